@@ -0,0 +1,45 @@
+#!/usr/bin/python
+
+#
+# Measures how long pb.api.API construction takes with an empty (cold) and a populated (warm) WSDL cache
+#
+# usage: bench-startup.py [-url wsdlUrl | -wsdl wsdlFile] [-n runs]
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import pb.api
+
+def construct(wsdl, cacheLocation):
+	pb.api.API.cacheLocation = cacheLocation
+	start = time.time()
+	pb.api.API("bench", "bench", wsdl = wsdl)
+	return time.time() - start
+
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+if "-url" in args:
+	pb.api.API.url = args["-url"]
+wsdl = args.get("-wsdl")
+runs = int(args.get("-n", 5))
+
+cacheLocation = tempfile.mkdtemp(prefix = "pbapi-bench-")
+try:
+	cold = []
+	for i in range(runs):
+		shutil.rmtree(cacheLocation)
+		cold.append(construct(wsdl, cacheLocation))
+	warm = [construct(wsdl, cacheLocation) for i in range(runs)]
+finally:
+	shutil.rmtree(cacheLocation, True)
+
+print "WSDL: %s" % (wsdl or pb.api.API.url)
+print "%-6s %10s %10s %10s" % ("cache", "min (ms)", "avg (ms)", "max (ms)")
+for name, times in (("cold", cold), ("warm", warm)):
+	print "%-6s %10.1f %10.1f %10.1f" % (name, min(times) * 1000, sum(times) / len(times) * 1000, max(times) * 1000)
+print "speedup: %.1fx" % (sum(cold) / sum(warm))
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+#
+# Benchmark suite: runs every benchmark against an in-process stand-in server (test/standin.py) and writes the
+# results, tagged with the current commit, to a JSON file so that runs of different commits can be compared.
+#
+# usage: bench-suite.py [-o results.json] [-n runs] [-servers 10,100,1000] [-calls N] [-latency ms]
+#                       [-only startup,init,latency,format,throughput] [-compare baseline.json] [-threshold 0.1]
+#
+# Benchmarks (times in milliseconds, throughputs in operations per second):
+#   startup.*     wall time of a process: bare python, importing pb.api, pbapi.py answering locally (@list,
+#                 @list-simple, an argument error) and pbapi.py running one operation with a warm WSDL cache
+#   init.*        pb.api.API construction with an empty (cold) and a populated (warm) WSDL cache
+#   latency.*     round trip of single API calls, reads and writes
+#   format.*      printDataCenter of a data center with that many servers, as text and as -o jsonl and csv records
+#                 (the reply is fetched once)
+#   decode.*      getDataCenter of a data center with that many servers, transport and reply decoding included,
+#                 decoded by suds and (decode.fast.*) by pb.fastxml
+#   parse.*       decoding of the getDataCenter reply alone, by suds and by pb.fastxml
+#   memory.*      peak memory (KiB) added by decoding that reply, by suds and by pb.fastxml: the peak of a fresh
+#                 process fetching and decoding it, less the peak of one only fetching it
+#   throughput.*  many getServer calls: one after the other, through a batch, and through AsyncAPI
+#
+# With -compare, every result is also compared with the same result in the baseline file; the exit status is 1
+# if any of them got worse by more than the threshold (default 10%).
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import resource
+import subprocess
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "src"))
+sys.path.insert(0, os.path.join(root, "test"))
+
+import pb.api
+import pb.batch
+import pb.asyncapi
+import pb.formatter
+import suds.client
+import standin
+
+# Output sink for the Formatter and the batch, so the benchmarks measure rendering and not the terminal
+class NullOutput:
+
+	softspace = 0
+
+	def write(self, data):
+		pass
+
+	def flush(self):
+		pass
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+# Summary of a list of durations (seconds), in milliseconds
+def timings(durations):
+	ms = [d * 1000 for d in durations]
+	return {"unit": "ms", "n": len(ms), "min": min(ms), "median": percentile(ms, 50), "p95": percentile(ms, 95), "mean": sum(ms) / len(ms), "max": max(ms)}
+
+def kilobytes(value):
+	return {"unit": "KiB", "n": 1, "value": value}
+
+def rate(count, duration):
+	return {"unit": "ops/s", "n": count, "value": count / duration}
+
+def measure(func, runs):
+	durations = []
+	for i in range(runs):
+		start = time.time()
+		func()
+		durations.append(time.time() - start)
+	return durations
+
+def commit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = root, stderr = open(os.devnull, "w")).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return "unknown"
+
+class Suite:
+
+	def __init__(self, server, runs, sizes, calls):
+		self.server = server
+		self.runs = runs
+		self.sizes = sizes
+		self.calls = calls
+		self.results = {}
+		self.cacheLocation = tempfile.mkdtemp(prefix = "pbapi-bench-")
+		pb.api.API.cacheLocation = self.cacheLocation
+		pb.api.API.url = server.url
+		self.api = pb.api.API("bench", "bench")
+		account = server.account
+		self.dataCenters = dict((size, account.seed(size, "bench-%d" % size)) for size in sizes)
+		account.provisioning = 0
+		dcid = self.dataCenters[min(sizes)]
+		self.serverIds = [s["serverId"] for s in account.servers.values() if s["_dc"] == dcid]
+		self.storageIds = [s["storageId"] for s in account.storages.values() if s["_dc"] == dcid]
+
+	def close(self):
+		shutil.rmtree(self.cacheLocation, True)
+
+	def add(self, name, result):
+		self.results[name] = result
+		if result["unit"] == "ms":
+			print "%-34s %9.2f %9.2f %9.2f ms (n=%d)" % (name, result["median"], result["p95"], result["max"], result["n"])
+		elif result["unit"] == "KiB":
+			print "%-34s %9d KiB" % (name, result["value"])
+		else:
+			print "%-34s %9.1f ops/s (n=%d)" % (name, result["value"], result["n"])
+
+	def startup(self):
+		env = dict(os.environ, PB_API_URL = self.server.url, PB_CACHE_DIR = self.cacheLocation)
+		pbapi = os.path.join(root, "src", "pbapi.py")
+		devnull = open(os.devnull, "w")
+		run = lambda args: subprocess.call([sys.executable, pbapi] + args, env = env, stdout = devnull, stderr = devnull)
+		python = lambda code: subprocess.call([sys.executable, "-c", code], env = env, cwd = os.path.join(root, "src"), stdout = devnull, stderr = devnull)
+		self.add("startup.python", timings(measure(lambda: python("pass"), self.runs)))
+		self.add("startup.importApi", timings(measure(lambda: python("import pb.api"), self.runs)))
+		self.add("startup.help", timings(measure(lambda: run(["@list"]), self.runs)))
+		self.add("startup.listSimple", timings(measure(lambda: run(["@list-simple"]), self.runs)))
+		self.add("startup.argsError", timings(measure(lambda: run(["get-server"]), self.runs)))
+		run(["-u", "bench", "-p", "bench", "get-all-datacenters"]) # warms the WSDL cache
+		dcid = self.dataCenters[min(self.sizes)]
+		self.add("startup.getDataCenterState", timings(measure(lambda: run(["-u", "bench", "-p", "bench", "get-datacenter-state", "-dcid", dcid]), self.runs)))
+
+	def init(self):
+		def cold():
+			shutil.rmtree(self.cacheLocation, True)
+			pb.api.API("bench", "bench")
+		self.add("init.cold", timings(measure(cold, self.runs)))
+		self.add("init.warm", timings(measure(lambda: pb.api.API("bench", "bench"), self.runs)))
+
+	def latency(self):
+		api = self.api
+		dcid = self.dataCenters[min(self.sizes)]
+		runs = self.runs * 4
+		self.add("latency.getAllDataCenters", timings(measure(api.getAllDataCenters, runs)))
+		self.add("latency.getDataCenterState", timings(measure(lambda: api.getDataCenterState(dcid), runs)))
+		self.add("latency.getServer", timings(measure(lambda: api.getServer(self.serverIds[0]), runs)))
+		self.add("latency.getStorage", timings(measure(lambda: api.getStorage(self.storageIds[0]), runs)))
+		self.add("latency.getAllImages", timings(measure(api.getAllImages, runs)))
+		self.add("latency.updateServer", timings(measure(lambda: api.updateServer({"srvid": self.serverIds[0], "name": "renamed"}), runs)))
+		created = []
+		self.add("latency.createDataCenter", timings(measure(lambda: created.append(str(api.createDataCenter("bench-tmp").dataCenterId)), runs)))
+		self.add("latency.deleteDataCenter", timings(measure(lambda: api.deleteDataCenter(created.pop()), runs)))
+
+	def format(self):
+		for size in self.sizes:
+			dcid = self.dataCenters[size]
+			self.add("decode.getDataCenter.%d" % size, timings(measure(lambda: self.api.getDataCenter(dcid), self.runs)))
+			self.api.fastDecode = ["getDataCenter"]
+			try:
+				self.add("decode.fast.getDataCenter.%d" % size, timings(measure(lambda: self.api.getDataCenter(dcid), self.runs)))
+			finally:
+				del self.api.fastDecode
+			xml = rawReply(self.api, "getDataCenter", dcid)
+			for decoder in ("suds", "fast"):
+				self.add("parse.%s.getDataCenter.%d" % (decoder, size), timings(measure(lambda: decode(self.api, decoder, "getDataCenter", xml), self.runs)))
+			baseline = self.memory("none", dcid)
+			for decoder in ("suds", "fast"):
+				self.add("memory.%s.getDataCenter.%d" % (decoder, size), kilobytes(self.memory(decoder, dcid) - baseline))
+			dataCenter = self.api.getDataCenter(dcid)
+			for mode in ("text", "jsonl", "csv"):
+				savedStdout, sys.stdout = sys.stdout, NullOutput()
+				try:
+					durations = measure(lambda: self.render(mode, dataCenter), self.runs)
+				finally:
+					sys.stdout = savedStdout
+				self.add("format.dataCenter.%d" % size if mode == "text" else "format.%s.dataCenter.%d" % (mode, size), timings(durations))
+
+	# Runs this script with -memory-probe in a fresh process, so that each decoder starts from the same state
+	def memory(self, decoder, dcid):
+		env = dict(os.environ, PB_CACHE_DIR = self.cacheLocation)
+		output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "-memory-probe", decoder, "-url", self.server.url, "-dcid", dcid, "-warm", self.dataCenters[min(self.sizes)]], env = env)
+		return int(output.split()[-1])
+
+	def render(self, mode, dataCenter):
+		formatter = pb.formatter.forArgs({"s": False, "o": mode if mode != "text" else None})
+		formatter.printDataCenter(dataCenter)
+		formatter.end()
+
+	def throughput(self):
+		api = self.api
+		ids = [self.serverIds[i % len(self.serverIds)] for i in range(self.calls)]
+		start = time.time()
+		for srvid in ids:
+			api.getServer(srvid)
+		self.add("throughput.serial", rate(len(ids), time.time() - start))
+		for parallel in (4, 8):
+			batch = pb.batch.Batch(api, short = True, parallel = parallel)
+			start = time.time()
+			batch.run(["get-server -srvid %s" % srvid for srvid in ids], out = NullOutput())
+			self.add("throughput.batch.%d" % parallel, rate(len(ids), time.time() - start))
+		asyncApi = pb.asyncapi.AsyncAPI("bench", "bench")
+		start = time.time()
+		asyncApi.loop.run(pb.asyncapi.gather([asyncApi.getServer(srvid) for srvid in ids]))
+		self.add("throughput.async", rate(len(ids), time.time() - start))
+
+# The reply XML of func, undecoded
+def rawReply(api, func, *args):
+	client = api.client.clone()
+	client.set_options(retxml = True)
+	return getattr(client.service, func)(*args)
+
+def decode(api, decoder, func, xml):
+	if decoder == "fast":
+		return api.fastDecoder().decode(xml)
+	method = getattr(api.client.service, func).method
+	return suds.client.SoapClient(api.client, method).succeeded(method.binding.output, xml)
+
+# Peak memory of this process in KiB. ru_maxrss is a last resort: on Linux it includes the peak of the (large)
+# benchmark process that forked this one
+def peakMemory():
+	try:
+		for line in open("/proc/self/status"):
+			if line.startswith("VmHWM:"):
+				return int(line.split()[1])
+	except IOError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Prints the peak memory (KiB) of this process after fetching the getDataCenter reply of dcid and decoding
+# it with decoder ("none" doesn't decode it); the reply of the (small) data center warm is decoded first, so that
+# setting the decoder up isn't counted
+def memoryProbe(decoder, url, dcid, warm):
+	api = pb.api.API("bench", "bench", url = url)
+	if decoder != "none":
+		decode(api, decoder, "getDataCenter", rawReply(api, "getDataCenter", warm))
+	xml = rawReply(api, "getDataCenter", dcid)
+	result = decode(api, decoder, "getDataCenter", xml) if decoder != "none" else None
+	print peakMemory()
+
+# Prints how each result changed from baseline to results; returns the names of the ones worse by more than threshold
+def compare(baseline, results, threshold):
+	regressions = []
+	print
+	print "%-34s %12s %12s %8s" % ("compared with " + baseline.get("commit", "?"), "before", "after", "change")
+	for name in sorted(results):
+		if name not in baseline["results"]:
+			continue
+		before, after = baseline["results"][name], results[name]
+		if after["unit"] == "ms":
+			old, new = before["median"], after["median"]
+			worse = new > old * (1 + threshold)
+		elif after["unit"] == "KiB":
+			old, new = before["value"], after["value"]
+			worse = new > old * (1 + threshold)
+		else:
+			old, new = before["value"], after["value"]
+			worse = new < old * (1 - threshold)
+		change = (new - old) / old * 100 if old else 0
+		print "%-34s %12.2f %12.2f %+7.1f%%%s" % (name, old, new, change, " WORSE" if worse else "")
+		if worse:
+			regressions.append(name)
+	return regressions
+
+if __name__ == "__main__":
+	args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+	if "-memory-probe" in args:
+		memoryProbe(args["-memory-probe"], args["-url"], args["-dcid"], args["-warm"])
+		sys.exit(0)
+	benchmarks = ["startup", "init", "latency", "format", "throughput"]
+	only = args["-only"].split(",") if "-only" in args else benchmarks
+	sizes = [int(size) for size in args.get("-servers", "10,100,1000").split(",")]
+	server = standin.StandInServer(latency = float(args.get("-latency", 0))).start()
+	suite = Suite(server, int(args.get("-n", 10)), sizes, int(args.get("-calls", 500)))
+	try:
+		print "%-34s %9s %9s %9s" % ("benchmark", "median", "p95", "max")
+		for name in benchmarks:
+			if name in only:
+				getattr(suite, name)()
+	finally:
+		suite.close()
+		server.stop()
+
+	revision = commit()
+	output = args.get("-o", "bench-%s.json" % revision)
+	report = {"commit": revision, "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "python": platform.python_version(), "platform": platform.platform(), "latency": float(args.get("-latency", 0)), "results": suite.results}
+	json.dump(report, open(output, "w"), indent = 1, sort_keys = True)
+	print "Results written to %s" % output
+
+	if "-compare" in args:
+		regressions = compare(json.load(open(args["-compare"])), suite.results, float(args.get("-threshold", 0.1)))
+		if regressions:
+			sys.exit(1)
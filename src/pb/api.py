@@ -1,29 +1,124 @@
 import sys
+import copy
+import time
+import hashlib
+import random
 import suds
 import logging
+import threading
 import errorhandler
+import wsdlcache
+import httppool
+import fastxml
+import retry
+import cassette
 from suds.transport.http import HttpAuthenticated
 from suds.transport import Request
+from cStringIO import StringIO
 
-## We need to patch suds.client.SoapClient because it doesn't throw an exception in case of bad authentication
+## We need to patch suds.client.SoapClient because it doesn't throw an exception in case of bad authentication.
+## A 500 raises the WebFault in its body; without one (an empty body, a proxy's error page) it would be returned as
+## the result, it raises the TransportError instead, which the retry policy may retry.
 class SudsClientPatched(suds.client.SoapClient):
 	_oldFailed = suds.client.SoapClient.failed
 	def failed(self, binding, error):
-		if error.httpcode == 500:
-			return SudsClientPatched._oldFailed(self, binding, error)
-		else:
-			raise error
+		if error.httpcode == 500 and error.fp is not None:
+			body = error.fp.read()
+			error.fp = StringIO(body)
+			try:
+				if body:
+					SudsClientPatched._oldFailed(self, binding, error)
+			except suds.WebFault:
+				raise
+			except Exception:
+				pass
+			error.fp = StringIO(body)
+		raise error
 suds.client.SoapClient = SudsClientPatched
 ## End patch
 
+## suds' bindings (shared by the clones of a client) have a single MultiRef, whose process() keeps the nodes of the
+## reply it works on in the instance: threads decoding replies at the same time could get each other's bodies.
+## Each reply gets a MultiRef of its own.
+_processMultiRefs = suds.bindings.multiref.MultiRef.process
+suds.bindings.multiref.MultiRef.process = lambda self, body: _processMultiRefs(suds.bindings.multiref.MultiRef(), body)
+## End patch
+
+# Identical read calls made at the same time by several threads (eg, the workers of a batch waiting for the same data
+# center): the first one goes to the network, the others wait for it and get the same result, or the same error.
+# A call only joins one that started after the last write made through the API (see wrote), so that a thread reading
+# what it just changed doesn't get a reply from before the change. Results are shared as they are, they must not be
+# modified.
+class SharedCalls:
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.calls = {} # key => [threading.Event set when done, result, sys.exc_info() of the error]
+		self.writes = 0 # writes made so far
+		self.stats = {"calls": 0, "shared": 0}
+	
+	# Returns fn(), or the result of the fn() already running for key
+	def run(self, key, fn):
+		with self.lock:
+			key = (key, self.writes)
+			call = self.calls.get(key)
+			first = call is None
+			if first:
+				call = self.calls[key] = [threading.Event(), None, None]
+				self.stats["calls"] += 1
+			else:
+				self.stats["shared"] += 1
+		if first:
+			try:
+				call[1] = fn()
+			except BaseException:
+				call[2] = sys.exc_info()
+			finally:
+				with self.lock:
+					del self.calls[key]
+				call[0].set()
+		else:
+			call[0].wait()
+		if call[2] is not None:
+			raise call[2][0], call[2][1], call[2][2]
+		return call[1]
+	
+	# Called once a call that may have changed something is over (whether it failed or not)
+	def wrote(self):
+		with self.lock:
+			self.writes += 1
+
 class API:
 	
-	url = "https://api.profitbricks.com/1.1/wsdl"
+	url = "https://api.profitbricks.com/1.1/wsdl" # WSDL of the service; its endpoint is the address the WSDL gives
+	wsdl = None # path of a local copy of the WSDL; if set, it is used instead of downloading url
+	cacheLocation = None # directory for the parsed WSDL cache (see wsdlcache.userCacheDir)
+	cache = None # optional responsecache.ResponseCache for the replies of read operations
+	cacheScope = "" # the replies of this account and endpoint in cache (a digest: the password is part of it)
+	inventory = None # inventory.Inventory last loaded by the find operation
+	sync = None # sync.Sync the inventory is loaded from, downloading only the data centers that changed
+	reads = ["getAllDataCenters", "getDataCenter", "getDataCenterState", "getServer", "getStorage", "getNic", "getLoadBalancer", "getAllImages", "getImage", "getAllPublicIpBlocks"] # operations that change nothing
+	coalesced = reads # operations shared by identical concurrent calls (see SharedCalls); never add a mutation
+	retryPolicy = retry.RetryPolicy() # which failed calls are made again, and when (see retry.RetryPolicy)
+	rateLimiter = None # optional ratelimit.RateLimiter every call (and every retry) waits for
+	cassette = None # optional cassette.Cassette the calls are recorded to, or replayed from without any network access
+	metrics = None # optional metrics.Metrics counting every call (see measured) and the building of the client
+	breaker = None # retry.CircuitBreaker of the endpoint, shared with all API objects calling it
+	sharedCalls = None # SharedCalls of this API and its clones
+	fastDecode = [] # operations whose replies are decoded by fastxml.Decoder instead of suds (see fastxml.defaultOperations)
+	rawClient = None # clone of client returning the reply XML, for fastDecode
+	decoder = None
 	debug = False
 	requestId = None
+	broken = False # set when the client can no longer be trusted (bad credentials, transport errors); see APIPool
+	pollMin = 0.5 # seconds between the first state polls of waitUntilAvailable
+	pollMax = 10.0 # longest time between two polls
+	pollBackoff = 1.5 # factor by which the time between polls grows while a data center stays busy
+	pollJitter = 0.2 # polls are spread by +/- this fraction so parallel waiters don't poll in lockstep
 	
-	def __init__(self, username, password, debug = False):
+	def __init__(self, username, password, debug = False, wsdl = None, url = None):
 		self.debug = debug
+		self.broken = True
 		if debug:
 			logging.getLogger("suds.server").setLevel(logging.DEBUG)
 			logging.getLogger("suds.client").setLevel(logging.DEBUG)
@@ -31,22 +126,65 @@ class API:
 		else:
 			logging.getLogger('suds.client').setLevel(logging.CRITICAL) # hide soap faults
 
+		self.url = url or self.url
+		self.sharedCalls = SharedCalls()
+		self.breaker = retry.breakerFor(self.url)
+		self.wsdl = wsdl = wsdl or self.wsdl
+		self.cacheScope = hashlib.sha1(repr((self.url, wsdl, username, password))).hexdigest()
+		wsdlUrl = wsdlcache.localWsdlUrl(wsdl) if wsdl else self.url
+		if self.cassette is None:
+			self.transport = httppool.PooledTransport(username = username, password = password)
+			cache = wsdlcache.WsdlCache(wsdlUrl, self.cacheLocation)
+		elif self.cassette.recording:
+			self.transport = self.cassette.transport(username = username, password = password)
+			cache = suds.cache.NoCache() # the WSDL must be read, to be recorded
+		else:
+			self.transport = self.cassette.transport(username = username, password = password)
+			cache = wsdlcache.WsdlCache(wsdlUrl, self.cacheLocation, digest = self.cassette.digest(wsdlUrl) or "none")
 		try:
-			self.client = suds.client.Client(url = self.url, username = username, password = password)
+			newClient = lambda: suds.client.Client(url = wsdlUrl, transport = self.transport, cache = cache, cachingpolicy = 1) # 1: cache the parsed Definitions, not just the documents
+			self.client = self.metrics.timed("client", newClient) if self.metrics is not None else newClient()
 		except suds.transport.TransportError as (err):
 			if err.httpcode == 401:
 				print "Error: Invalid username or password"
 			else:
 				print "Error: Unknown error: %s" % str(err)
 			errorhandler.exit(3)
+			return
+		self.broken = False
+	
+	# Returns a new API sharing the parsed WSDL and the connection pool with this one, to be used from another thread
+	def clone(self):
+		api = copy.copy(self)
+		api.client = self.client.clone()
+		api.transport = api.client.options.transport
+		api.rawClient = None
+		api.requestId = None
+		return api
 	
 	# Calls the func() function using SOAP and the given arguments list (must always be an array)
 	def call(self, func, args):
+		if self.cache is not None:
+			result = self.cache.get(func, args, self.cacheScope)
+			if result is not None:
+				if self.debug:
+					print "# Cached %s %s" % (func, args)
+				return result
 		if (self.debug):
 			print "# Calling %s %s" % (func, args)
 		try:
-			method = getattr(self.client.service, func)
-			result = method(*args)
+			if func in self.coalesced:
+				result = self.measured(func, lambda: self.sharedCalls.run((func, repr(args)), lambda: self.send(func, args)))
+			else:
+				try:
+					result = self.measured(func, lambda: self.send(func, args))
+				finally:
+					if func not in self.reads:
+						self.sharedCalls.wrote()
+						if self.cache is not None:
+							self.cache.wrote(func, args)
+			if self.cache is not None:
+				self.cache.put(func, args, result, self.cacheScope)
 			if self.requestId is None:
 				if "requestId" in result:
 					self.requestId = result["requestId"]
@@ -56,13 +194,58 @@ class API:
 		except suds.WebFault as (err):
 			print "Error: %s" % str(err)
 			errorhandler.exit(2)
+		except (retry.CircuitOpen, cassette.Miss) as (err):
+			# the client is fine: a new one would share the breaker (and the cassette)
+			print "Error: %s" % str(err)
+			errorhandler.exit(3)
 		except suds.transport.TransportError as (err):
+			self.broken = True
 			if err.httpcode == 401:
 				print "Error: Invalid username or password"
 			else:
 				print "Error: Unknown error: %s" % str(err)
 			errorhandler.exit(3)
 	
+	# Returns fn(), the network part of a call of func, recording its time, bytes and outcome in metrics
+	def measured(self, func, fn):
+		if self.metrics is None:
+			return fn()
+		sent, received = self.transport.traffic()
+		started = time.time()
+		failed = True
+		try:
+			result = fn()
+			failed = False
+			return result
+		finally:
+			nowSent, nowReceived = self.transport.traffic()
+			self.metrics.record(func, time.time() - started, failed, nowSent - sent, nowReceived - received)
+	
+	# Calls func on the network (again, if it fails in a way retryPolicy allows) and returns the decoded reply; the
+	# errors are left to call()
+	def send(self, func, args):
+		return self.retryPolicy.run(lambda: self.sendOnce(func, args), func in self.reads, self.breaker, self.debug)
+	
+	def sendOnce(self, func, args):
+		if self.rateLimiter is not None:
+			self.rateLimiter.acquire(func in self.reads)
+		if func in self.fastDecode:
+			return self.fastCall(func, args)
+		return getattr(self.client.service, func)(*args)
+	
+	# Calls func like call() does, but gets the reply XML from suds and decodes it with fastxml.Decoder
+	def fastCall(self, func, args):
+		if self.rawClient is None:
+			self.rawClient = self.client.clone()
+			self.rawClient.set_options(retxml = True)
+		return self.fastDecoder().decode(getattr(self.rawClient.service, func)(*args))
+	
+	# The fastxml.Decoder for the replies of this API's WSDL, built on first use and shared by its clones
+	def fastDecoder(self):
+		if self.decoder is None:
+			self.decoder = fastxml.Decoder(self.client.wsdl.schema)
+		return self.decoder
+	
 	# Returns the userArgs hash, but replaces the keys with the values found in translation and only the ones found in translation
 	# eg, parseArgs({"a": 10, "b": 20, "c": 30}, {"a": "a", "b": "B"}) => {"a": 10, "B": 20}
 	def parseArgs(self, userArgs, translation):
@@ -87,6 +270,35 @@ class API:
 	def getDataCenterState(self, id):
 		return self.call("getDataCenterState", [id])
 	
+	# Polls the provisioning state of all the given data centers in a single loop until each of them is AVAILABLE
+	# (or DELETED, or its state can't be read), waiting longer between polls the longer a data center stays busy.
+	# progress(states) is called after every round of polls. Returns {dcid: last state}.
+	def waitUntilAvailable(self, dcids, timeout = 600, progress = None):
+		deadline = time.time() + timeout
+		states = dict((dcid, None) for dcid in dcids)
+		interval = dict((dcid, self.pollMin) for dcid in dcids)
+		nextPoll = dict((dcid, 0) for dcid in dcids)
+		pending = set(dcids)
+		while pending:
+			now = time.time()
+			for dcid in [dcid for dcid in pending if nextPoll[dcid] <= now]:
+				state = self.getDataCenterState(dcid)
+				states[dcid] = str(state) if state is not None else None
+				if states[dcid] in (None, "AVAILABLE", "DELETED"):
+					pending.discard(dcid)
+				else:
+					nextPoll[dcid] = now + interval[dcid] * random.uniform(1 - self.pollJitter, 1 + self.pollJitter)
+					interval[dcid] = min(interval[dcid] * self.pollBackoff, self.pollMax)
+			if progress is not None:
+				progress(states)
+			if not pending or now >= deadline:
+				break
+			time.sleep(max(0, min(min(nextPoll[dcid] for dcid in pending), deadline) - time.time()))
+		if pending:
+			print "Error: Timed out waiting for %s" % ", ".join("%s (%s)" % (dcid, states[dcid]) for dcid in sorted(pending))
+			errorhandler.exit(4)
+		return states
+	
 	def updateDataCenter(self, userArgs):
 		args = self.parseArgs(userArgs, {"dcid": "dataCenterId", "name": "dataCenterName"})
 		return self.call("updateDataCenter", [args])
@@ -137,13 +349,16 @@ class API:
 	def deleteStorage(self, id):
 		return self.call("deleteStorage", [id])
 	
-	def createLoadBalancer(self, userArgs):
+	def _parseLoadBalancerArgs(self, userArgs):
 		args = self.parseArgs(userArgs, {"dcid": "dataCenterId", "name": "loadBalancerName", "ip": "ip", "lanid": "lanId"})
 		if "algo" in userArgs:
 			args["loadBalancerAlgorithm"] = userArgs["algo"].upper()
 		if "srvid" in userArgs:
 			args["serverIds"] = userArgs["srvid"].split(",")
-		result = self.call("createLoadBalancer", [args])
+		return args
+	
+	def createLoadBalancer(self, userArgs):
+		result = self.call("createLoadBalancer", [self._parseLoadBalancerArgs(userArgs)])
 		return result.loadBalancerId
 	
 	def getLoadBalancer(self, id):
@@ -243,3 +458,30 @@ class API:
 		return self.call("addFirewallRuleToLoadBalancer", [id, [rule]])
 	
 
+# Keeps warm API clients keyed by credentials, debug flag and WSDL, so that programs running many operations
+# (such as the pbcli.py shell) pay for building the suds client once instead of once per operation
+class APIPool:
+	
+	def __init__(self):
+		self.clients = {}
+		self.lock = threading.Lock()
+	
+	# Returns a ready API for these settings, building a new one only if there is none yet or the old one went bad
+	def get(self, username, password, debug = False, wsdl = None, url = None):
+		key = (username, password, debug, wsdl, url)
+		with self.lock:
+			api = self.clients.get(key)
+			if api is not None and not api.broken:
+				api.requestId = None
+				return api
+			# credentials changed or the client broke, forget the clients built for this user so far
+			for oldKey in [k for k in self.clients if k[0] == username]:
+				del self.clients[oldKey]
+			api = API(username, password, debug = debug, wsdl = wsdl, url = url)
+			if not api.broken:
+				self.clients[key] = api
+			return api
+	
+	def clear(self):
+		with self.lock:
+			self.clients = {}
@@ -1,14 +1,64 @@
+import os
 import errorhandler
+import inventory
+import registry
+
+# batch loads the SOAP client, which the local (@) operations must not wait for, so it is only imported when a batch runs
+def _runBatch(formatter, api, opArgs):
+	import batch
+	batch.runBatch(formatter, api, opArgs)
+
+# Same for provision (which uses batch)
+def _createServers(formatter, api, opArgs):
+	import provision
+	results = provision.createServers(api, opArgs)
+	formatter.printCreateServers(results)
+	if any(result["error"] is not None for result in results):
+		formatter.end()
+		errorhandler.exit(3)
+
+# Same for topology
+def _planTopology(formatter, api, opArgs):
+	import topology
+	plan = topology.plan(api, opArgs)
+	if plan is not None:
+		formatter.printPlan(plan)
+
+def _applyTopology(formatter, api, opArgs):
+	import topology
+	plan = topology.apply(api, opArgs)
+	if plan is not None:
+		formatter.printApply(plan)
+		if plan.failed():
+			formatter.end()
+			errorhandler.exit(3)
+
+# Same for watch (which uses sync, which uses batch); the events are printed as they come, until Ctrl-C
+def _watchDataCenter(formatter, api, opArgs):
+	import watch
+	try:
+		for event in watch.watchDataCenter(api, opArgs):
+			formatter.printWatchEvent(event)
+	except KeyboardInterrupt:
+		pass
+
+def _waitDataCenter(formatter, api, opArgs):
+	try:
+		timeout = float(opArgs.get("timeout") or 600)
+	except ValueError:
+		errorhandler.ArgsError("-timeout must be a number")
+		return
+	formatter.printWaitDataCenter(api.waitUntilAvailable(opArgs["dcid"].split(","), timeout))
 
 class ArgsParser:
 	
 	def __init__(self):
-		self.baseArgs = {"s": False, "debug": False} # s = short output formatting
+		self.baseArgs = {"s": False, "debug": False, "cache": False, "fast": False, "retries": None, "rate": os.environ.get("PB_RATE"), "stats": False, "statsfile": os.environ.get("PB_STATS_FILE"), "record": None, "replay": None, "replaylatency": False, "daemon": False, "wsdl": os.environ.get("PB_WSDL"), "url": os.environ.get("PB_API_URL"), "o": None} # s = short output formatting
 		self.opArgs = {}
 	
 	def readUserArgs(self, argv):
 		i = 1
-		# -u -p -auth -debug and -s are base arguments, everything else are operation arguments
+		# -u -p -auth -url -wsdl -cache -fast -retries -rate -stats -stats-file -record -replay -replay-latency -daemon -debug -s -o and -help are base arguments, everything else are operation arguments
 		# operation argument names are converted to lower-case and have dashes removed (eg, "create-datacenter -nA-Me hello" => baseArgs["op"]="create-datacenter", opArgs["name"]="hello")
 		while i < len(argv):
 			arg = argv[i]
@@ -46,33 +96,77 @@ class ArgsParser:
 				except:
 					ProfitBricks.ArgsError("Authfile does not exist or cannot be read")
 				i += 1
+			elif arg.lower() == "-url":
+				if i == len(argv) - 1:
+					errorhandler.ArgsError("Missing WSDL URL")
+				self.baseArgs["url"] = argv[i + 1]
+				i += 1
+			elif arg.lower() == "-wsdl":
+				if i == len(argv) - 1:
+					errorhandler.ArgsError("Missing WSDL file")
+				self.baseArgs["wsdl"] = argv[i + 1]
+				i += 1
+			elif arg.lower() == "-cache":
+				self.baseArgs["cache"] = True
+			elif arg.lower() == "-retries":
+				if i == len(argv) - 1 or not argv[i + 1].isdigit():
+					errorhandler.ArgsError("-retries must be a number")
+				else:
+					self.baseArgs["retries"] = int(argv[i + 1])
+				i += 1
+			elif arg.lower() == "-rate":
+				if i == len(argv) - 1:
+					errorhandler.ArgsError("Missing rate")
+				self.baseArgs["rate"] = argv[i + 1]
+				i += 1
+			elif arg.lower() == "-fast":
+				self.baseArgs["fast"] = True
+			elif arg.lower() == "-stats":
+				self.baseArgs["stats"] = True
+			elif arg.lower() == "-stats-file":
+				if i == len(argv) - 1:
+					errorhandler.ArgsError("Missing stats file")
+				self.baseArgs["statsfile"] = argv[i + 1]
+				i += 1
+			elif arg.lower() in ("-record", "-replay"):
+				if i == len(argv) - 1:
+					errorhandler.ArgsError("Missing cassette file")
+				self.baseArgs[arg.lower()[1:]] = argv[i + 1]
+				i += 1
+			elif arg.lower() == "-replay-latency":
+				self.baseArgs["replaylatency"] = True
+			elif arg.lower() == "-daemon":
+				self.baseArgs["daemon"] = True
 			elif arg.lower() == "-debug":
 				self.baseArgs["debug"] = True
 			elif arg.lower() == "-s":
 				self.baseArgs["s"] = True
+			elif arg.lower() == "-o":
+				if i == len(argv) - 1 or argv[i + 1].lower() not in ("text", "json", "jsonl", "csv"):
+					errorhandler.ArgsError("-o must be one of: text json jsonl csv")
+				else:
+					self.baseArgs["o"] = argv[i + 1].lower() if argv[i + 1].lower() != "text" else None
+				i += 1
+			elif arg.lower() in ("-help", "--help"):
+				self.baseArgs["op"] = "@list"
 			# if not base arg, then it is operation arg
 			else:
 				self.opArgs[arg[1:].lower().replace("-", "")] = (argv[i + 1] if i < len(argv) - 1 else "")
 				i += 1
 			i += 1
 		
-		if "op" not in self.baseArgs:
+		if "op" not in self.baseArgs and not self.baseArgs["daemon"]:
 			errorhandler.ArgsError("Missing operation")
 		
 		self._loadAuthFile()
 	
 	def getRequestedOperation(self):
-		userOperation = self.baseArgs["op"].replace("-", "").lower()
-		for op in ArgsParser.operations:
-			if '@' + userOperation == op.replace("-", "").lower():
-				return op
-			if userOperation != op.replace("-", "").lower():
-				continue
-			for requiredArg in ArgsParser.operations[op]["args"]:
-				if not requiredArg in self.opArgs:
-					errorhandler.ArgsError("operation '%s' requires these arguments: -%s" % (self.baseArgs["op"], " -".join(ArgsParser.operations[op]["args"])))
+		op = ArgsParser.registry.lookup(self.baseArgs["op"])
+		if op is None or ArgsParser.registry.isLocal(op):
 			return op
-		return None
+		if ArgsParser.registry.missingArgs(op, self.opArgs):
+			errorhandler.ArgsError("operation '%s' requires these arguments: -%s" % (self.baseArgs["op"], " -".join(ArgsParser.operations[op]["args"])))
+		return op
 	
 	def _loadAuthFile(self):
 		if "u" not in self.baseArgs or "p" not in self.baseArgs:
@@ -100,7 +194,17 @@ class ArgsParser:
 				"args": ["dcid"],
 				"lambda": lambda formatter, api, opArgs: formatter.printDataCenterState(api.getDataCenterState(opArgs["dcid"]))
 			},
+			"waitDataCenter": {
+				"args": ["dcid"],
+				"lambda": lambda formatter, api, opArgs: _waitDataCenter(formatter, api, opArgs)
+			},
+			"watchDataCenter": {
+				"aliases": ["watch"],
+				"args": [],
+				"lambda": lambda formatter, api, opArgs: _watchDataCenter(formatter, api, opArgs)
+			},
 			"getAllDataCenters": {
+				"aliases": ["listDataCenters"],
 				"args": [],
 				"lambda": lambda formatter, api, opArgs: formatter.printAllDataCenters(api.getAllDataCenters())
 			},
@@ -120,6 +224,12 @@ class ArgsParser:
 				"args": ["cores", "ram"],
 				"lambda": lambda formatter, api, opArgs: formatter.printCreateServer(api.createServer(opArgs))
 			},
+			"createServers": {
+				"aliases": ["bulkCreateServers"],
+				"args": ["dcid", "count", "cores", "ram"],
+				"optionalArgs": ["name", "first", "size", "mountimageid", "bootfromimageid", "lanid", "internetaccess", "ostype", "parallel"],
+				"lambda": lambda formatter, api, opArgs: _createServers(formatter, api, opArgs)
+			},
 			"getServer": {
 				"args": ["srvid"],
 				"lambda": lambda formatter, api, opArgs: formatter.printServer(api.getServer(opArgs["srvid"]))
@@ -145,10 +255,12 @@ class ArgsParser:
 				"lambda": lambda formatter, api, opArgs: formatter.printStorage(api.getStorage(opArgs["stoid"]))
 			},
 			"connectStorageToServer": {
+				"aliases": ["connectStorage"],
 				"args": ["stoid", "srvid", "bus"],
 				"lambda": lambda formatter, api, opArgs: formatter.printConnectStorageToServer(api.connectStorageToServer(opArgs))
 			},
 			"disconnectStorageFromServer": {
+				"aliases": ["disconnectStorage"],
 				"args": ["stoid", "srvid"],
 				"lambda": lambda formatter, api, opArgs: formatter.printDisconnectStorageFromServer(api.disconnectStorageFromServer(opArgs["stoid"], opArgs["srvid"]))
 			},
@@ -161,14 +273,17 @@ class ArgsParser:
 				"lambda": lambda formatter, api, opArgs: formatter.printDeleteStorage(api.deleteStorage(opArgs["stoid"]))
 			},
 			"createLoadBalancer": {
+				"aliases": ["createLb"],
 				"args": ["dcid"],
 				"lambda": lambda formatter, api, opArgs: formatter.printCreateLoadBalancer(api.createLoadBalancer(opArgs))
 			},
 			"getLoadBalancer": {
+				"aliases": ["getLb"],
 				"args": ["bid"],
 				"lambda": lambda formatter, api, opArgs: formatter.printLoadBalancer(api.getLoadBalancer(opArgs["bid"]))
 			},
 			"updateLoadBalancer": {
+				"aliases": ["updateLb"],
 				"args": ["bid"],
 				"lambda": lambda formatter, api, opArgs: formatter.printUpdateLoadBalancer(api.updateLoadBalancer(opArgs))
 			},
@@ -189,6 +304,7 @@ class ArgsParser:
 				"lambda": lambda formatter, api, opArgs: formatter.printDeactivateLoadBalancingOnServers(api.deactivateLoadBalancingOnServers(opArgs["srvid"].split(","), opArgs["bid"]))
 			},
 			"deleteLoadBalancer": {
+				"aliases": ["deleteLb"],
 				"args": ["bid"],
 				"lambda": lambda formatter, api, opArgs: formatter.printDeleteLoadBalancer(api.deleteLoadBalancer(opArgs["bid"]))
 			},
@@ -209,6 +325,7 @@ class ArgsParser:
 				"lambda": lambda formatter, api, opArgs: formatter.printImage(api.getImage(opArgs["imgid"]))
 			},
 			"getAllImages": {
+				"aliases": ["listImages"],
 				"args": [],
 				"lambda": lambda formatter, api, opArgs: formatter.printAllImages(api.getAllImages())
 			},
@@ -241,6 +358,7 @@ class ArgsParser:
 				"lambda": lambda formatter, api, opArgs: formatter.printDeleteNIC(api.deleteNIC(opArgs["nicid"]))
 			},
 			"reservePublicIpBlock": {
+				"aliases": ["reserveIpBlock"],
 				"args": ["size"],
 				"lambda": lambda formatter, api, opArgs: formatter.printPublicIPBlock(api.reservePublicIPBlock(opArgs["size"]))
 			},
@@ -249,6 +367,7 @@ class ArgsParser:
 				"lambda": lambda formatter, api, opArgs: formatter.printAddPublicIPToNIC(api.addPublicIPToNIC(opArgs["ip"], opArgs["nicid"]))
 			},
 			"getAllPublicIpBlocks": {
+				"aliases": ["listPublicIpBlocks"],
 				"args": [],
 				"lambda": lambda formatter, api, opArgs: formatter.printGetAllPublicIPBlocks(api.getAllPublicIPBlocks())
 			},
@@ -257,6 +376,7 @@ class ArgsParser:
 				"lambda": lambda formatter, api, opArgs: formatter.printRemovePublicIPFromNIC(api.removePublicIPFromNIC(opArgs["ip"], opArgs["nicid"]))
 			},
 			"releasePublicIpBlock": {
+				"aliases": ["releaseIpBlock"],
 				"args": ["blockid"],
 				"lambda": lambda formatter, api, opArgs: formatter.printReleasePublicIPBlock(api.releasePublicIPBlock(opArgs["blockid"]))
 			},
@@ -268,15 +388,32 @@ class ArgsParser:
 				"args": ["bid"],
 				"lambda": lambda formatter, api, opArgs: formatter.printAddFirewallRule(api.addFirewallRuleToLoadBalancer(opArgs["bid"], opArgs))
 			},
+			"find": {
+				"args": [],
+				"lambda": lambda formatter, api, opArgs: formatter.printFind(inventory.find(api, opArgs))
+			},
+			"planTopology": {
+				"aliases": ["plan"],
+				"args": ["file"],
+				"lambda": lambda formatter, api, opArgs: _planTopology(formatter, api, opArgs)
+			},
+			"applyTopology": {
+				"aliases": ["apply"],
+				"args": ["file"],
+				"lambda": lambda formatter, api, opArgs: _applyTopology(formatter, api, opArgs)
+			},
+			"batch": {
+				"args": [],
+				"lambda": lambda formatter, api, opArgs: _runBatch(formatter, api, opArgs)
+			},
 			"@list": {
 				"args": [],
-				"lambda": lambda helper: helper.printOperations(ArgsParser.operations)
+				"lambda": lambda helper: helper.printOperations(ArgsParser.registry)
 			},
 			"@list-simple": {
 				"args": [],
-				"lambda": lambda helper: helper.printOperationsSimple(ArgsParser.operations)
+				"lambda": lambda helper: helper.printOperationsSimple(ArgsParser.registry)
 			}
 		}
 
-
-
+ArgsParser.registry = registry.Registry(ArgsParser.operations)
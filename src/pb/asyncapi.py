@@ -0,0 +1,636 @@
+import ssl
+import time
+import errno
+import random
+import select
+import socket
+import base64
+import urlparse
+import threading
+import collections
+import suds
+import suds.client
+from suds.transport import TransportError
+from cStringIO import StringIO
+import api
+import retry
+import httppool
+
+# Result of an operation that hasn't finished yet; callbacks run on the event loop once it has
+class Future:
+
+	def __init__(self):
+		self._done = False
+		self._result = None
+		self._exception = None
+		self._callbacks = []
+
+	def done(self):
+		return self._done
+
+	def result(self):
+		if not self._done:
+			raise RuntimeError("result is not ready yet")
+		if self._exception is not None:
+			raise self._exception
+		return self._result
+
+	def exception(self):
+		return self._exception
+
+	def setResult(self, result):
+		self._finish(result, None)
+
+	def setException(self, exception):
+		self._finish(None, exception)
+
+	def _finish(self, result, exception):
+		if self._done:
+			return
+		self._done, self._result, self._exception = True, result, exception
+		for callback in self._callbacks:
+			callback(self)
+		self._callbacks = []
+
+	def addCallback(self, callback):
+		if self._done:
+			callback(self)
+		else:
+			self._callbacks.append(callback)
+
+	# Returns a new future with fn(result of this one)
+	def then(self, fn):
+		future = Future()
+		def chain(done):
+			if done.exception() is not None:
+				future.setException(done.exception())
+				return
+			try:
+				future.setResult(fn(done.result()))
+			except Exception as (err):
+				future.setException(err)
+		self.addCallback(chain)
+		return future
+
+# Returns a future with the list of results of all the given futures (in the same order); fails with the first error
+def gather(futures):
+	futures = list(futures)
+	result = Future()
+	pending = [len(futures)]
+	if not futures:
+		result.setResult([])
+	def collect(done):
+		if done.exception() is not None:
+			result.setException(done.exception())
+			return
+		pending[0] -= 1
+		if pending[0] == 0 and not result.done():
+			result.setResult([f.result() for f in futures])
+	for future in futures:
+		future.addCallback(collect)
+	return result
+
+# Turns a generator function into a coroutine: every "yield future" (or "yield [futures]") suspends it until the
+# result is there, which is then sent back into the generator; calling the coroutine returns a Future of its return
+# value, given with "raise Return(value)" (Python 2 generators can't return values)
+class Return(Exception):
+
+	def __init__(self, value = None):
+		Exception.__init__(self)
+		self.value = value
+
+def coroutine(fn):
+	def start(*args, **kwargs):
+		future = Future()
+		generator = fn(*args, **kwargs)
+		def step(value, exception):
+			try:
+				if exception is not None:
+					yielded = generator.throw(exception)
+				else:
+					yielded = generator.send(value)
+			except StopIteration:
+				future.setResult(None)
+				return
+			except Return as (ret):
+				future.setResult(ret.value)
+				return
+			except Exception as (err):
+				future.setException(err)
+				return
+			if isinstance(yielded, (list, tuple)):
+				yielded = gather(yielded)
+			yielded.addCallback(lambda done: step(done._result, done._exception))
+		step(None, None)
+		return future
+	return start
+
+# One non-blocking HTTP/1.1 connection driven by the event loop, to the first of addresses (see EventLoop.resolve);
+# if that one can't be connected to, the request goes on to a connection to the next one
+class Connection:
+
+	def __init__(self, loop, key, addresses):
+		self.loop = loop
+		self.key = key
+		self.addresses = addresses
+		self.state = "connecting"
+		self.lastUsed = time.time()
+		family, address = addresses[0]
+		self.sock = socket.socket(family, socket.SOCK_STREAM)
+		self.sock.setblocking(0)
+		err = self.sock.connect_ex(address)
+		if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+			raise socket.error(err, errno.errorcode.get(err, "connect failed"))
+		self.wants = "w"
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def start(self, request, future, deadline, reused):
+		self.request, self.future, self.deadline, self.reused = request, future, deadline, reused
+		self.outgoing = request
+		self.incoming = StringIO()
+		self.received = 0
+		self.tail = ""
+		self.head = None # (status, headers, body offset) once the response headers are in
+		if self.state == "idle":
+			self.state, self.wants = "sending", "w"
+
+	def ready(self):
+		try:
+			if self.state == "connecting":
+				err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if err != 0:
+					raise socket.error(err, errno.errorcode.get(err, "connect failed"))
+				if self.key[0] == "https":
+					self.sock = self.loop.sslContext.wrap_socket(self.sock, server_hostname = self.key[1], do_handshake_on_connect = False)
+					self.state = "handshaking"
+				else:
+					self.state = "sending"
+			if self.state == "handshaking":
+				self.sock.do_handshake()
+				self.state, self.wants = "sending", "w"
+			if self.state == "sending":
+				sent = self.sock.send(self.outgoing)
+				self.outgoing = self.outgoing[sent:]
+				if not self.outgoing:
+					self.state, self.wants = "receiving", "r"
+				return
+			if self.state == "receiving":
+				while True:
+					data = self.sock.recv(65536)
+					if not data:
+						self._complete(closed = True)
+						return
+					self._append(data)
+					if not (hasattr(self.sock, "pending") and self.sock.pending()):
+						break
+				if self._mayBeComplete():
+					self._complete(closed = False)
+			elif self.state == "idle":
+				# the server closed an idle connection
+				self.close()
+		except ssl.SSLWantReadError:
+			self.wants = "r"
+		except ssl.SSLWantWriteError:
+			self.wants = "w"
+		except (socket.error, ssl.SSLError) as (err):
+			if getattr(err, "errno", None) in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return
+			self.fail(TransportError(str(err), None))
+
+	def _append(self, data):
+		self.incoming.write(data)
+		self.received += len(data)
+		self.tail = (self.tail + data)[-5:]
+		if self.head is None:
+			value = self.incoming.getvalue()
+			end = value.find("\r\n\r\n")
+			if end >= 0:
+				status, reason, headers = parseHead(value[:end])
+				self.head = (status, headers, end + 4)
+
+	# Cheap check telling whether it's worth decoding the response, so big responses aren't re-parsed on every read
+	def _mayBeComplete(self):
+		if self.head is None:
+			return False
+		status, headers, bodyStart = self.head
+		if headers.get("transfer-encoding", "").lower() == "chunked":
+			return self.tail == "0\r\n\r\n"
+		if "content-length" in headers:
+			return self.received - bodyStart >= int(headers["content-length"])
+		return status in (204, 304) or 100 <= status < 200
+
+	# Finishes the current request if the whole response has been received
+	def _complete(self, closed):
+		response = parseResponse(self.incoming.getvalue(), closed)
+		if response is None:
+			if closed:
+				self.fail(TransportError("Connection closed by server", None))
+			return
+		status, reason, headers, body = response
+		keepAlive = not closed and headers.get("connection", "").lower() != "close"
+		future = self.future
+		self.future = None
+		self.loop.release(self, keepAlive)
+		future.setResult((status, reason, body))
+
+	def fail(self, exception):
+		future = self.future
+		connecting = self.state == "connecting"
+		self.future = None
+		self.close()
+		if future is None:
+			return
+		if connecting and len(self.addresses) > 1:
+			# the next address of the host (eg its IPv4 one, when the IPv6 one can't be reached)
+			self.loop.connect(self.key, self.addresses[1:], self.request, future, self.deadline)
+		elif self.reused and self.received == 0:
+			# the server may have dropped the idle connection; try again once on a fresh one
+			self.loop.dispatch(self.key, self.request, future, self.deadline, reuse = False)
+		else:
+			future.setException(exception)
+
+	def close(self):
+		self.state = "closed"
+		self.loop.forget(self)
+		try:
+			self.sock.close()
+		except socket.error:
+			pass
+
+# Returns (status, reason, headers) of an HTTP response head; header names are lower-cased
+def parseHead(head):
+	lines = head.split("\r\n")
+	parts = lines[0].split(" ", 2)
+	headers = {}
+	for line in lines[1:]:
+		name, _, value = line.partition(":")
+		headers[name.strip().lower()] = value.strip()
+	return int(parts[1]), (parts[2] if len(parts) > 2 else ""), headers
+
+# Returns (status, reason, headers, body) if data holds a whole HTTP response, else None
+def parseResponse(data, closed):
+	end = data.find("\r\n\r\n")
+	if end < 0:
+		return None
+	status, reason, headers = parseHead(data[:end])
+	rest = data[end + 4:]
+	if headers.get("transfer-encoding", "").lower() == "chunked":
+		body = StringIO()
+		position = 0
+		while True:
+			lineEnd = rest.find("\r\n", position)
+			if lineEnd < 0:
+				return None
+			size = int(rest[position:lineEnd].split(";")[0], 16)
+			if size == 0:
+				return (status, reason, headers, body.getvalue()) if rest.find("\r\n", lineEnd + 2) >= 0 else None
+			if len(rest) < lineEnd + 2 + size + 2:
+				return None
+			body.write(rest[lineEnd + 2:lineEnd + 2 + size])
+			position = lineEnd + 2 + size + 2
+	if "content-length" in headers:
+		length = int(headers["content-length"])
+		return (status, reason, headers, rest[:length]) if len(rest) >= length else None
+	if status in (204, 304) or 100 <= status < 200:
+		return (status, reason, headers, "")
+	return (status, reason, headers, rest) if closed else None
+
+# select()-based event loop running the HTTP requests of one or more AsyncAPI objects; single threaded
+class EventLoop:
+
+	poolSize = 16 # idle connections kept per host; as many as AsyncAPI.maxConcurrent, so a busy API never reconnects
+	resolvePoll = 0.01 # seconds the loop waits at most while a name is being resolved, to pick its result up
+
+	def __init__(self):
+		self.connections = set()
+		self.idle = {} # (scheme, host, port) => [connection, ...]
+		self.addresses = {} # (host, port) => [(address family, socket address), ...]
+		self.resolving = {} # (host, port) => future of its addresses, while a thread looks them up
+		self.ready = collections.deque()
+		self.timers = []
+		self.sslContext = ssl.create_default_context()
+		self.stats = {"requests": 0, "connections": 0, "reused": 0}
+
+	# Returns a future of the addresses of host (IPv6 and IPv4 ones, in the order getaddrinfo gives them). getaddrinfo
+	# blocks, so it runs on a thread of its own, once per host and port; the loop picks its result up
+	def resolve(self, host, port):
+		key = (host, port)
+		if key in self.addresses:
+			future = Future()
+			future.setResult(self.addresses[key])
+			return future
+		if key not in self.resolving:
+			self.resolving[key] = Future()
+			def lookup():
+				try:
+					addresses = []
+					for family, socktype, proto, name, address in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+						if (family, address) not in addresses:
+							addresses.append((family, address))
+					self.ready.append((self._resolved, (key, addresses, None)))
+				except Exception as (err):
+					self.ready.append((self._resolved, (key, None, err)))
+			thread = threading.Thread(target = lookup)
+			thread.daemon = True
+			thread.start()
+		return self.resolving[key]
+
+	def _resolved(self, key, addresses, error):
+		future = self.resolving.pop(key)
+		if error is not None:
+			future.setException(error)
+		else:
+			self.addresses[key] = addresses
+			future.setResult(addresses)
+
+	def callSoon(self, fn, *args):
+		self.ready.append((fn, args))
+
+	def callLater(self, delay, fn, *args):
+		self.timers.append((time.time() + delay, fn, args))
+
+	# Returns a future that is done after the given number of seconds
+	def sleep(self, seconds):
+		future = Future()
+		self.callLater(seconds, future.setResult, None)
+		return future
+
+	# Sends an HTTP POST; returns a future with (status, reason, body)
+	def post(self, url, body, headers, timeout):
+		parts = urlparse.urlsplit(url)
+		key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+		path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+		head = ["POST %s HTTP/1.1" % path, "Host: %s" % parts.netloc, "Content-Length: %d" % len(body), "Connection: keep-alive"]
+		head += ["%s: %s" % (name, value) for name, value in headers.items()]
+		future = Future()
+		self.stats["requests"] += 1
+		self.dispatch(key, "\r\n".join(head) + "\r\n\r\n" + body, future, time.time() + timeout)
+		return future
+
+	# Starts sending request on an idle connection to key (if reuse is allowed and there is one) or on a new one, once
+	# the host is resolved
+	def dispatch(self, key, request, future, deadline, reuse = True):
+		idle = self.idle.get(key, [])
+		if reuse and idle:
+			connection = idle.pop()
+			self.stats["reused"] += 1
+			connection.start(request, future, deadline, True)
+			return
+		scheme, host, port = key
+		resolved = self.resolve(host, port)
+		if not resolved.done():
+			self.callLater(max(0, deadline - time.time()), lambda: future.setException(TransportError("timed out", None)))
+		resolved.addCallback(lambda done: self.connect(key, done.result(), request, future, deadline) if done.exception() is None else future.setException(TransportError(str(done.exception()), None)))
+
+	# Starts sending request on a new connection to the first of addresses that can be connected to
+	def connect(self, key, addresses, request, future, deadline):
+		if future.done():
+			return # timed out while the host was resolved
+		if time.time() > deadline:
+			future.setException(TransportError("timed out", None))
+			return
+		while True:
+			try:
+				connection = Connection(self, key, addresses)
+				break
+			except socket.error as (err):
+				addresses = addresses[1:]
+				if not addresses:
+					future.setException(TransportError(str(err), None))
+					return
+		self.stats["connections"] += 1
+		self.connections.add(connection)
+		connection.start(request, future, deadline, False)
+
+	def release(self, connection, keepAlive):
+		idle = self.idle.setdefault(connection.key, [])
+		if keepAlive and len(idle) < self.poolSize:
+			connection.state, connection.wants, connection.lastUsed = "idle", "r", time.time()
+			idle.append(connection)
+		else:
+			connection.close()
+
+	def forget(self, connection):
+		self.connections.discard(connection)
+		idle = self.idle.get(connection.key, [])
+		if connection in idle:
+			idle.remove(connection)
+
+	# Runs the loop until the future is done and returns its result
+	def run(self, future):
+		while not future.done():
+			self.step()
+		return future.result()
+
+	def step(self, maxWait = 1.0):
+		while self.ready:
+			fn, args = self.ready.popleft()
+			fn(*args)
+		now = time.time()
+		due = [timer for timer in self.timers if timer[0] <= now]
+		if due:
+			self.timers = [timer for timer in self.timers if timer[0] > now]
+			for when, fn, args in sorted(due):
+				fn(*args)
+			return
+		wait = maxWait
+		if self.timers:
+			wait = max(0, min(wait, min(timer[0] for timer in self.timers) - now))
+		if self.resolving:
+			wait = min(wait, self.resolvePoll)
+		active = list(self.connections)
+		readers = [c for c in active if c.wants == "r"]
+		writers = [c for c in active if c.wants == "w"]
+		if not readers and not writers:
+			time.sleep(wait)
+			return
+		readable, writable, failed = select.select(readers, writers, [], wait)
+		for connection in set(readable + writable):
+			connection.ready()
+		now = time.time()
+		for connection in list(self.connections):
+			if connection.state == "idle":
+				if now - connection.lastUsed > httppool.PooledTransport.idleTimeout:
+					connection.close()
+			elif connection.future is not None and now > connection.deadline:
+				connection.fail(TransportError("timed out", None))
+
+# The error of AsyncAPI.waitUntilAvailable when data centers are still provisioning at its timeout: states is what
+# it would have returned
+class WaitTimeout(Exception):
+
+	def __init__(self, states, pending):
+		Exception.__init__(self, "Timed out waiting for %s" % ", ".join("%s (%s)" % (dcid, states[dcid]) for dcid in sorted(pending)))
+		self.states = states
+
+# Non-blocking counterpart of pb.api.API: the same operations (getDataCenter, createServer, addFirewallRuleToNic, ...),
+# with the same argument translation, but each returns a Future instead of blocking. At most maxConcurrent calls
+# are on the wire at once, the others wait their turn; a read (API.coalesced) identical to one on the wire gets the
+# future of that one. Errors don't exit; the future fails with the
+# suds.WebFault or suds.transport.TransportError instead. suds is only used to build and decode the SOAP envelopes.
+# Calls go through the rate limiter and the circuit breaker of the endpoint like those of API, but failed calls are
+# not made again (retryPolicy), replies are not cached (cache) and the cassette is neither recorded nor replayed.
+# waitUntilAvailable, the one helper of API that chains calls, is a coroutine here and fails with WaitTimeout.
+# Only the calls are non-blocking: creating an AsyncAPI blocks like creating an API, while the WSDL is read (or loaded
+# from the cache) and parsed.
+#
+#	loop = pb.asyncapi.EventLoop()
+#	pbApi = pb.asyncapi.AsyncAPI(username, password, loop = loop)
+#	@pb.asyncapi.coroutine
+#	def states(dcids):
+#		states = yield [pbApi.getDataCenterState(dcid) for dcid in dcids]
+#		raise pb.asyncapi.Return(dict(zip(dcids, states)))
+#	print loop.run(states(["dc1", "dc2"]))
+class AsyncAPI(api.API):
+
+	maxConcurrent = 16
+
+	def __init__(self, username, password, debug = False, wsdl = None, loop = None, maxConcurrent = None, url = None):
+		api.API.__init__(self, username, password, debug = debug, wsdl = wsdl, url = url)
+		self.loop = loop or EventLoop()
+		if maxConcurrent is not None:
+			self.maxConcurrent = maxConcurrent
+		self.inFlight = 0
+		self.waiting = collections.deque()
+		self.sharedFutures = {} # (func, args) of the coalesced reads on the wire => their future
+
+	def call(self, func, args):
+		if func in self.coalesced:
+			key = (func, repr(args), self.sharedCalls.writes) # see api.SharedCalls
+			if key in self.sharedFutures:
+				self.sharedCalls.stats["shared"] += 1
+				return self.sharedFutures[key]
+			self.sharedCalls.stats["calls"] += 1
+			future = self.sharedFutures[key] = self._call(func, args)
+			future.addCallback(lambda done: self.sharedFutures.pop(key, None))
+			return future
+		future = self._call(func, args)
+		if func not in self.reads:
+			future.addCallback(lambda done: self.sharedCalls.wrote())
+		return future
+
+	def _call(self, func, args):
+		if self.debug:
+			print "# Calling %s %s" % (func, args)
+		future = Future()
+		if self.inFlight < self.maxConcurrent:
+			self._send(func, args, future)
+		else:
+			self.waiting.append((func, args, future))
+		return future
+
+	def _send(self, func, args, future):
+		self.inFlight += 1
+		try:
+			if self.breaker is not None:
+				self.breaker.allow()
+		except retry.CircuitOpen as (err):
+			self._finished(future, None, err, allowed = False)
+			return
+		delay = self.rateLimiter.reserve(func in self.reads) if self.rateLimiter is not None else 0
+		if delay > 0:
+			self.loop.callLater(delay, self._post, func, args, future)
+		else:
+			self._post(func, args, future)
+
+	def _post(self, func, args, future):
+		started = time.time()
+		try:
+			method = getattr(self.client.service, func).method
+			soapClient = suds.client.SoapClient(self.client, method)
+			envelope = method.binding.input.get_message(method, args, {}).plain().encode("utf-8")
+			headers = soapClient.headers()
+			credentials = self.transport.credentials()
+			if not (None in credentials):
+				headers["Authorization"] = "Basic " + base64.b64encode(":".join(credentials))
+			reply = self.loop.post(soapClient.location(), envelope, headers, self.transport.options.timeout)
+		except Exception as (err):
+			self._measure(func, started, True, 0, 0)
+			self._finished(future, None, err)
+			return
+		reply.addCallback(lambda done: self._received(func, method, soapClient, done, future, started, len(envelope)))
+
+	def _received(self, func, method, soapClient, done, future, started, sent):
+		if done.exception() is not None:
+			self._measure(func, started, True, sent, 0)
+			self._finished(future, None, done.exception())
+			return
+		status, reason, body = done.result()
+		try:
+			if status in (202, 204):
+				result = None
+			elif status == 200 and func in self.fastDecode:
+				result = self.fastDecoder().decode(body)
+			elif status == 200:
+				result = soapClient.succeeded(method.binding.output, body)
+			elif status == 500 and body:
+				try:
+					method.binding.output.get_fault(body) # raises suds.WebFault
+				except suds.WebFault:
+					raise
+				except Exception:
+					pass # not a SOAP fault (eg an HTML error page)
+				raise TransportError(reason, status, StringIO(body))
+			else:
+				raise TransportError(reason, status, StringIO(body))
+		except Exception as (err):
+			self._measure(func, started, True, sent, len(body or ""))
+			self._finished(future, None, err)
+			return
+		self._measure(func, started, False, sent, len(body or ""))
+		if self.requestId is None:
+			self.requestId = result["requestId"] if result is not None and "requestId" in result else "(no info)"
+		self._finished(future, result, None)
+
+	def _measure(self, func, started, failed, sent, received):
+		if self.metrics is not None:
+			self.metrics.record(func, time.time() - started, failed, sent, received)
+
+	# allowed: the breaker let the call through, so its outcome counts (see retry.CircuitBreaker.record)
+	def _finished(self, future, result, exception, allowed = True):
+		self.inFlight -= 1
+		if allowed and self.breaker is not None:
+			self.breaker.record(exception)
+		if self.waiting:
+			self.loop.callSoon(self._send, *self.waiting.popleft())
+		if exception is not None:
+			if isinstance(exception, TransportError):
+				self.broken = True
+			future.setException(exception)
+		else:
+			future.setResult(result)
+
+	# Like API.waitUntilAvailable, but the data centers due are polled together and the future of the states fails
+	# with WaitTimeout instead of exiting
+	@coroutine
+	def waitUntilAvailable(self, dcids, timeout = 600, progress = None):
+		deadline = time.time() + timeout
+		states = dict((dcid, None) for dcid in dcids)
+		interval = dict((dcid, self.pollMin) for dcid in dcids)
+		nextPoll = dict((dcid, 0) for dcid in dcids)
+		pending = set(dcids)
+		while pending:
+			now = time.time()
+			due = [dcid for dcid in pending if nextPoll[dcid] <= now]
+			polled = yield [self.getDataCenterState(dcid) for dcid in due]
+			for dcid, state in zip(due, polled):
+				states[dcid] = str(state) if state is not None else None
+				if states[dcid] in (None, "AVAILABLE", "DELETED"):
+					pending.discard(dcid)
+				else:
+					nextPoll[dcid] = now + interval[dcid] * random.uniform(1 - self.pollJitter, 1 + self.pollJitter)
+					interval[dcid] = min(interval[dcid] * self.pollBackoff, self.pollMax)
+			if progress is not None:
+				progress(states)
+			if not pending or now >= deadline:
+				break
+			yield self.loop.sleep(max(0, min(min(nextPoll[dcid] for dcid in pending), deadline) - time.time()))
+		if pending:
+			raise WaitTimeout(states, pending)
+		raise Return(states)
+
+	# createLoadBalancer is the only operation that post-processes its result
+	def createLoadBalancer(self, userArgs):
+		return self.call("createLoadBalancer", [self._parseLoadBalancerArgs(userArgs)]).then(lambda result: result.loadBalancerId)
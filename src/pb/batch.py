@@ -0,0 +1,176 @@
+import sys
+import shlex
+import Queue
+import threading
+import traceback
+from cStringIO import StringIO
+import errorhandler
+import argsparser
+import formatter
+import helper
+import api
+import metrics
+
+# sys.stdout replacement that sends what a thread prints to that thread's buffer (if it has one), so the
+# formatter, the API error messages and errorhandler can keep using print while operations run in parallel
+class ThreadOutput(object):
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.local = threading.local()
+
+	def target(self):
+		return getattr(self.local, "buffer", None) or self.stream
+
+	def write(self, data):
+		self.target().write(data)
+
+	def flush(self):
+		self.target().flush()
+
+	# print keeps its "need a space" flag on the file object, which must not leak between threads
+	softspace = property(lambda self: getattr(self.target(), "softspace", 0), lambda self, value: setattr(self.target(), "softspace", value))
+
+# Returns sys.stdout as a ThreadOutput, making it one first if needed, for code that runs operations on threads of its
+# own and sets their buffers. A ThreadOutput already in place is used as it is (each thread has its own buffer in
+# it): concurrent users (eg, the batches of several daemon requests) must not put back a sys.stdout another still uses
+def threadOutput():
+	if not isinstance(sys.stdout, ThreadOutput):
+		sys.stdout = ThreadOutput(sys.stdout)
+	return sys.stdout
+
+# Runs many operations, one per input line, with the same syntax as the pbapi.py command line (eg "get-server -srvid 123").
+# Lines may carry their own base arguments (-u -p -auth -s ...), the rest are taken from the batch command itself.
+# Operations run on a bounded pool of threads; each thread uses its own clone of the API clients (sharing the parsed
+# WSDL and the connection pool), and the output of each operation is printed in input order as soon as it is ready.
+class Batch:
+
+	parallel = 4
+
+	def __init__(self, baseApi, short = False, parallel = None, output = None):
+		self.baseApi = baseApi
+		options = baseApi.transport.options
+		self.baseArgs = {"u": options.username, "p": options.password, "debug": baseApi.debug, "wsdl": baseApi.wsdl, "url": baseApi.url, "s": short, "o": output}
+		if parallel is not None:
+			self.parallel = max(1, int(parallel))
+		self.apiPool = api.APIPool()
+		self.local = threading.local()
+
+	# Runs all the operations in lines (an iterable of strings) and returns the highest exit code
+	def run(self, lines, out = None):
+		out = out or sys.stdout
+		jobs = [(i + 1, line.strip()) for i, line in enumerate(lines) if line.strip() != "" and not line.strip().startswith("#")]
+		results = {}
+		done = threading.Condition()
+		queue = Queue.Queue()
+		for job in jobs:
+			queue.put(job)
+
+		def worker():
+			while True:
+				try:
+					number, line = queue.get_nowait()
+				except Queue.Empty:
+					return
+				result = self.runLine(line)
+				with done:
+					results[number] = result
+					done.notify()
+
+		savedStdout, savedShouldExit = sys.stdout, errorhandler.should_exit_python
+		self.output = threadOutput()
+		errorhandler.should_exit_python = True # errors must end the operation (SystemExit is caught per line), not the batch
+		try:
+			threads = [threading.Thread(target = worker) for i in range(min(self.parallel, len(jobs)))]
+			for thread in threads:
+				thread.daemon = True
+				thread.start()
+			exitCode = 0
+			for number, line in jobs:
+				with done:
+					while number not in results:
+						done.wait(1)
+					code, output = results.pop(number)
+				out.write("[%d] %s%s\n" % (number, line, "" if code == 0 else " (error %d)" % code))
+				out.write(output)
+				out.flush()
+				exitCode = max(exitCode, code)
+		finally:
+			sys.stdout = savedStdout
+			errorhandler.should_exit_python = savedShouldExit
+		return exitCode
+
+	# Runs one operation line and returns (exit code, output)
+	def runLine(self, line):
+		buffer = StringIO()
+		self.output.local.buffer = buffer
+		code = 0
+		try:
+			self.runOperation(shlex.split(line))
+		except SystemExit as (err):
+			code = err.code if isinstance(err.code, int) else 1
+		except Exception as (err):
+			print "Error: %s" % str(err)
+			if self.baseArgs["debug"]:
+				traceback.print_exc(file = buffer)
+			code = 3
+		finally:
+			self.output.local.buffer = None
+		return code, buffer.getvalue()
+
+	def runOperation(self, args):
+		argsParser = argsparser.ArgsParser()
+		argsParser.baseArgs.update(self.baseArgs)
+		argsParser.readUserArgs(["batch"] + args)
+		requestedOp = argsParser.getRequestedOperation()
+		if requestedOp is None:
+			print "Error: Unknown operation:", argsParser.baseArgs["op"]
+			errorhandler.exit(2)
+		if requestedOp == "batch":
+			errorhandler.ArgsError("batches cannot be nested")
+		if requestedOp[0] == "@":
+			argsparser.ArgsParser.operations[requestedOp]["lambda"](helper.Helper())
+			return
+		if not argsParser.isAuthenticated():
+			errorhandler.ArgsError("Missing authentication")
+		lineFormatter = formatter.forArgs(argsParser.baseArgs)
+		lineApi = self.threadApi(argsParser.baseArgs)
+		if lineApi.metrics is not None:
+			lineFormatter = metrics.TimedFormatter(lineFormatter, lineApi.metrics)
+		argsparser.ArgsParser.operations[requestedOp]["lambda"](lineFormatter, lineApi, argsParser.opArgs)
+		lineFormatter.end()
+		if not argsParser.baseArgs["s"] and argsParser.baseArgs["o"] is None:
+			print "Request ID:", str(lineApi.requestId) if lineApi.requestId is not None else "(none)"
+
+	# Returns this thread's clone of the API client for the given credentials
+	def threadApi(self, baseArgs):
+		key = (baseArgs["u"], baseArgs["p"], baseArgs["debug"], baseArgs["wsdl"], baseArgs["url"])
+		clients = self.local.__dict__.setdefault("clients", {})
+		if key not in clients or clients[key].broken:
+			if key == (self.baseArgs["u"], self.baseArgs["p"], self.baseArgs["debug"], self.baseArgs["wsdl"], self.baseArgs["url"]):
+				shared = self.baseApi
+			else:
+				shared = self.apiPool.get(*key)
+			if shared.broken:
+				errorhandler.exit(3)
+			clients[key] = shared.clone()
+		clients[key].requestId = None
+		return clients[key]
+
+# Entry point of the "batch" operation: reads the operations from -file (default: stdin) and runs them -parallel at a time
+def runBatch(batchFormatter, batchApi, opArgs):
+	try:
+		parallel = int(opArgs["parallel"]) if opArgs.get("parallel") else None
+	except ValueError:
+		errorhandler.ArgsError("-parallel must be a number")
+		return
+	fileName = opArgs.get("file", "-")
+	try:
+		lines = sys.stdin.readlines() if fileName in ("", "-") else open(fileName, "r").readlines()
+	except IOError as (err):
+		print "Error: Cannot read %s: %s" % (fileName, err.strerror)
+		errorhandler.exit(1)
+		return
+	exitCode = Batch(batchApi, batchFormatter.short, parallel, getattr(batchFormatter, "mode", None)).run(lines)
+	if exitCode != 0:
+		errorhandler.exit(exitCode)
@@ -0,0 +1,12 @@
+import os
+import sys
+
+# Returns the per-user cache directory (~/.cache/pbapi on Unix, %LOCALAPPDATA%\pbapi on Windows); PB_CACHE_DIR overrides it.
+# Kept apart from wsdlcache, which loads suds: the daemon client must find its socket without it.
+def userCacheDir():
+	if "PB_CACHE_DIR" in os.environ:
+		return os.environ["PB_CACHE_DIR"]
+	if sys.platform.startswith("win") and "LOCALAPPDATA" in os.environ:
+		return os.path.join(os.environ["LOCALAPPDATA"], "pbapi")
+	base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(base, "pbapi")
@@ -0,0 +1,166 @@
+import time
+import json
+import hashlib
+import threading
+import collections
+from cStringIO import StringIO
+import xml.etree.cElementTree as etree
+from suds.transport import Reply, TransportError
+import httppool
+
+# Raised in replay when the cassette has no reply for a request; never retried, the cassette won't change
+class Miss(TransportError):
+
+	def __init__(self, operation, fileName):
+		TransportError.__init__(self, "no recorded reply for this %s call in %s" % (operation, fileName), None)
+
+# Returns (operation, key) of a SOAP request: the name of the element in its Body, and the element itself as text,
+# which holds the arguments (suds writes the same envelope for the same operation and arguments)
+def requestKey(message):
+	for event, element in etree.iterparse(StringIO(message), ("start",)):
+		if element.tag.endswith("}Body"):
+			break
+	else:
+		return None, message
+	for child in element:
+		return child.tag.rpartition("}")[2], etree.tostring(child)
+	return None, message
+
+# File of the SOAP exchanges of a run, one JSON object per line: the documents the WSDL was read from
+# ({"open": url, "body"}) and every call ({"operation", "request", "status", "reason", "body", "seconds"}).
+# Requests are recorded without their headers, credentials are never written. A cassette is recorded by a
+# RecordingTransport (mode "record": the file is overwritten) and played back by a ReplayTransport (mode "replay"),
+# which answers each request with the replies recorded for the same operation and arguments, in the order they
+# were recorded (the last one again once they are used up, eg for a data center state polled more often than
+# when the cassette was recorded). With latency, a replayed reply takes as long as it took when recorded.
+#
+#	pb.api.API.cassette = pb.cassette.Cassette("incident.cassette", "replay")
+#	api = pb.api.API(username, password)
+#
+# pb.asyncapi.AsyncAPI sends without the transport and is neither recorded nor replayed.
+class Cassette:
+
+	def __init__(self, fileName, mode = "replay", latency = False):
+		if mode not in ("record", "replay"):
+			raise ValueError(mode)
+		self.fileName = fileName
+		self.mode = mode
+		self.recording = mode == "record"
+		self.latency = latency
+		self.lock = threading.Lock()
+		self.stats = {"recorded": 0, "replayed": 0, "missed": 0}
+		if self.recording:
+			self.out = open(fileName, "w")
+			return
+		self.documents = {} # url => body
+		self.replies = {} # requestKey() => deque of the recorded calls not replayed yet
+		self.last = {} # requestKey() => the last recorded call
+		for line in open(fileName, "r"):
+			if not line.strip():
+				continue
+			entry = json.loads(line)
+			if "open" in entry:
+				self.documents[entry["open"]] = entry["body"].encode("utf-8")
+			else:
+				key = requestKey(entry["request"].encode("utf-8"))
+				self.replies.setdefault(key, collections.deque()).append(entry)
+				self.last[key] = entry
+
+	# The suds transport that records to this cassette or replays from it
+	def transport(self, **kwargs):
+		if self.recording:
+			return RecordingTransport(self, **kwargs)
+		return ReplayTransport(self, **kwargs)
+
+	# Content hash of the WSDL recorded for url, for wsdlcache.WsdlCache (None if the cassette has none)
+	def digest(self, url):
+		body = self.documents.get(url)
+		return hashlib.sha1(body).hexdigest() if body is not None else None
+
+	def write(self, entry):
+		line = json.dumps(entry)
+		with self.lock:
+			self.out.write(line + "\n")
+			self.out.flush() # a run that dies half way still leaves what it did
+			if "open" not in entry:
+				self.stats["recorded"] += 1
+
+	def open(self, url):
+		body = self.documents.get(url)
+		if body is None:
+			raise TransportError("%s was not recorded in %s" % (url, self.fileName), None)
+		return StringIO(body)
+
+	# Returns the recorded call answering request message, and counts it
+	def play(self, message):
+		key = requestKey(message)
+		with self.lock:
+			replies = self.replies.get(key)
+			entry = replies.popleft() if replies else self.last.get(key)
+			self.stats["replayed" if entry is not None else "missed"] += 1
+		if entry is None:
+			raise Miss(key[0] or "unknown", self.fileName)
+		return entry
+
+	def close(self):
+		if self.recording:
+			self.out.close()
+
+# Pooled transport writing every document it reads and every call it sends to a cassette
+class RecordingTransport(httppool.PooledTransport):
+
+	def __init__(self, cassette = None, **kwargs):
+		httppool.PooledTransport.__init__(self, **kwargs)
+		self.cassette = cassette
+
+	def open(self, request):
+		body = httppool.PooledTransport.open(self, request).read()
+		self.cassette.write({"open": request.url, "body": body.decode("utf-8")})
+		return StringIO(body)
+
+	def send(self, request):
+		started = time.time()
+		entry = {"operation": requestKey(request.message)[0], "request": request.message.decode("utf-8")}
+		try:
+			reply = httppool.PooledTransport.send(self, request)
+		except TransportError as (err):
+			body = err.fp.read() if err.fp is not None else ""
+			err.fp = StringIO(body) # suds reads the fault from it
+			entry.update({"status": err.httpcode, "reason": str(err), "body": body.decode("utf-8"), "seconds": time.time() - started})
+			self.cassette.write(entry)
+			raise
+		entry.update({"status": 200 if reply is not None else 204, "reason": "OK", "body": reply.message.decode("utf-8") if reply is not None else "", "seconds": time.time() - started})
+		self.cassette.write(entry)
+		return reply
+
+	def __deepcopy__(self, memo = {}):
+		clone = httppool.PooledTransport.__deepcopy__(self, memo)
+		clone.cassette = self.cassette
+		return clone
+
+# Transport answering from a cassette, without any network access
+class ReplayTransport(httppool.PooledTransport):
+
+	def __init__(self, cassette = None, **kwargs):
+		httppool.PooledTransport.__init__(self, **kwargs)
+		self.cassette = cassette
+
+	def open(self, request):
+		return self.cassette.open(request.url)
+
+	def send(self, request):
+		entry = self.cassette.play(request.message)
+		body = entry["body"].encode("utf-8")
+		self._countBytes(len(request.message), len(body))
+		if self.cassette.latency:
+			time.sleep(entry["seconds"])
+		if entry["status"] == 204:
+			return None
+		if entry["status"] is None or entry["status"] >= 300:
+			raise TransportError(entry["reason"], entry["status"], StringIO(body) if entry["status"] is not None else None)
+		return Reply(200, {}, body)
+
+	def __deepcopy__(self, memo = {}):
+		clone = httppool.PooledTransport.__deepcopy__(self, memo)
+		clone.cassette = self.cassette
+		return clone
@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import errno
+import socket
+import signal
+import threading
+import traceback
+import cachedir
+import errorhandler
+
+# Version of the requests the client sends; a daemon of another version refuses them and the client runs the
+# operation itself
+protocol = 1
+
+# Operations reading their -file from stdin when it is missing or "-"; the daemon has no access to the client's stdin
+stdinOperations = ["batch", "planTopology", "applyTopology"]
+
+# Operations running until they are interrupted; the daemon would not see the client go away
+endlessOperations = ["watchDataCenter"]
+
+# Returns the path of the daemon's Unix socket: PB_DAEMON_SOCKET, or daemon.sock in the user's cache directory
+def socketPath():
+	return os.environ.get("PB_DAEMON_SOCKET") or os.path.join(cachedir.userCacheDir(), "daemon.sock")
+
+# Whether a pbapi.py invocation may run in the daemon: not when it asks for its debugging output, uses a cassette
+# (which the daemon's clients can't change to), reads stdin or runs until interrupted, nor when PB_NO_DAEMON is set
+def mayForward(requestedOp, argsParser):
+	baseArgs = argsParser.baseArgs
+	if os.environ.get("PB_NO_DAEMON") or baseArgs["debug"] or baseArgs["record"] or baseArgs["replay"] or requestedOp in endlessOperations:
+		return False
+	return not (requestedOp in stdinOperations and argsParser.opArgs.get("file", "-") in ("", "-"))
+
+# Runs an operation in the daemon if one is running: sends it the parsed arguments (the password was asked and the
+# auth file read here already; the file names are made absolute), prints what it writes and returns its exit code.
+# Returns None, without any output, if there is no daemon (or one of another version) to run it.
+def forward(requestedOp, argsParser):
+	baseArgs = dict(argsParser.baseArgs)
+	opArgs = dict(argsParser.opArgs)
+	for args, name in ((baseArgs, "wsdl"), (baseArgs, "statsfile"), (opArgs, "file")):
+		if args.get(name) not in (None, "", "-"):
+			args[name] = os.path.abspath(args[name])
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		connection.connect(socketPath())
+		connection.sendall(json.dumps({"protocol": protocol, "op": requestedOp, "baseArgs": baseArgs, "opArgs": opArgs}) + "\n")
+		reply = connection.makefile("rb")
+		while True:
+			header = reply.readline().split()
+			if not header:
+				print "Error: the pbapi.py daemon stopped while running the operation"
+				return 3
+			kind, value = header[0], int(header[1])
+			if kind == "X":
+				return value
+			if kind == "R":
+				return None
+			(sys.stderr if kind == "E" else sys.stdout).write(reply.read(value))
+			(sys.stderr if kind == "E" else sys.stdout).flush()
+	except socket.error as (err):
+		if err.errno in (errno.ENOENT, errno.ECONNREFUSED):
+			return None
+		raise
+	finally:
+		connection.close()
+
+# File-like object sending what is written to it to the client, as one frame each: "O <length>\n" and the data for
+# stdout, "E" for stderr; "X <exit code>\n" ends the reply, "R 0\n" refuses the request
+class Stream(object):
+
+	def __init__(self, connection, kind = "O"):
+		self.connection = connection
+		self.kind = kind
+
+	def write(self, data):
+		if isinstance(data, unicode):
+			data = data.encode("utf-8")
+		if data:
+			self.connection.sendall("%s %d\n%s" % (self.kind, len(data), data))
+
+	def flush(self):
+		pass
+
+# pbapi.py -daemon: runs the operations of the pbapi.py invocations of the user, each in a thread of its own, with API
+# clients that are built once per account and kept (parsed WSDL, open connections, cached replies, rate limiters),
+# so an invocation costs little more than its API calls. The socket is only accessible to the user. The modules loading
+# the SOAP client are only imported by the daemon itself: the forwarding side must start fast.
+class Daemon:
+
+	def __init__(self, path = None):
+		import api
+		self.path = path or socketPath()
+		self.apiPool = api.APIPool()
+		self.lock = threading.Lock()
+		self.cache = None # responsecache.ResponseCache of the requests with -cache
+		self.limiters = {} # -rate value => its ratelimit.RateLimiter
+
+	def serve(self):
+		directory = os.path.dirname(self.path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory, 0700)
+		if os.path.exists(self.path):
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(self.path)
+				print "Error: a daemon is already running on %s" % self.path
+				errorhandler.exit(1)
+				return
+			except socket.error:
+				os.unlink(self.path) # left by a daemon that didn't stop cleanly
+			finally:
+				probe.close()
+		listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		umask = os.umask(0077)
+		try:
+			listener.bind(self.path)
+		finally:
+			os.umask(umask)
+		listener.listen(64)
+		signal.signal(signal.SIGTERM, lambda number, frame: sys.exit(0))
+		print "Listening on %s" % self.path
+		sys.stdout.flush()
+		import batch
+		self.output = batch.threadOutput()
+		errorhandler.should_exit_python = True # a failed operation ends its request (SystemExit is caught per request)
+		try:
+			while True:
+				connection, address = listener.accept()
+				thread = threading.Thread(target = self.handle, args = (connection,))
+				thread.daemon = True
+				thread.start()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			listener.close()
+			os.unlink(self.path)
+
+	def handle(self, connection):
+		code = 0
+		try:
+			request = json.loads(connection.makefile("rb").readline() or "null")
+			if request is None or request.get("protocol") != protocol:
+				connection.sendall("R 0\n")
+				return
+			self.output.local.buffer = Stream(connection)
+			try:
+				self.run(request["op"], request["baseArgs"], request["opArgs"], Stream(connection, "E"))
+			except SystemExit as (err):
+				code = err.code if isinstance(err.code, int) else 1
+			except Exception as (err):
+				print "Error: %s" % str(err)
+				traceback.print_exc(file = sys.stderr)
+				code = 3
+			finally:
+				self.output.local.buffer = None
+			connection.sendall("X %d\n" % code)
+		except (socket.error, ValueError):
+			pass # the client went away, or didn't send a request
+		finally:
+			connection.close()
+
+	# Runs one operation the way pbapi.py does, with the settings of its base arguments on its own clone of the API
+	def run(self, requestedOp, baseArgs, opArgs, stderr):
+		import formatter
+		import argsparser
+		import metrics
+		output = formatter.forArgs(baseArgs)
+		shared = self.apiPool.get(baseArgs["u"], baseArgs["p"], wsdl = baseArgs["wsdl"], url = baseArgs["url"])
+		if shared.broken:
+			errorhandler.exit(3)
+		requestApi = shared.clone()
+		self.configure(requestApi, baseArgs)
+		if requestApi.metrics is not None:
+			output = metrics.TimedFormatter(output, requestApi.metrics)
+		try:
+			argsparser.ArgsParser.operations[requestedOp]["lambda"](output, requestApi, opArgs)
+			output.end()
+			if not baseArgs["s"] and baseArgs["o"] is None and requestedOp != "batch":
+				print ""
+				print "Request ID:", str(requestApi.requestId) if requestApi.requestId is not None else "(none)"
+		finally:
+			if requestApi.metrics is not None:
+				if baseArgs["stats"]:
+					stderr.write(requestApi.metrics.summary() + "\n")
+				if baseArgs["statsfile"]:
+					requestApi.metrics.write(baseArgs["statsfile"])
+
+	# Sets the options pbapi.py sets on the API class on this request's API object only
+	def configure(self, requestApi, baseArgs):
+		import responsecache
+		import retry
+		import ratelimit
+		import fastxml
+		import metrics
+		if baseArgs["cache"]:
+			with self.lock:
+				if self.cache is None:
+					self.cache = responsecache.ResponseCache(os.path.join(cachedir.userCacheDir(), "responses"))
+			requestApi.cache = self.cache
+		if baseArgs["retries"] is not None:
+			requestApi.retryPolicy = retry.RetryPolicy(baseArgs["retries"])
+		if baseArgs["rate"]:
+			with self.lock:
+				if baseArgs["rate"] not in self.limiters:
+					try:
+						self.limiters[baseArgs["rate"]] = ratelimit.forRate(baseArgs["rate"])
+					except ValueError:
+						errorhandler.ArgsError("-rate must be R or R:W (reads and writes per second)")
+				requestApi.rateLimiter = self.limiters[baseArgs["rate"]]
+		if baseArgs["fast"]:
+			requestApi.fastDecode = fastxml.defaultOperations
+		if baseArgs["stats"] or baseArgs["statsfile"]:
+			requestApi.metrics = metrics.Metrics()
+
+# Entry point of pbapi.py -daemon
+def serve():
+	Daemon().serve()
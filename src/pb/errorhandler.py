@@ -13,6 +13,7 @@ def exit(level = 0):
 	# 1 = args error
 	# 2 = authentication error
 	# 3 = soap fault
+	# 4 = timed out waiting for a data center
 	if should_exit_python:
 		sys.exit(level)
 	if last_error.last == 0:
@@ -0,0 +1,97 @@
+import threading
+from cStringIO import StringIO
+import xml.etree.cElementTree as etree
+
+# Operations worth decoding with Decoder when API.fastDecode is switched on from the command line (-fast):
+# the reads whose replies grow with the size of the data centers
+defaultOperations = ["getDataCenter", "getAllDataCenters", "getServer", "getStorage", "getNic", "getLoadBalancer", "getAllImages", "getImage", "getAllPublicIpBlocks"]
+
+# Plain dict that also gives its items as attributes, so that code written for suds objects (reply.servers,
+# "servers" in reply, reply["servers"]) works unchanged with it
+class Record(dict):
+
+	__slots__ = ()
+
+	def __getattr__(self, name):
+		try:
+			return self[name]
+		except KeyError:
+			raise AttributeError(name)
+
+# Decodes SOAP replies straight from their XML into Records, lists and builtins, with an incremental parser that
+# drops every element once it is converted. The shape of the result is taken from the WSDL schema (the same one
+# suds uses), so it is the same as suds' own: repeated elements are lists even with a single item, and numbers,
+# booleans and dates are converted by the suds types themselves.
+class Decoder:
+
+	def __init__(self, schema):
+		self.schema = schema
+		self.types = {} # qname of a complex type => {child name: (is a list, child fields or converter)}
+		self.elements = {} # qname of a reply element => fields of its type
+		self.lock = threading.Lock() # the tables are built on first use, possibly by several threads of a batch
+
+	def fields(self, xtype):
+		key = xtype.qname
+		if key in self.types:
+			return self.types[key]
+		fields = self.types[key] = {}
+		for child, ancestry in xtype:
+			resolved = child.resolve()
+			if resolved.builtin():
+				name = resolved.__class__.__name__
+				converter = None if name in ("XString", "XAny") else resolved.translate
+			else:
+				converter = self.fields(resolved)
+			fields[child.name] = (child.unbounded(), converter)
+		return fields
+
+	def elementFields(self, tag):
+		if tag not in self.elements:
+			with self.lock:
+				namespace, name = tag[1:].split("}", 1) if tag[0] == "{" else (None, tag)
+				element = self.schema.elements.get((name, namespace))
+				self.elements[tag] = self.fields(element.resolve()) if element is not None else {}
+		return self.elements[tag]
+
+	# Returns what suds would return for the reply xml: the "return" part of the response element
+	def decode(self, xml):
+		stack = [] # [(child fields or converter, Record for complex elements, is a list)]
+		inBody = False
+		for event, element in etree.iterparse(StringIO(xml), ("start", "end")):
+			if event == "start":
+				if not inBody:
+					inBody = element.tag.endswith("}Body")
+				elif not stack:
+					stack.append((self.elementFields(element.tag), Record(), False))
+				else:
+					spec = stack[-1][0].get(element.tag.rpartition("}")[2]) if isinstance(stack[-1][0], dict) else None
+					isList, converter = spec if spec is not None else (False, None)
+					stack.append((converter, Record() if isinstance(converter, dict) else None, isList))
+				continue
+			if not stack:
+				continue
+			converter, record, isList = stack.pop()
+			if not stack:
+				response = record
+				break
+			if record is not None:
+				value = record
+			elif element.text is None:
+				value = None
+			elif converter is not None:
+				value = converter(element.text)
+			else:
+				value = element.text
+			parent = stack[-1][1]
+			name = element.tag.rpartition("}")[2]
+			if isList:
+				parent.setdefault(name, []).append(value)
+			else:
+				parent[name] = value
+			element.clear()
+		else:
+			return None
+		if "return" in response:
+			return response["return"]
+		spec = self.elementFields(element.tag).get("return")
+		return [] if spec is not None and spec[0] else None
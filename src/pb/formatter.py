@@ -1,3 +1,9 @@
+import sys
+import csv
+import json
+import datetime
+import suds.sudsobject
+
 class Formatter:
 	
 	indentValue = 0
@@ -21,6 +27,10 @@ class Formatter:
 	def out(self, outStr = "", *args):
 		print ("\t" * self.indentValue) + outStr % args
 	
+	# Called once the operation has printed everything (see RecordFormatter)
+	def end(self):
+		pass
+	
 	@staticmethod
 	def requireArgs(soapResponse, requiredArgs, replaceMissingWith = "(none)"):
 		result = {}
@@ -30,7 +40,7 @@ class Formatter:
 	
 	# Generic method, for many operations that don't give any response (except through HTTP, which is handled by ProfitBricks.API)
 	def operationCompleted(self, response):
-		self.out("Operation completed") # if you change this, remember to change it in test/test-pbapi.sh
+		self.out("Operation completed") # if you change this, remember to change it in test/test-pbapi.py
 	
 	printClearDataCenter = operationCompleted
 	printUpdateDataCenter = operationCompleted
@@ -69,9 +79,50 @@ class Formatter:
 	def printCreateStorage(self, response):
 		self.out("Virtual storage ID: %s", response["storageId"])
 	
+	def printCreateServers(self, results):
+		for result in results:
+			if self.short:
+				self.out("%s %s %s%s", result["serverId"] or "-", result["storageId"] or "-", result["serverName"], "" if result["error"] is None else " " + result["error"])
+			elif result["error"] is not None:
+				self.out("Server %d (%s): %s%s", result["number"], result["serverName"], result["error"], "" if result["storageId"] is None else " (storage %s was created)" % result["storageId"])
+			else:
+				self.out("Server %d (%s): server ID %s%s", result["number"], result["serverName"], result["serverId"], "" if result["storageId"] is None else ", storage ID " + result["storageId"])
+		if not self.short:
+			self.out("Created %d of %d servers", len([result for result in results if result["error"] is None]), len(results))
+	
+	def printPlan(self, plan):
+		if not plan.steps:
+			self.out("No changes")
+		for step in plan.steps:
+			self.out("%3d. %s %s %s%s%s", step.number, step.action, step.kind, step.name, "" if not step.detail else ": " + step.detail, "" if self.short or not step.after else " (after %s)" % ", ".join(str(dep.number) for dep in step.after))
+	
+	def printApply(self, plan):
+		if not plan.steps:
+			self.out("No changes")
+		for step in plan.steps:
+			if step.status == "done":
+				self.out("%3d. %s %s %s: done%s", step.number, step.action, step.kind, step.name, "" if step.id is None else ", ID " + step.id)
+			else:
+				self.out("%3d. %s %s %s: %s, %s", step.number, step.action, step.kind, step.name, step.status, step.error)
+		if not self.short and plan.steps:
+			self.out("Applied %d of %d changes", len(plan.steps) - len(plan.failed()), len(plan.steps))
+	
 	def printDataCenterState(self, response):
 		self.out("Provisioning state: %s", response)
 	
+	def printWaitDataCenter(self, states):
+		for dcid in sorted(states):
+			self.out("Data center %s: %s", dcid, states[dcid] or "(unknown)")
+	
+	# One line per event, written at once: the watch keeps running
+	def printWatchEvent(self, event):
+		if event.old is not None and event.new is not None:
+			change = "%s -> %s" % (event.old, event.new)
+		else:
+			change = str(event.new if event.new is not None else event.old or "")
+		self.out("%s %s %s %s %s %s", event.time, event.kind.ljust(12), event.id, event.name or "(none)", event.event, change)
+		sys.stdout.flush()
+	
 	def printAllDataCenters(self, dataCenters):
 		if not self.short:
 			self.out()
@@ -195,6 +246,26 @@ class Formatter:
 			self.out("NIC ID: %s", srv["balancedNicId"])
 			self.out("Active: %s", "yes" if srv["activate"] else "no")
 	
+	# Firewall of a NIC or of a load balancer, and its rules
+	def printFirewall(self, firewall):
+		self.out("Firewall ID: %s", firewall["firewallId"])
+		if "nicId" in firewall:
+			self.out("NIC ID: %s", firewall["nicId"])
+		if "provisioningState" in firewall:
+			self.out("Provisioning state: %s", firewall["provisioningState"])
+		self.out("The firewall is %s", "enabled" if firewall["active"] else "disabled")
+		if "firewallRules" in firewall:
+			for rule in firewall.firewallRules:
+				self.printFirewallRule(rule)
+	
+	def printFirewallRule(self, apiRule):
+		rule = self.requireArgs(apiRule, ["firewallRuleId", "protocol", "sourceMac", "sourceIp", "targetIp", "portRangeStart", "portRangeEnd", "icmpType", "icmpCode"], "any")
+		if rule["protocol"] == "ICMP":
+			target = "ICMP type %s code %s" % (rule["icmpType"], rule["icmpCode"])
+		else:
+			target = "%s ports %s:%s" % (rule["protocol"], rule["portRangeStart"], rule["portRangeEnd"])
+		self.out("Rule %s: %s from %s (MAC %s) to %s", rule["firewallRuleId"], target, rule["sourceIp"], rule["sourceMac"], rule["targetIp"])
+	
 	def printRegisterServersOnLoadBalancer(self, response):
 		self.out("Load balancer ID: %s", response["loadBalancerId"])
 		self.out("LAN ID: %s", response["lanId"])
@@ -202,7 +273,7 @@ class Formatter:
 			for srv in response["balancedServers"]:
 				self.printBalancedServer(srv)
 		else:
-			sel.out("ERROR")
+			self.out("ERROR")
 	
 	def _printImage(self, image): # need to test whether to use this or other method
 		if self.short:
@@ -274,6 +345,26 @@ class Formatter:
 				self.out("(none)")
 			self.indent(-1);
 	
+	def printFind(self, resources):
+		if len(resources) == 0:
+			self.out("Nothing found")
+		for resource in resources:
+			if self.short:
+				self.out("%s %s (%s) in data center %s", resource.kind, resource.id, resource.name or "no name", resource.dataCenterId or "(none)")
+			elif resource.kind == "server":
+				self.printServer(resource.item)
+			elif resource.kind == "nic":
+				self.printNIC(resource.item)
+			elif resource.kind == "storage":
+				self.printStorage(resource.item)
+			elif resource.kind == "loadbalancer":
+				self.out()
+				self.printLoadBalancer(resource.item)
+			else:
+				self.out()
+				self.out("IP block ID: %s", resource.id)
+				self.out("IP addresses: %s", " ; ".join(str(publicIp.ip) for publicIp in resource.item.publicIps) if "publicIps" in resource.item else "(none)")
+	
 	def printPublicIPBlock(self, ipBlock):
 		if not self.short:
 			self.out("IP Block %s: %s", ipBlock["blockId"], " ; ".join(ipBlock["ips"]))
@@ -290,13 +381,226 @@ class Formatter:
 			self.printPublicIPBlock({"blockId": ipBlock.blockId, "ips": ips})
 	
 	def printAddFirewallRule(self, response):
-		self.out("Firewall ID: %s", response.firewallId)
-		self.out("NIC ID: %s", response.nicId)
-		self.out("Provisioning state: %s", response.provisioningState)
-		self.out("The firewall is %s", "enabled" if response.active else "disabled")
-		self.out()
-		print response.firewallRules
-		self.out()
-		print response
-		self.out()
+		self.printFirewall(response)
+
+# Returns the formatter the base arguments ask for: a RecordFormatter for -o json|jsonl|csv, else text (short with -s)
+def forArgs(baseArgs):
+	if baseArgs.get("o") is not None:
+		return RecordFormatter(baseArgs["o"])
+	formatter = Formatter()
+	if baseArgs["s"]:
+		formatter.shortFormat()
+	return formatter
 
+# Converts a reply (suds objects, lists, dates) into builtins that json and csv can write
+def toRecord(value):
+	if isinstance(value, suds.sudsobject.Object):
+		return dict((name, toRecord(item)) for name, item in value)
+	if isinstance(value, dict):
+		return dict((name, toRecord(item)) for name, item in value.iteritems())
+	if isinstance(value, list):
+		return [toRecord(item) for item in value]
+	if isinstance(value, (datetime.datetime, datetime.date)):
+		return value.isoformat()
+	if isinstance(value, basestring):
+		return unicode(value)
+	return value
+
+# Flattens a record for csv: nested fields become "parent.child" columns, lists become space separated values
+# (a list of objects gives one column per field, eg "nics.nicId")
+def flatten(record, prefix = ""):
+	flat = {}
+	for name, value in record.iteritems():
+		if isinstance(value, dict):
+			flat.update(flatten(value, prefix + name + "."))
+		elif isinstance(value, list) and any(isinstance(item, dict) for item in value):
+			for item in value:
+				for subName, subValue in flatten(item, prefix + name + ".").iteritems():
+					flat[subName] = (flat[subName] + " " if subName in flat else "") + unicode(subValue)
+		elif isinstance(value, list):
+			flat[prefix + name] = " ".join(unicode(item) for item in value)
+		else:
+			flat[prefix + name] = value
+	return flat
+
+# Formatter for programs instead of people: the print methods write one record per resource (server, storage,
+# image ...) as soon as it is converted, as a JSON array (json), one JSON object per line (jsonl) or CSV rows (csv).
+# Every record has a "kind" field. Print methods without a specific version here write their reply as one record,
+# or one record per item for lists.
+class RecordFormatter:
+	
+	modes = ["json", "jsonl", "csv"]
+	
+	# csv columns of the records of each kind, after "kind" (other kinds get the columns of their first record)
+	columns = {
+		"datacenter": ["dataCenterId", "dataCenterName", "provisioningState", "dataCenterVersion"],
+		"server": ["dataCenterId", "serverId", "serverName", "provisioningState", "virtualMachineState", "cores", "ram", "internetAccess", "ips", "osType", "creationTime", "lastModificationTime", "nics.nicId", "connectedStorages.storageId"],
+		"storage": ["dataCenterId", "storageId", "storageName", "provisioningState", "size", "osType", "serverIds", "mountImage.imageId", "mountImage.imageName", "creationTime", "lastModificationTime"],
+		"loadbalancer": ["dataCenterId", "loadBalancerId", "loadBalancerName", "provisioningState", "loadBalancerAlgorithm", "ip", "lanId", "balancedServers.serverId", "creationTime", "lastModificationTime"],
+		"nic": ["dataCenterId", "nicId", "nicName", "serverId", "lanId", "internetAccess", "ips", "macAddress"],
+		"image": ["imageId", "imageName", "imageType", "imageSize", "osType", "writeable", "cpuHotpluggable", "memoryHotpluggable", "serverIds"],
+		"ipblock": ["blockId", "publicIps.ip", "publicIps.nicId"],
+		"state": ["dataCenterId", "provisioningState"],
+		"event": ["time", "dataCenterId", "resource", "id", "name", "event", "old", "new"],
+		"createdserver": ["number", "serverName", "serverId", "storageId", "error"],
+		"step": ["number", "action", "resource", "name", "detail", "after", "status", "id", "error"]
+	}
+	
+	def __init__(self, mode):
+		self.mode = mode
+		self.short = False
+		self.indentValue = 0
+		self.count = 0
+		self.header = None
+		self.writer = None
+		self.ended = False
+	
+	def shortFormat(self):
+		pass
+	
+	def longFormat(self):
+		pass
+	
+	# Sets the csv columns from the kinds of records the operation writes (before its first record)
+	def begin(self, kinds):
+		if self.header is None and kinds is not None:
+			self.header = ["kind"]
+			for kind in kinds:
+				self.header += [column for column in self.columns[kind] if column not in self.header]
+	
+	def write(self, kind, value, **fields):
+		converted = toRecord(value)
+		if isinstance(converted, dict):
+			record = converted
+		else:
+			record = {} if converted is None else {"value": converted}
+		for name, field in fields.iteritems():
+			record.setdefault(name, field)
+		record["kind"] = kind
+		# sys.stdout is looked up for every record so that batch can capture the output of each thread
+		stream = sys.stdout
+		if self.mode == "csv":
+			flat = flatten(record)
+			if self.header is None:
+				self.header = ["kind"] + sorted(name for name in flat if name != "kind")
+			if self.writer is None or self.writer[0] is not stream:
+				self.writer = (stream, csv.writer(stream))
+				if self.count == 0:
+					self.writer[1].writerow(self.header)
+			self.writer[1].writerow([self._csvValue(flat.get(column)) for column in self.header])
+		elif self.mode == "jsonl":
+			stream.write(json.dumps(record) + "\n")
+		else:
+			stream.write(("[\n" if self.count == 0 else ",\n") + json.dumps(record))
+		self.count += 1
+	
+	def _csvValue(self, value):
+		if value is None:
+			return ""
+		if isinstance(value, bool):
+			return "true" if value else "false"
+		return unicode(value).encode("utf-8")
+	
+	def end(self):
+		if self.ended:
+			return
+		self.ended = True
+		if self.mode == "json":
+			sys.stdout.write("[]\n" if self.count == 0 else "\n]\n")
+		elif self.mode == "csv" and self.count == 0 and self.header is not None:
+			csv.writer(sys.stdout).writerow(self.header)
+		sys.stdout.flush()
+	
+	# Any print method not defined below writes its reply as it is (eg, the replies of the update operations)
+	def __getattr__(self, name):
+		if not name.startswith("print"):
+			raise AttributeError(name)
+		def printReply(response):
+			self.begin(None)
+			kind = name[len("print"):].lower()
+			for item in (response if isinstance(response, list) else [response]):
+				self.write(kind, item)
+		return printReply
+	
+	def printDataCenterState(self, response):
+		self.begin(["state"])
+		self.write("state", None, provisioningState = toRecord(response))
+	
+	def printWaitDataCenter(self, states):
+		self.begin(["state"])
+		for dcid in sorted(states):
+			self.write("state", None, dataCenterId = dcid, provisioningState = states[dcid])
+	
+	def printWatchEvent(self, event):
+		self.begin(["event"])
+		self.write("event", None, **event.record())
+		sys.stdout.flush()
+	
+	def printAllDataCenters(self, dataCenters):
+		self.begin(["datacenter"])
+		for dataCenter in dataCenters or []:
+			self.write("datacenter", dataCenter)
+	
+	def printDataCenter(self, dataCenter):
+		self.begin(["datacenter", "server", "storage", "loadbalancer"])
+		dcid = toRecord(dataCenter.dataCenterId)
+		self.write("datacenter", None, **dict((name, toRecord(dataCenter[name])) for name in ("dataCenterId", "dataCenterName", "provisioningState", "dataCenterVersion") if name in dataCenter))
+		for field, kind in (("servers", "server"), ("storages", "storage"), ("loadBalancers", "loadbalancer")):
+			if field in dataCenter:
+				for item in dataCenter[field]:
+					self.write(kind, item, dataCenterId = dcid)
+	
+	def printServer(self, server):
+		self.begin(["server"])
+		self.write("server", server)
+	
+	def printStorage(self, storage):
+		self.begin(["storage"])
+		self.write("storage", storage)
+	
+	def printNIC(self, nic):
+		self.begin(["nic"])
+		self.write("nic", nic)
+	
+	def printLoadBalancer(self, loadBalancer):
+		self.begin(["loadbalancer"])
+		self.write("loadbalancer", loadBalancer)
+	
+	def printImage(self, image):
+		self.begin(["image"])
+		self.write("image", image)
+	
+	def printAllImages(self, images):
+		self.begin(["image"])
+		for image in images or []:
+			self.write("image", image)
+	
+	def printGetAllPublicIPBlocks(self, blocks):
+		self.begin(["ipblock"])
+		for block in blocks or []:
+			self.write("ipblock", block)
+	
+	def printCreateServers(self, results):
+		self.begin(["createdserver"])
+		for result in results:
+			self.write("createdserver", result)
+	
+	def printPlan(self, plan):
+		self.begin(["step"])
+		for step in plan.steps:
+			self.write("step", step.record())
+	
+	printApply = printPlan
+	
+	def printCreateLoadBalancer(self, id):
+		self.begin(None)
+		self.write("createloadbalancer", None, loadBalancerId = toRecord(id))
+	
+	def printFind(self, resources):
+		kinds = []
+		for resource in resources:
+			if resource.kind not in kinds:
+				kinds.append(resource.kind)
+		self.begin(kinds)
+		for resource in resources:
+			self.write(resource.kind, resource.item, dataCenterId = resource.dataCenterId)
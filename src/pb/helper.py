@@ -8,16 +8,17 @@ class Helper:
 		return re.sub('([a-z0-9])([A-Z])', r'\1-\2', s1).lower()
 	
 	@staticmethod
-	def printOperations(operations):
+	def printOperations(registry):
 		print "Available operations and mandatory arguments:"
-		for op in sorted(operations):
+		for op in registry:
 			print ":",\
-				Helper.camelCaseToDash(re.sub("@", "", op)),\
-				("(-" + " -".join(operations[op]["args"]) + ")") if len(operations[op]["args"]) > 0 else "",\
-				"(internal)" if re.search("@", op) else ""
+				registry.displayName(op),\
+				("(-" + " -".join(registry.operations[op]["args"]) + ")") if len(registry.operations[op]["args"]) > 0 else "",\
+				("[-" + " -".join(registry.optionalArgs[op]) + "]") if registry.optionalArgs[op] else "",\
+				("(also: " + ", ".join(Helper.camelCaseToDash(alias) for alias in registry.aliases(op)) + ")") if registry.aliases(op) else "",\
+				"(internal)" if registry.isLocal(op) else ""
 	
 	@staticmethod
-	def printOperationsSimple(operations):
-		for op in sorted(operations):
-			print Helper.camelCaseToDash(re.sub("@", "", op))
-
+	def printOperationsSimple(registry):
+		for op in registry:
+			print registry.displayName(op)
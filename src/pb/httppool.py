@@ -0,0 +1,145 @@
+import time
+import errno
+import socket
+import httplib
+import urlparse
+import threading
+from cStringIO import StringIO
+from suds.transport import Reply, TransportError
+from suds.transport.http import HttpAuthenticated
+
+# Raised when the connection to the server could not be made, so the request surely did not reach it
+class ConnectError(TransportError):
+	pass
+
+# suds transport that keeps HTTP/1.1 connections open between SOAP calls, so a script making hundreds of
+# calls pays for the TCP and TLS handshakes once instead of once per call. The basic authentication header is
+# sent with every request (no 401 challenge round trip). Safe to share between threads and between the
+# clones of a suds client; the WSDL itself is still fetched through urllib2 (see HttpTransport.open).
+class PooledTransport(HttpAuthenticated):
+
+	poolSize = 4 # idle connections kept per host
+	idleTimeout = 30 # seconds an idle connection is kept; stay below the server's keep-alive timeout
+
+	def __init__(self, poolSize = None, idleTimeout = None, **kwargs):
+		HttpAuthenticated.__init__(self, **kwargs)
+		if poolSize is not None:
+			self.poolSize = poolSize
+		if idleTimeout is not None:
+			self.idleTimeout = idleTimeout
+		self.idle = {} # (scheme, host, port) => [(connection, last used), ...]
+		self.lock = threading.Lock()
+		self.stats = {"requests": 0, "connections": 0, "reused": 0, "closed": 0}
+		self.local = threading.local() # bytes sent and received by the current thread, see traffic()
+
+	def send(self, request):
+		self._countBytes(len(request.message or ""), 0)
+		if self.options.proxy:
+			reply = HttpAuthenticated.send(self, request)
+			self._countBytes(0, len(reply.message or "") if reply is not None else 0)
+			return reply
+		self.addcredentials(request)
+		url = urlparse.urlsplit(request.url)
+		key = (url.scheme, url.hostname, url.port)
+		path = (url.path or "/") + ("?" + url.query if url.query else "")
+		headers = dict(request.headers)
+		headers["Connection"] = "keep-alive"
+		self._count("requests")
+		while True:
+			connection, reused = self._acquire(key)
+			if not reused:
+				try:
+					connection.connect()
+				except (socket.error, httplib.HTTPException) as (err):
+					connection.close()
+					self._count("closed")
+					raise ConnectError(str(err), None)
+			replied = False
+			try:
+				connection.request("POST", path, request.message, headers)
+				response = connection.getresponse()
+				replied = True
+				body = response.read()
+				break
+			except (socket.error, httplib.HTTPException) as (err):
+				connection.close()
+				self._count("closed")
+				# the server may have dropped an idle connection; send again on a fresh one (the retry policy decides
+				# about any other failure, the request may have been carried out)
+				if reused and self._dropped(err, replied):
+					continue
+				raise TransportError(str(err), None)
+		self._release(key, connection, response)
+		self._countBytes(0, len(body))
+		if response.status in (202, 204):
+			return None
+		if response.status >= 300:
+			raise TransportError(response.reason, response.status, StringIO(body))
+		return Reply(200, dict(response.getheaders()), body)
+
+	# Whether err shows that the server had closed an idle connection, and so never saw the request: it closed it
+	# without any reply (BadStatusLine), or reset it before the status line of a reply. Not a timeout.
+	@staticmethod
+	def _dropped(err, replied):
+		if isinstance(err, httplib.BadStatusLine):
+			return True
+		return not replied and isinstance(err, socket.error) and not isinstance(err, socket.timeout) and err.errno in (errno.ECONNRESET, errno.EPIPE)
+
+	# Returns (connection, reused) with the most recently used live idle connection, or a new one
+	def _acquire(self, key):
+		now = time.time()
+		with self.lock:
+			connections = self.idle.get(key, [])
+			while connections:
+				connection, lastUsed = connections.pop()
+				if now - lastUsed < self.idleTimeout:
+					self.stats["reused"] += 1
+					return connection, True
+				connection.close()
+				self.stats["closed"] += 1
+			self.stats["connections"] += 1
+		scheme, host, port = key
+		connectionClass = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+		return connectionClass(host, port, timeout = self.options.timeout), False
+
+	def _release(self, key, connection, response):
+		with self.lock:
+			connections = self.idle.setdefault(key, [])
+			if response.will_close or len(connections) >= self.poolSize:
+				connection.close()
+				self.stats["closed"] += 1
+			else:
+				connections.append((connection, time.time()))
+
+	def _count(self, name):
+		with self.lock:
+			self.stats[name] += 1
+
+	def _countBytes(self, sent, received):
+		self.local.sent = getattr(self.local, "sent", 0) + sent
+		self.local.received = getattr(self.local, "received", 0) + received
+
+	# Returns (sent, received): the bytes of the request and reply bodies this thread has exchanged so far
+	def traffic(self):
+		return getattr(self.local, "sent", 0), getattr(self.local, "received", 0)
+
+	# Closes all idle connections
+	def close(self):
+		with self.lock:
+			for connections in self.idle.values():
+				for connection, lastUsed in connections:
+					connection.close()
+					self.stats["closed"] += 1
+			self.idle.clear()
+
+	# suds deep-copies the options (and with them the transport) when cloning a client; the copy gets its own
+	# options, as suds requires, but shares the pool and the counters with the original
+	def __deepcopy__(self, memo = {}):
+		clone = HttpAuthenticated.__deepcopy__(self, memo)
+		clone.poolSize = self.poolSize
+		clone.idleTimeout = self.idleTimeout
+		clone.idle = self.idle
+		clone.lock = self.lock
+		clone.stats = self.stats
+		clone.local = self.local
+		return clone
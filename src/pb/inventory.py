@@ -0,0 +1,136 @@
+import time
+import errorhandler
+
+# A server, NIC, storage, load balancer or public IP block of the inventory
+class Resource:
+
+	def __init__(self, kind, id, name, dataCenterId, item):
+		self.kind = kind
+		self.id = id
+		self.name = name
+		self.dataCenterId = dataCenterId
+		self.item = item # the suds object returned by the API
+
+	def __repr__(self):
+		return "<%s %s>" % (self.kind, self.id)
+
+def _get(item, name, default = None):
+	return item[name] if name in item else default
+
+def _str(value):
+	return str(value) if value is not None else None
+
+# All resources of one or more data centers, indexed by ID, name, IP, MAC address, LAN and server, so that
+# questions like "which server owns this IP" are dictionary lookups instead of walks through getDataCenter trees
+class Inventory:
+
+	maxAge = 30 # seconds an inventory loaded by find() is reused
+
+	def __init__(self):
+		self.loaded = time.time()
+		self.complete = False # True if all the data centers of the account were loaded
+		self.dataCenterIds = set()
+		self.byId = {}
+		self.byName = {} # lower-case name => [resource, ...]
+		self.byIp = {}
+		self.byMac = {} # lower-case MAC => [resource, ...]
+		self.byLan = {} # (data center ID, LAN ID) => [resource, ...]
+		self.byServer = {} # server ID => [NICs and storages attached to it]
+
+	# Loads the given data centers (default: all of them) and the public IP blocks. The trees come from the api's
+	# sync.Sync, which only downloads again the data centers whose version changed since the last load.
+	def load(self, api, dcids = None):
+		import sync # loads the SOAP client (through batch), which the local (@) operations must not wait for
+		if api.sync is None:
+			api.sync = sync.Sync(api)
+		api.sync.refresh(dcids)
+		if dcids is None:
+			self.complete = True
+			dcids = sorted(api.sync.trees)
+		for dcid in dcids:
+			dataCenter = api.sync.trees.get(dcid) or api.getDataCenter(dcid) # not listed: getDataCenter says why
+			if dataCenter is not None:
+				self.addDataCenter(dataCenter)
+		for block in (api.getAllPublicIPBlocks() or []):
+			self.addIpBlock(block)
+		return self
+
+	def addDataCenter(self, dataCenter):
+		dcid = _str(dataCenter.dataCenterId)
+		self.dataCenterIds.add(dcid)
+		for server in _get(dataCenter, "servers", []):
+			srvid = _str(server.serverId)
+			self._add(Resource("server", srvid, _str(_get(server, "serverName")), dcid, server))
+			for nic in _get(server, "nics", []):
+				self.addNic(nic, dcid)
+		for storage in _get(dataCenter, "storages", []):
+			resource = self._add(Resource("storage", _str(storage.storageId), _str(_get(storage, "storageName")), dcid, storage))
+			for srvid in _get(storage, "serverIds", []):
+				self._index(self.byServer, str(srvid), resource)
+		for loadBalancer in _get(dataCenter, "loadBalancers", []):
+			resource = self._add(Resource("loadbalancer", _str(loadBalancer.loadBalancerId), _str(_get(loadBalancer, "loadBalancerName")), dcid, loadBalancer))
+			if "ip" in loadBalancer:
+				self._index(self.byIp, str(loadBalancer.ip), resource)
+			if "lanId" in loadBalancer:
+				self._index(self.byLan, (dcid, str(loadBalancer.lanId)), resource)
+
+	def addNic(self, nic, dcid):
+		resource = self._add(Resource("nic", _str(nic.nicId), _str(_get(nic, "nicName")), dcid, nic))
+		for ip in _get(nic, "ips", []):
+			self._index(self.byIp, str(ip), resource)
+		if "macAddress" in nic:
+			self._index(self.byMac, str(nic.macAddress).lower(), resource)
+		if "lanId" in nic:
+			self._index(self.byLan, (dcid, str(nic.lanId)), resource)
+		if "serverId" in nic:
+			self._index(self.byServer, str(nic.serverId), resource)
+
+	def addIpBlock(self, block):
+		resource = self._add(Resource("ipblock", _str(block.blockId), None, None, block))
+		for publicIp in _get(block, "publicIps", []):
+			self._index(self.byIp, str(publicIp.ip), resource)
+
+	def _add(self, resource):
+		self.byId[resource.id] = resource
+		if resource.name:
+			self._index(self.byName, resource.name.lower(), resource)
+		return resource
+
+	def _index(self, index, key, resource):
+		index.setdefault(key, []).append(resource)
+
+	# Returns the resources matching all the given criteria (each one is an index lookup)
+	def find(self, id = None, name = None, ip = None, mac = None, lanid = None, dcid = None, srvid = None):
+		candidates = []
+		if id is not None:
+			candidates.append([self.byId[id]] if id in self.byId else [])
+		if name is not None:
+			candidates.append(self.byName.get(name.lower(), []))
+		if ip is not None:
+			candidates.append(self.byIp.get(ip, []))
+		if mac is not None:
+			candidates.append(self.byMac.get(mac.lower(), []))
+		if srvid is not None:
+			candidates.append(self.byServer.get(srvid, []))
+		if lanid is not None:
+			dcids = [dcid] if dcid is not None else self.dataCenterIds
+			candidates.append([resource for d in dcids for resource in self.byLan.get((d, lanid), [])])
+		if not candidates:
+			return []
+		others = [set(other) for other in candidates[1:]]
+		result = [resource for resource in candidates[0] if all(resource in other for other in others)]
+		if dcid is not None:
+			result = [resource for resource in result if resource.dataCenterId in (dcid, None)]
+		return result
+
+# Entry point of the "find" operation: looks the resources up in the inventory of api, (re)loading it when it is too old
+def find(api, opArgs):
+	criteria = dict((name, opArgs[name]) for name in ("id", "name", "ip", "mac", "lanid", "srvid") if name in opArgs)
+	if not criteria:
+		errorhandler.ArgsError("operation 'find' requires at least one of these arguments: -id -name -ip -mac -lanid -srvid")
+		return []
+	dcid = opArgs.get("dcid")
+	inventory = api.inventory
+	if inventory is None or time.time() - inventory.loaded > Inventory.maxAge or (dcid is None and not inventory.complete) or (dcid is not None and dcid not in inventory.dataCenterIds):
+		inventory = api.inventory = Inventory().load(api, [dcid] if dcid is not None else None)
+	return inventory.find(dcid = dcid, **criteria)
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import threading
+
+# Latencies counted in buckets growing by factor from minimum seconds: memory stays the same however many calls a
+# long-running shell or batch makes, and quantiles are off by less than one bucket (factor - 1 = 20%) of the value
+class Histogram:
+
+	minimum = 0.001
+	factor = 1.2
+	size = 70 # the last bucket (from about 300s) takes everything longer
+
+	def __init__(self):
+		self.counts = [0] * self.size
+		self.count = 0
+		self.sum = 0.0
+		self.min = None
+		self.max = None
+
+	def add(self, seconds):
+		index = 0
+		bound = self.minimum
+		while seconds > bound and index < self.size - 1:
+			index += 1
+			bound *= self.factor
+		self.counts[index] += 1
+		self.count += 1
+		self.sum += seconds
+		self.min = seconds if self.min is None else min(self.min, seconds)
+		self.max = seconds if self.max is None else max(self.max, seconds)
+
+	# Estimated value below which fraction q of the latencies are (the upper bound of the bucket it falls in)
+	def quantile(self, q):
+		if not self.count:
+			return None
+		rank = q * self.count
+		seen = 0
+		bound = self.minimum
+		for count in self.counts:
+			seen += count
+			if seen >= rank:
+				break
+			bound *= self.factor
+		return max(self.min, min(self.max, bound))
+
+# What was measured for one operation (or one phase, see Metrics.phase): bytes are those of the HTTP bodies, retries
+# included; calls answered by another thread's identical call (see api.SharedCalls) count without bytes
+class Counter:
+
+	def __init__(self):
+		self.calls = 0
+		self.errors = 0
+		self.sent = 0
+		self.received = 0
+		self.seconds = Histogram()
+
+	def toRecord(self):
+		record = {"calls": self.calls, "errors": self.errors, "seconds": round(self.seconds.sum, 6), "sent": self.sent, "received": self.received}
+		for name, q in quantiles:
+			value = self.seconds.quantile(q)
+			record[name] = round(value, 6) if value is not None else None
+		return record
+
+quantiles = [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]
+
+# Counters of the calls made by API.call (per operation name) and of the client side phases around them ("client":
+# building the suds client, "format": formatting the replies). One Metrics is shared by all the API objects and
+# threads of the process; it is written as a summary (-stats), a JSON file or Prometheus text (-stats-file).
+class Metrics:
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.operations = {} # operation name => Counter
+		self.phases = {} # phase name => Counter
+
+	def record(self, operation, seconds, failed = False, sent = 0, received = 0):
+		self._add(self.operations, operation, seconds, failed, sent, received)
+
+	def phase(self, name, seconds, failed = False):
+		self._add(self.phases, name, seconds, failed, 0, 0)
+
+	def _add(self, counters, name, seconds, failed, sent, received):
+		with self.lock:
+			counter = counters.get(name)
+			if counter is None:
+				counter = counters[name] = Counter()
+			counter.calls += 1
+			counter.errors += 1 if failed else 0
+			counter.sent += sent
+			counter.received += received
+			counter.seconds.add(seconds)
+
+	# Returns fn(), adding the time it took to phase name
+	def timed(self, name, fn):
+		started = time.time()
+		failed = True
+		try:
+			result = fn()
+			failed = False
+			return result
+		finally:
+			self.phase(name, time.time() - started, failed)
+
+	def toRecord(self):
+		with self.lock:
+			return {
+				"uptime": round(time.time() - self.started, 3),
+				"operations": dict((name, counter.toRecord()) for name, counter in self.operations.items()),
+				"phases": dict((name, counter.toRecord()) for name, counter in self.phases.items())
+			}
+
+	def toJson(self):
+		return json.dumps(self.toRecord(), indent = 2, sort_keys = True)
+
+	# Prometheus text exposition format: counters and a summary (p50/p95/p99) per operation and per phase
+	def toPrometheus(self):
+		record = self.toRecord()
+		lines = []
+		for kind, label in (("operations", "operation"), ("phases", "phase")):
+			prefix = "pbapi_call" if kind == "operations" else "pbapi_phase"
+			counters = sorted(record[kind].items())
+			metrics = [("seconds", "summary", "Time taken"), ("errors_total", "counter", "Failed ones")]
+			if kind == "operations":
+				metrics += [("request_bytes_total", "counter", "Bytes of the requests sent"), ("response_bytes_total", "counter", "Bytes of the responses received")]
+			for suffix, metricType, help in metrics:
+				name = "%s_%s" % (prefix, suffix)
+				lines.append("# HELP %s %s" % (name, help))
+				lines.append("# TYPE %s %s" % (name, metricType))
+				for value, counter in counters:
+					labels = '%s="%s"' % (label, value.replace("\\", "\\\\").replace('"', '\\"'))
+					if suffix == "seconds":
+						for quantile, q in quantiles:
+							if counter[quantile] is not None:
+								lines.append('%s{%s,quantile="%s"} %r' % (name, labels, q, counter[quantile]))
+						lines.append("%s_sum{%s} %r" % (name, labels, counter["seconds"]))
+						lines.append("%s_count{%s} %d" % (name, labels, counter["calls"]))
+					else:
+						lines.append("%s{%s} %d" % (name, labels, counter[{"errors_total": "errors", "request_bytes_total": "sent", "response_bytes_total": "received"}[suffix]]))
+		return "\n".join(lines) + "\n"
+
+	# One line per operation and phase, slowest total first
+	def summary(self):
+		record = self.toRecord()
+		lines = ["%-28s %7s %6s %9s %9s %9s %10s %10s" % ("# Operation", "calls", "errors", "p50 ms", "p95 ms", "p99 ms", "sent", "received")]
+		for kind in ("operations", "phases"):
+			for name, counter in sorted(record[kind].items(), key = lambda item: -item[1]["seconds"]):
+				lines.append("%-28s %7d %6d %9s %9s %9s %10s %10s" % (
+					name if kind == "operations" else "(%s)" % name, counter["calls"], counter["errors"],
+					_milliseconds(counter["p50"]), _milliseconds(counter["p95"]), _milliseconds(counter["p99"]),
+					counter["sent"] if kind == "operations" else "", counter["received"] if kind == "operations" else ""))
+		return "\n".join(lines)
+
+	# Writes the metrics to fileName: Prometheus text if it ends with ".prom" (as node_exporter's textfile collector
+	# expects), else JSON. The file is replaced at once, a reader never sees half of it.
+	def write(self, fileName):
+		text = self.toPrometheus() if fileName.endswith(".prom") else self.toJson() + "\n"
+		temporary = "%s.%d.tmp" % (fileName, os.getpid())
+		with open(temporary, "w") as out:
+			out.write(text)
+		os.rename(temporary, fileName)
+
+def _milliseconds(seconds):
+	return "%.1f" % (seconds * 1000) if seconds is not None else "-"
+
+# Formatter proxy adding the time spent in each formatter method to the "format" phase of metrics
+class TimedFormatter:
+
+	def __init__(self, formatter, metrics):
+		self.formatter = formatter
+		self.metrics = metrics
+
+	def __getattr__(self, name):
+		value = getattr(self.formatter, name)
+		if not callable(value):
+			return value
+		return lambda *args, **kwargs: self.metrics.timed("format", lambda: value(*args, **kwargs))
@@ -0,0 +1,100 @@
+import sys
+import Queue
+import threading
+from cStringIO import StringIO
+import errorhandler
+import batch
+
+# Creates many servers from one template: for each, a boot storage (if the template has a size) and then the server
+# booting from it, with a NIC in the template's LAN. The only order the API requires is storage before server, so the
+# chains of all the servers run at the same time on a bounded pool of threads, each with its own clone of the API.
+# A failed chain doesn't stop the others; its error is reported with its result.
+class Fleet:
+
+	parallel = 8
+
+	def __init__(self, baseApi, parallel = None):
+		self.baseApi = baseApi
+		if parallel is not None:
+			self.parallel = max(1, int(parallel))
+
+	# Returns one result per server, in order: {"number", "serverName", "serverId", "storageId", "error"}
+	def create(self, template, count, first = 1):
+		results = [{"number": number, "serverName": serverName(template.get("name"), number), "serverId": None, "storageId": None, "error": None} for number in range(first, first + count)]
+		queue = Queue.Queue()
+		for result in results:
+			queue.put(result)
+
+		def worker():
+			api = self.baseApi.clone()
+			while True:
+				try:
+					result = queue.get_nowait()
+				except Queue.Empty:
+					return
+				self.createOne(api, template, result)
+				if api.broken:
+					api = self.baseApi.clone()
+
+		savedStdout, savedShouldExit = sys.stdout, errorhandler.should_exit_python
+		self.output = batch.threadOutput()
+		errorhandler.should_exit_python = True # a failed call must end its chain (SystemExit is caught per server)
+		try:
+			threads = [threading.Thread(target = worker) for i in range(min(self.parallel, count))]
+			for thread in threads:
+				thread.daemon = True
+				thread.start()
+			for thread in threads:
+				while thread.is_alive():
+					thread.join(1)
+		finally:
+			sys.stdout = savedStdout
+			errorhandler.should_exit_python = savedShouldExit
+		return results
+
+	def createOne(self, api, template, result):
+		buffer = StringIO()
+		self.output.local.buffer = buffer
+		try:
+			if template.get("size"):
+				storageArgs = {"dcid": template["dcid"], "size": template["size"], "name": result["serverName"] + "-storage"}
+				if template.get("mountimageid"):
+					storageArgs["mountimageid"] = template["mountimageid"]
+				result["storageId"] = str(api.createStorage(storageArgs)["storageId"])
+			serverArgs = dict((name, template[name]) for name in ("dcid", "cores", "ram", "lanid", "internetaccess", "ostype", "bootfromimageid") if template.get(name))
+			serverArgs["name"] = result["serverName"]
+			if result["storageId"] is not None:
+				serverArgs["bootfromstorageid"] = result["storageId"]
+			result["serverId"] = str(api.createServer(serverArgs)["serverId"])
+		except SystemExit:
+			result["error"] = buffer.getvalue().strip() or "Error: unknown error"
+		except Exception as (err):
+			result["error"] = "Error: %s" % str(err)
+		finally:
+			self.output.local.buffer = None
+
+# Name of server number in a fleet: the template name formatted with the number (eg "web-%03d"), or with "-number"
+# appended if it has no place for it
+def serverName(pattern, number):
+	pattern = pattern or "server-%d"
+	try:
+		return pattern % number
+	except (TypeError, ValueError): # no %d, or a stray % (eg "web-100%")
+		return "%s-%d" % (pattern, number)
+
+# Entry point of the "createServers" operation
+def createServers(api, opArgs):
+	try:
+		count = int(opArgs["count"])
+		first = int(opArgs.get("first") or 1)
+		parallel = int(opArgs["parallel"]) if opArgs.get("parallel") else None
+	except ValueError:
+		errorhandler.ArgsError("-count, -first and -parallel must be numbers")
+		return []
+	if count < 1:
+		errorhandler.ArgsError("-count must be at least 1")
+		return []
+	if opArgs.get("mountimageid") and not opArgs.get("size"):
+		errorhandler.ArgsError("-mountimageid needs -size: the image is copied to the boot storage of every server")
+		return []
+	return Fleet(api, parallel).create(opArgs, count, first)
@@ -0,0 +1,109 @@
+import os
+import time
+import threading
+import cachedir
+try:
+	import fcntl
+except ImportError:
+	fcntl = None # no flock (Windows): buckets are only shared within the process
+
+# Token bucket: rate tokens per second, at most burst of them saved up. A caller takes its token at once, even if
+# the bucket is empty, and is told how long to wait: the callers are spaced evenly at the rate, in the order they
+# came, instead of all retrying when a token frees up.
+class TokenBucket:
+
+	def __init__(self, rate, burst = None):
+		self.rate = float(rate)
+		self.burst = float(burst if burst is not None else max(1, rate))
+		self.lock = threading.Lock()
+		self.level = self.burst
+		self.last = time.time()
+
+	# Takes tokens and returns the seconds to wait before using them
+	def reserve(self, tokens = 1):
+		with self.lock:
+			now = time.time()
+			self.level, delay = self.take(self.level, self.last, now, tokens)
+			self.last = now
+			return delay
+
+	def take(self, level, last, now, tokens):
+		level = min(self.burst, level + max(0, now - last) * self.rate) - tokens
+		return level, (-level / self.rate if level < 0 else 0)
+
+# Token bucket kept in a file, so that all the processes of the host using the same file share it (each with the
+# rate it was given: give them all the same). The file is locked (flock) only while a token is taken.
+class FileBucket(TokenBucket):
+
+	def __init__(self, rate, burst, path):
+		TokenBucket.__init__(self, rate, burst)
+		self.path = path
+
+	def reserve(self, tokens = 1):
+		with self.lock:
+			fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+			try:
+				fcntl.flock(fd, fcntl.LOCK_EX)
+				now = time.time()
+				try:
+					level, last = [float(value) for value in os.read(fd, 100).split()]
+				except ValueError:
+					level, last = self.burst, now
+				level, delay = self.take(level, last, now, tokens)
+				os.lseek(fd, 0, os.SEEK_SET)
+				os.ftruncate(fd, 0)
+				os.write(fd, "%r %r" % (level, now))
+				return delay
+			finally:
+				os.close(fd)
+
+# Limits the calls of API.call with one bucket for reads and one for writes (a rate of None or 0 doesn't limit), or
+# with a single bucket of readRate for both if shared. One limiter is shared by all the threads using it; with a
+# location (a directory), the buckets are files in it and shared by all the processes using the same location.
+class RateLimiter:
+
+	def __init__(self, readRate = None, writeRate = None, location = None, burst = None, shared = False):
+		self.location = location
+		if shared:
+			bucket = self.bucket("calls", readRate, burst)
+			self.buckets = {True: bucket, False: bucket}
+		else:
+			self.buckets = {True: self.bucket("reads", readRate, burst), False: self.bucket("writes", writeRate, burst)}
+		self.lock = threading.Lock()
+		self.stats = {"calls": 0, "delayed": 0, "waited": 0.0}
+
+	def bucket(self, name, rate, burst):
+		if not rate:
+			return None
+		if self.location is None or fcntl is None:
+			return TokenBucket(rate, burst)
+		try:
+			os.makedirs(self.location, 0700)
+		except OSError:
+			pass
+		return FileBucket(rate, burst, os.path.join(self.location, name))
+
+	# Returns the seconds a read (or a write) has to wait for its turn, and counts it
+	def reserve(self, read):
+		bucket = self.buckets[bool(read)]
+		delay = bucket.reserve() if bucket is not None else 0
+		with self.lock:
+			self.stats["calls"] += 1
+			if delay > 0:
+				self.stats["delayed"] += 1
+				self.stats["waited"] += delay
+		return delay
+
+	# Blocks until a read (or a write) may be sent
+	def acquire(self, read):
+		delay = self.reserve(read)
+		if delay > 0:
+			time.sleep(delay)
+
+# Returns the RateLimiter for a -rate value shared by all the processes of the user: "R" (R calls per second, reads
+# and writes alike) or "R:W" (R reads and W writes per second); raises ValueError for anything else
+def forRate(value):
+	rates = [float(rate) for rate in value.split(":")]
+	if len(rates) not in (1, 2) or min(rates) < 0:
+		raise ValueError(value)
+	return RateLimiter(rates[0], rates[-1], os.path.join(cachedir.userCacheDir(), "ratelimit"), shared = len(rates) == 1)
@@ -0,0 +1,75 @@
+import helper
+
+# Operation and argument names are case and dash insensitive ("create-server" is "createServer", "-srvId" is "-srvid")
+def normalize(name):
+	return name.replace("-", "").lower()
+
+# Index of an operation table (see ArgsParser.operations), built once: lookups of operation names and aliases are
+# dictionary lookups and completions are prefix trie walks, however many operations there are.
+# Entries of the table may have "aliases" (other names of the operation) and "optionalArgs" (arguments listed in the
+# usage but not required) besides "args" and "lambda".
+class Registry:
+
+	def __init__(self, operations):
+		self.operations = operations
+		self.byName = {} # normalized name or alias => operation
+		self.requiredArgs = {} # operation => [normalized names of its mandatory arguments]
+		self.optionalArgs = {} # operation => [normalized names of the other arguments it takes]
+		self.trie = ({}, []) # (children by character, sorted completions below this node)
+		for op in operations:
+			self.add(op)
+
+	def add(self, op):
+		entry = self.operations[op]
+		name = normalize(op)
+		self.byName[name] = op
+		if op[0] == "@":
+			self.byName[name[1:]] = op # @ operations may be called without their @
+		for alias in entry.get("aliases", []):
+			self.byName[normalize(alias)] = op
+		self.requiredArgs[op] = [normalize(arg) for arg in entry["args"]]
+		self.optionalArgs[op] = [normalize(arg) for arg in entry.get("optionalArgs", [])]
+		self.addCompletion(self.displayName(op))
+
+	# Makes complete() offer name (eg, a command that isn't in the operation table)
+	def addCompletion(self, name):
+		node = self.trie
+		self._insert(node[1], name)
+		for c in normalize(name):
+			node = node[0].setdefault(c, ({}, []))
+			self._insert(node[1], name)
+
+	def _insert(self, completions, name):
+		if name not in completions:
+			completions.append(name)
+			completions.sort()
+
+	# Returns the operation called name (or one of its aliases), or None
+	def lookup(self, name):
+		return self.byName.get(normalize(name))
+
+	# Returns the mandatory arguments of op that are missing from opArgs (whose names are normalized already)
+	def missingArgs(self, op, opArgs):
+		return [arg for arg in self.requiredArgs[op] if arg not in opArgs]
+
+	# Returns the sorted names starting with prefix (compared normalized, so "creates" completes "create-server")
+	def complete(self, prefix):
+		node = self.trie
+		for c in normalize(prefix):
+			node = node[0].get(c)
+			if node is None:
+				return []
+		return node[1]
+
+	# The name of op as users type it (eg, "create-server", "list" for "@list")
+	def displayName(self, op):
+		return helper.Helper.camelCaseToDash(op.replace("@", ""))
+
+	def aliases(self, op):
+		return self.operations[op].get("aliases", [])
+
+	def isLocal(self, op):
+		return op[0] == "@"
+
+	def __iter__(self):
+		return iter(sorted(self.operations))
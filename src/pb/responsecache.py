@@ -0,0 +1,215 @@
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+import collections
+import cPickle as pickle
+import suds.sudsobject
+import api
+
+# Converts a suds reply into builtins only (suds classes are generated at run time and can't be pickled)
+def toPlain(value):
+	if isinstance(value, suds.sudsobject.Object):
+		return ("__suds__", value.__class__.__name__, [(name, toPlain(item)) for name, item in value])
+	if isinstance(value, list):
+		return [toPlain(item) for item in value]
+	if isinstance(value, basestring):
+		return unicode(value)
+	return value
+
+def fromPlain(value):
+	if isinstance(value, tuple) and len(value) == 3 and value[0] == "__suds__":
+		obj = suds.sudsobject.Factory.object(value[1])
+		for name, item in value[2]:
+			setattr(obj, name, fromPlain(item))
+		return obj
+	if isinstance(value, list):
+		return [fromPlain(item) for item in value]
+	return value
+
+# Returns the set of resource IDs mentioned by a call's arguments or result (any field named ...Id or ...Ids)
+def resourceIds(value, name = "Id"):
+	ids = set()
+	if isinstance(value, suds.sudsobject.Object):
+		for itemName, item in value:
+			ids |= resourceIds(item, itemName)
+	elif isinstance(value, dict):
+		for itemName, item in value.items():
+			ids |= resourceIds(item, itemName)
+	elif isinstance(value, (list, tuple)):
+		for item in value:
+			ids |= resourceIds(item, name)
+	elif isinstance(value, basestring) and (name.endswith("Id") or name.endswith("Ids")) and value != "":
+		ids.add(unicode(value))
+	return ids
+
+# Read-through cache of API replies, used by API.call when API.cache is set. Replies are kept per scope (API.cacheScope:
+# the account and the endpoint), so that one cache can serve several of them.
+# Only the operations listed in ttls are cached, each for its own number of seconds; at most maxEntries replies are
+# kept in memory, least recently used first out. The other reads (api.API.reads) are neither cached nor invalidate
+# anything. Every other call is a mutation: it invalidates the cached replies that mention any resource ID it was
+# given (the data center, server, storage ... IDs found in the arguments and in the cached replies), as well as the
+# lists in volatile. With a location, replies are also stored on disk so that
+# separate processes share them; invalidations then go through per-ID marker files in the same directory.
+class ResponseCache:
+
+	ttls = {
+		"getAllImages": 300,
+		"getImage": 300,
+		"getAllDataCenters": 30,
+		"getDataCenter": 10,
+		"getAllPublicIpBlocks": 60
+	}
+	volatile = ["getAllDataCenters", "getAllPublicIpBlocks"] # change with almost any mutation (eg dataCenterVersion)
+	maxEntries = 500
+
+	def __init__(self, location = None, ttls = None, maxEntries = None):
+		self.location = location
+		if ttls is not None:
+			self.ttls = dict(ResponseCache.ttls, **ttls)
+		if maxEntries is not None:
+			self.maxEntries = maxEntries
+		self.entries = collections.OrderedDict() # key => (stored, expires, tags, result)
+		self.invalidated = {} # tag => time of the last in-process invalidation
+		self.lock = threading.Lock()
+		self.stats = {"hits": 0, "diskHits": 0, "misses": 0, "stores": 0, "invalidations": 0, "evictions": 0}
+
+	def isCached(self, func):
+		return func in self.ttls
+
+	# Returns the cached result of func(*args) in scope, or None
+	def get(self, func, args, scope = ""):
+		if not self.isCached(func):
+			return None
+		key = self._key(func, args, scope)
+		now = time.time()
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is not None and self._fresh(entry, now):
+				self.entries[key] = entry
+				self.stats["hits"] += 1
+				return entry[3]
+		entry = self._load(key, now)
+		with self.lock:
+			if entry is None:
+				self.stats["misses"] += 1
+				return None
+			self.stats["diskHits"] += 1
+			self._remember(key, entry)
+		return entry[3]
+
+	# Records the result of a read in scope (if func is cached)
+	def put(self, func, args, result, scope = ""):
+		if not self.isCached(func) or result is None:
+			return
+		now = time.time()
+		tags = resourceIds(args) | resourceIds(result) | set(["op:" + func])
+		entry = (now, now + self.ttls[func], tags, result)
+		key = self._key(func, args, scope)
+		with self.lock:
+			self.stats["stores"] += 1
+			self._remember(key, entry)
+		self._save(key, entry)
+
+	# Invalidates what a call of func may have changed (nothing, for a read). Called whether the call succeeded or not:
+	# one that failed on the transport may still have been carried out
+	def wrote(self, func, args):
+		if func not in api.API.reads:
+			self.invalidate(resourceIds(args) | set("op:" + op for op in self.volatile))
+
+	def invalidate(self, tags):
+		now = time.time()
+		with self.lock:
+			# marks older than the longest TTL can't make any entry stale anymore
+			oldest = now - max(self.ttls.values() or [0])
+			for tag in [tag for tag, when in self.invalidated.items() if when < oldest]:
+				del self.invalidated[tag]
+			for tag in tags:
+				self.invalidated[tag] = now
+			for key, entry in self.entries.items():
+				if entry[2] & tags:
+					del self.entries[key]
+					self.stats["invalidations"] += 1
+		if self.location is not None:
+			for tag in tags:
+				self._touch(self._tagFile(tag))
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def _key(self, func, args, scope):
+		return scope + "\0" + func + "\0" + repr(args)
+
+	def _remember(self, key, entry):
+		self.entries[key] = entry
+		while len(self.entries) > self.maxEntries:
+			self.entries.popitem(last = False)
+			self.stats["evictions"] += 1
+
+	# An entry is fresh if it hasn't expired and none of its IDs was invalidated (here or, with a location, anywhere) since it was stored
+	def _fresh(self, entry, now):
+		stored, expires, tags, result = entry
+		if expires <= now:
+			return False
+		for tag in tags:
+			if self.invalidated.get(tag, 0) >= stored:
+				return False
+		if self.location is not None:
+			for tag in tags:
+				try:
+					if os.path.getmtime(self._tagFile(tag)) >= stored:
+						return False
+				except OSError:
+					pass
+		return True
+
+	def _entryFile(self, key):
+		return os.path.join(self.location, "r-" + hashlib.sha1(key).hexdigest())
+
+	def _tagFile(self, tag):
+		return os.path.join(self.location, "t-" + hashlib.sha1(tag.encode("utf-8")).hexdigest())
+
+	def _load(self, key, now):
+		if self.location is None:
+			return None
+		try:
+			stored, expires, tags, plain = pickle.load(open(self._entryFile(key), "rb"))
+		except Exception:
+			return None
+		entry = (stored, expires, tags, None)
+		if not self._fresh(entry, now):
+			return None
+		return (stored, expires, tags, fromPlain(plain))
+
+	def _save(self, key, entry):
+		if self.location is None:
+			return
+		stored, expires, tags, result = entry
+		try:
+			self._makeLocation()
+			# write to a temporary file and rename it, so other processes never read half a file
+			handle, tmpName = tempfile.mkstemp(dir = self.location)
+			tmp = os.fdopen(handle, "wb")
+			pickle.dump((stored, expires, tags, toPlain(result)), tmp, 2)
+			tmp.close()
+			os.rename(tmpName, self._entryFile(key))
+		except (IOError, OSError):
+			pass
+
+	def _touch(self, fileName):
+		try:
+			self._makeLocation()
+			open(fileName, "a").close()
+			os.utime(fileName, None)
+		except (IOError, OSError):
+			pass
+
+	def _makeLocation(self):
+		try:
+			os.makedirs(self.location)
+		except OSError as (err):
+			if err.errno != errno.EEXIST:
+				raise
@@ -0,0 +1,158 @@
+import time
+import random
+import threading
+from suds import WebFault
+from suds.transport import TransportError
+import httppool
+import cassette
+
+# Raised instead of calling the API while the circuit breaker of its endpoint is open
+class CircuitOpen(TransportError):
+
+	def __init__(self, url, seconds):
+		TransportError.__init__(self, "%s failed too often, not calling it for %.0f more seconds" % (url, seconds), None)
+
+# Stops calling an endpoint that keeps failing: after threshold transport failures in a row the circuit opens and
+# every call fails at once, without going to the network; resetTimeout seconds later one call is let through, and
+# the circuit closes again if it succeeds. SOAP faults and authentication failures count as successes: the endpoint
+# answered.
+class CircuitBreaker:
+
+	threshold = 5
+	resetTimeout = 30.0
+
+	def __init__(self, url, threshold = None, resetTimeout = None):
+		self.url = url
+		if threshold is not None:
+			self.threshold = threshold
+		if resetTimeout is not None:
+			self.resetTimeout = resetTimeout
+		self.lock = threading.Lock()
+		self.failures = 0 # in a row
+		self.openedAt = None # time the circuit opened, None while it is closed
+		self.trial = False # a call is testing the endpoint while the circuit is half-open
+		self.stats = {"trips": 0, "rejected": 0, "recoveries": 0}
+
+	# Raises CircuitOpen unless a call may go to the endpoint now; returns True if that call is the trial of a
+	# half-open circuit, whose outcome must then be given to record() (or abandon(), if it has none)
+	def allow(self):
+		with self.lock:
+			if self.openedAt is None:
+				return False
+			wait = self.openedAt + self.resetTimeout - time.time()
+			if wait <= 0 and not self.trial:
+				self.trial = True
+				return True
+			self.stats["rejected"] += 1
+		raise CircuitOpen(self.url, max(wait, 0))
+
+	# Counts the outcome of a call allow() let through: err is None if it succeeded. Errors that are neither an
+	# answer of the endpoint nor a transport failure (eg a reply missing from a cassette) say nothing about it.
+	def record(self, err = None):
+		if err is None or isinstance(err, WebFault) or (isinstance(err, TransportError) and err.httpcode == 401):
+			self.succeeded()
+		elif isinstance(err, TransportError) and not isinstance(err, (CircuitOpen, cassette.Miss)):
+			self.failed()
+		else:
+			self.abandon()
+
+	# Lets another call test the endpoint when the trial call ended without telling anything
+	def abandon(self):
+		with self.lock:
+			self.trial = False
+
+	def succeeded(self):
+		with self.lock:
+			if self.openedAt is not None:
+				self.stats["recoveries"] += 1
+			self.failures, self.openedAt, self.trial = 0, None, False
+
+	def failed(self):
+		with self.lock:
+			self.failures += 1
+			if self.trial or (self.openedAt is None and self.failures >= self.threshold):
+				if self.openedAt is None:
+					self.stats["trips"] += 1
+				self.openedAt, self.trial = time.time(), False
+
+breakers = {} # endpoint URL => its CircuitBreaker, shared by all the API objects of the process
+breakersLock = threading.Lock()
+
+def breakerFor(url):
+	with breakersLock:
+		if url not in breakers:
+			breakers[url] = CircuitBreaker(url)
+		return breakers[url]
+
+# Which failed calls API.call makes again, and when. Reads (API.reads) are retried after any transport error
+# except authentication failures; other operations only when the request surely did not change anything: the
+# connection could not be made (httppool.ConnectError), the server answered 503 or 429, or a SOAP fault whose
+# message contains one of safeFaults. Attempt n+1 waits baseDelay * 2^n seconds (at most maxDelay), spread by
+# +/- jitter so that parallel workers don't retry in lockstep.
+class RetryPolicy:
+
+	retries = 3 # attempts after the first one; 0 disables retrying
+	baseDelay = 0.5
+	maxDelay = 8.0
+	jitter = 0.3
+	readStatus = [None, 408, 429, 500, 502, 503, 504] # None: the connection failed or broke
+	safeStatus = [429, 503]
+	safeFaults = [] # eg, messages of faults the API returns when it is too busy to accept a request
+
+	def __init__(self, retries = None, baseDelay = None, maxDelay = None):
+		if retries is not None:
+			self.retries = max(0, int(retries))
+		if baseDelay is not None:
+			self.baseDelay = baseDelay
+		if maxDelay is not None:
+			self.maxDelay = maxDelay
+		self.lock = threading.Lock()
+		self.stats = {"retries": 0, "recovered": 0, "exhausted": 0}
+
+	def shouldRetry(self, err, read):
+		if isinstance(err, (CircuitOpen, cassette.Miss)):
+			return False
+		if isinstance(err, httppool.ConnectError):
+			return True
+		if isinstance(err, TransportError):
+			return err.httpcode in (self.readStatus if read else self.safeStatus)
+		message = str(err)
+		return any(fault in message for fault in self.safeFaults)
+
+	def delay(self, attempt):
+		return min(self.maxDelay, self.baseDelay * 2 ** attempt) * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+	# Returns fn(), calling it again while it fails in a way worth retrying; breaker (if any) sees every attempt
+	def run(self, fn, read, breaker = None, debug = False):
+		attempt = 0
+		while True:
+			trial = breaker is not None and breaker.allow()
+			try:
+				result = fn()
+			except Exception as (err):
+				if breaker is not None:
+					breaker.record(err)
+				if attempt >= self.retries or not self.shouldRetry(err, read):
+					if attempt > 0:
+						self._count("exhausted")
+					raise
+				wait = self.delay(attempt)
+				attempt += 1
+				self._count("retries")
+				if debug:
+					print "# Retrying in %.1fs (%d/%d) after: %s" % (wait, attempt, self.retries, err)
+				time.sleep(wait)
+				continue
+			except BaseException:
+				if trial:
+					breaker.abandon() # eg Ctrl-C in the shell during the trial call
+				raise
+			if breaker is not None:
+				breaker.record()
+			if attempt > 0:
+				self._count("recovered")
+			return result
+
+	def _count(self, name):
+		with self.lock:
+			self.stats[name] += 1
@@ -0,0 +1,242 @@
+import sys
+import time
+import Queue
+import threading
+from cStringIO import StringIO
+import errorhandler
+
+# Kinds of the resources of a getDataCenter tree: kind => (ID field, name field)
+kinds = {
+	"datacenter": ("dataCenterId", "dataCenterName"),
+	"server": ("serverId", "serverName"),
+	"storage": ("storageId", "storageName"),
+	"loadbalancer": ("loadBalancerId", "loadBalancerName"),
+	"nic": ("nicId", "nicName")
+}
+
+# Lists nested in a tree that hold resources of their own (kept apart, next to their parent): field => kind
+children = {"servers": "server", "storages": "storage", "loadBalancers": "loadbalancer", "nics": "nic"}
+
+# Fields referring to other resources, reduced to the fields saying how they are attached: the referenced resource's
+# own fields (eg the name of a connected storage) change with that resource, not with the one it is attached to
+references = {
+	"connectedStorages": ["storageId", "busType", "deviceNumber", "bootDevice"],
+	"romDrives": ["imageId", "deviceNumber"],
+	"balancedServers": ["serverId", "balancedNicId", "activate"],
+	"mountImage": ["imageId"]
+}
+
+ignored = ["requestId", "dataCenterId", "dataCenterVersion"] # the version is kept by Sync itself
+
+def _items(value):
+	return value.iteritems() if isinstance(value, dict) else iter(value)
+
+def _reference(value, fields):
+	if isinstance(value, list):
+		return [_reference(item, fields) for item in value]
+	if value is None:
+		return None
+	import formatter
+	return dict((name, formatter.toRecord(value[name])) for name in fields if name in value)
+
+# Returns the resources of a getDataCenter reply (suds objects or fastxml Records), the data center included:
+# (kind, ID) => {field: value} with builtins only, so that two versions of a resource compare with ==
+def flatten(dataCenter):
+	import formatter # loads suds, like batch below: only imported once there is something to download
+	resources = {}
+	def add(kind, item):
+		idField = kinds[kind][0]
+		fields = {}
+		for name, value in _items(item):
+			if name in children:
+				for child in value or []:
+					add(children[name], child)
+			elif name in references:
+				fields[name] = _reference(value, references[name])
+			elif name != idField and name not in ignored:
+				fields[name] = formatter.toRecord(value)
+		resources[(kind, str(item[idField]))] = fields
+	add("datacenter", dataCenter)
+	return resources
+
+# A resource that appeared ("added"), disappeared ("removed") or changed ("changed") between two syncs
+class Change:
+
+	def __init__(self, action, kind, id, dataCenterId, old, new):
+		self.action = action
+		self.kind = kind
+		self.id = id
+		self.dataCenterId = dataCenterId
+		self.old = old # fields before (None if added)
+		self.new = new # fields after (None if removed)
+
+	def __repr__(self):
+		return "<%s %s %s>" % (self.action, self.kind, self.id)
+
+	@property
+	def name(self):
+		return (self.new or self.old).get(kinds[self.kind][1])
+
+	# Names of the fields that changed
+	def fields(self):
+		old, new = self.old or {}, self.new or {}
+		return sorted(name for name in set(old) | set(new) if old.get(name) != new.get(name))
+
+	def record(self):
+		record = {"action": self.action, "kind": self.kind, "id": self.id, "dataCenterId": self.dataCenterId, "name": self.name}
+		if self.action == "changed":
+			record["fields"] = dict((name, {"old": self.old.get(name), "new": self.new.get(name)}) for name in self.fields())
+		else:
+			record["resource"] = self.new if self.action == "added" else self.old
+		return record
+
+# Changes of the resources of one data center, from its old resources to its new ones (see flatten)
+def diff(dataCenterId, old, new):
+	changes = []
+	for key in sorted(set(old) | set(new)):
+		if key not in old:
+			changes.append(Change("added", key[0], key[1], dataCenterId, None, new[key]))
+		elif key not in new:
+			changes.append(Change("removed", key[0], key[1], dataCenterId, old[key], None))
+		elif old[key] != new[key]:
+			changes.append(Change("changed", key[0], key[1], dataCenterId, old[key], new[key]))
+	return changes
+
+# What a Sync.refresh found: the changes, and what it cost
+class Delta:
+
+	def __init__(self):
+		self.changes = []
+		self.listed = 0 # data centers in the version list
+		self.fetched = [] # data centers whose tree was downloaded
+		self.errors = {} # data center ID => error of its download (it is tried again at the next refresh)
+		self.pending = [] # data centers left for the next refresh by its limit
+
+	def __iter__(self):
+		return iter(self.changes)
+
+	def __len__(self):
+		return len(self.changes)
+
+	def ofAction(self, action):
+		return [change for change in self.changes if change.action == action]
+
+	def record(self):
+		return {"changes": [change.record() for change in self.changes], "listed": self.listed, "fetched": self.fetched, "errors": self.errors, "pending": self.pending}
+
+# Local copy of the data centers of an account, kept up to date from the cheap version list (getAllDataCenters):
+# a refresh only downloads the trees (getDataCenter) of the data centers whose version changed, and those still
+# provisioning (their resources become AVAILABLE without a new version), on a bounded pool of threads each with its
+# own clone of the API. Replies are never taken from the response cache. Every refresh returns the Delta of what
+# changed since the previous one; the first one returns every resource as added.
+#
+#	sync = pb.sync.Sync(api)
+#	sync.refresh()
+#	for change in sync.refresh():
+#		print change.action, change.kind, change.id, change.fields()
+class Sync:
+
+	parallel = 8
+
+	def __init__(self, api, dcids = None, parallel = None):
+		self.api = api.clone()
+		self.api.cache = None # a cached version list would hide the changes
+		self.only = set(dcids) if dcids is not None else None # the data centers followed (default: all of them)
+		if parallel is not None:
+			self.parallel = max(1, int(parallel))
+		self.versions = {} # data center ID => version of the tree held
+		self.trees = {} # data center ID => its last getDataCenter reply
+		self.resources = {} # data center ID => flatten() of its tree
+		self.fetchedAt = {} # data center ID => time its tree was downloaded
+		self.lock = threading.Lock()
+		self.stats = {"refreshes": 0, "fetched": 0, "unchanged": 0, "errors": 0}
+
+	# Whether the tree of dcid was caught while the data center was provisioning
+	def settling(self, dcid):
+		state = self.resources[dcid][("datacenter", dcid)].get("provisioningState")
+		return state not in (None, "AVAILABLE")
+
+	# Brings the copy up to date and returns the Delta, or None if the version list could not be read (the error
+	# was printed). With dcids, only those data centers are downloaded if they changed, the others keep their old tree.
+	# With limit, at most that many trees are downloaded: those whose version changed first, then those provisioning
+	# that were downloaded the longest ago; the others are left for the next refresh (delta.pending).
+	def refresh(self, dcids = None, limit = None):
+		with self.lock:
+			listing = self.api.getAllDataCenters()
+			if listing is None and errorhandler.last_error.last:
+				return None
+			versions = {}
+			for dataCenter in listing or []:
+				dcid = str(dataCenter.dataCenterId)
+				if self.only is None or dcid in self.only:
+					versions[dcid] = dataCenter["dataCenterVersion"] if "dataCenterVersion" in dataCenter else None
+			delta = Delta()
+			delta.listed = len(versions)
+			for dcid in [dcid for dcid in self.resources if dcid not in versions]:
+				delta.changes.extend(diff(dcid, self.resources.pop(dcid), {}))
+				del self.trees[dcid], self.versions[dcid], self.fetchedAt[dcid]
+			changed = lambda dcid: dcid not in self.resources or versions[dcid] is None or versions[dcid] != self.versions[dcid]
+			stale = sorted(dcid for dcid in versions if (dcids is None or dcid in dcids) and (changed(dcid) or self.settling(dcid)))
+			unchanged = len(versions) - len(stale)
+			if limit is not None and len(stale) > limit:
+				stale.sort(key = lambda dcid: (not changed(dcid), self.fetchedAt.get(dcid, 0)))
+				stale, delta.pending = stale[:limit], sorted(stale[limit:])
+			for dcid, tree in sorted(self.fetch(stale, delta).items()):
+				resources = flatten(tree)
+				delta.changes.extend(diff(dcid, self.resources.get(dcid, {}), resources))
+				self.trees[dcid] = tree
+				self.resources[dcid] = resources
+				self.versions[dcid] = tree["dataCenterVersion"] if "dataCenterVersion" in tree else versions[dcid]
+				self.fetchedAt[dcid] = time.time()
+				delta.fetched.append(dcid)
+			self.stats["refreshes"] += 1
+			self.stats["fetched"] += len(delta.fetched)
+			self.stats["unchanged"] += unchanged
+			self.stats["errors"] += len(delta.errors)
+			return delta
+
+	# Downloads the trees of dcids and returns them by ID; the error of a failed download is kept in delta.errors
+	def fetch(self, dcids, delta):
+		import batch
+		trees = {}
+		if not dcids:
+			return trees
+		queue = Queue.Queue()
+		for dcid in dcids:
+			queue.put(dcid)
+
+		def worker():
+			api = self.api.clone()
+			while True:
+				try:
+					dcid = queue.get_nowait()
+				except Queue.Empty:
+					return
+				buffer = StringIO()
+				self.output.local.buffer = buffer
+				try:
+					tree = api.getDataCenter(dcid)
+					if tree is not None:
+						trees[dcid] = tree
+				except SystemExit:
+					delta.errors[dcid] = buffer.getvalue().strip() or "Error: unknown error"
+					if api.broken:
+						api = self.api.clone()
+				finally:
+					self.output.local.buffer = None
+
+		savedStdout, savedShouldExit = sys.stdout, errorhandler.should_exit_python
+		self.output = batch.threadOutput()
+		errorhandler.should_exit_python = True # a failed download ends with SystemExit, caught per data center
+		try:
+			threads = [threading.Thread(target = worker) for i in range(min(self.parallel, len(dcids)))]
+			for thread in threads:
+				thread.daemon = True
+				thread.start()
+			for thread in threads:
+				while thread.is_alive():
+					thread.join(1)
+		finally:
+			sys.stdout = savedStdout
+			errorhandler.should_exit_python = savedShouldExit
+		return trees
@@ -0,0 +1,406 @@
+import sys
+import json
+import threading
+from cStringIO import StringIO
+import errorhandler
+import batch
+
+#
+# Declarative data centers: a topology file describes a data center, "plan" lists the API calls that would make the
+# live data center look like it, "apply" makes them. Resources are matched by name. Example file (JSON):
+#
+#	{
+#		"dataCenterName": "shop",
+#		"lans": [{"lanId": 1, "internetAccess": true}],
+#		"storages": [{"name": "web-1-disk", "size": 20, "mountImageId": "..."}],
+#		"servers": [{"name": "web-1", "cores": 2, "ram": 2048, "storages": ["web-1-disk"],
+#		             "nics": [{"name": "web-1-lan1", "lanId": 1, "firewall": [{"protocol": "TCP", "port": "80"}]}]}],
+#		"loadBalancers": [{"name": "front", "lanId": 1, "algorithm": "ROUND_ROBIN", "servers": ["web-1"],
+#		                   "firewall": [{"protocol": "TCP", "port": "443"}]}]
+#	}
+#
+# "dataCenterId" may be given instead of (or besides) "dataCenterName"; a data center that can't be found by name is
+# created. Servers take "osType" too, NICs "ip", load balancers "ip", firewall rules "sourceIp", "sourceMac",
+# "targetIp", "icmpType" and "icmpCode" (port is "start" or "start:end"). Resources of the data center that are not
+# in the file are left alone, unless pruned. Firewall rules can only be added.
+#
+
+def _get(item, name, default = None):
+	return item[name] if name in item else default
+
+def _str(value):
+	return str(value) if value is not None else None
+
+def _int(value):
+	return int(value) if value is not None else None
+
+# Comparable form of a firewall rule, from a topology file or from the API
+def ruleKey(rule):
+	if "port" in rule:
+		ports = str(rule["port"]).split(":")
+		start, end = ports[0], ports[-1]
+	else:
+		start, end = _get(rule, "portRangeStart"), _get(rule, "portRangeEnd")
+	protocol = _get(rule, "protocol")
+	return (_str(protocol).upper() if protocol is not None else None, _int(start), _int(end), _str(_get(rule, "sourceIp")), _str(_get(rule, "sourceMac")), _str(_get(rule, "targetIp")), _int(_get(rule, "icmpType")), _int(_get(rule, "icmpCode")))
+
+# The arguments of API.addFirewallRuleToNic and addFirewallRuleToLoadBalancer for a rule of a topology file
+def ruleArgs(rule):
+	protocol, start, end, sourceIp, sourceMac, targetIp, icmpType, icmpCode = ruleKey(rule)
+	args = {}
+	for name, value in (("proto", protocol), ("sip", sourceIp), ("smac", sourceMac), ("dip", targetIp), ("icmptype", icmpType), ("icmpcode", icmpCode)):
+		if value is not None:
+			args[name] = str(value)
+	if start is not None:
+		args["port"] = "%d:%d" % (start, end if end is not None else start)
+	return args
+
+def describeRule(rule):
+	protocol, start, end, sourceIp, sourceMac, targetIp, icmpType, icmpCode = ruleKey(rule)
+	parts = [protocol or "ANY"]
+	if start is not None:
+		parts.append("port %d" % start if end in (None, start) else "ports %d-%d" % (start, end))
+	for label, value in (("from", sourceIp), ("from MAC", sourceMac), ("to", targetIp), ("ICMP type", icmpType), ("ICMP code", icmpCode)):
+		if value is not None:
+			parts.append("%s %s" % (label, value))
+	return " ".join(parts)
+
+# Reads a topology file; returns None (after ArgsError) if it can't be used
+def load(fileName):
+	try:
+		spec = json.load(sys.stdin if fileName in ("", "-") else open(fileName, "r"))
+	except IOError as (err):
+		errorhandler.ArgsError("cannot read %s: %s" % (fileName, err.strerror))
+		return None
+	except ValueError as (err):
+		errorhandler.ArgsError("%s is not valid JSON: %s" % (fileName, err))
+		return None
+	if not isinstance(spec, dict) or not (spec.get("dataCenterName") or spec.get("dataCenterId")):
+		errorhandler.ArgsError("the topology needs a dataCenterName or a dataCenterId")
+		return None
+	for section in ("lans", "storages", "servers", "loadBalancers"):
+		spec.setdefault(section, [])
+	for section, items in (("storages", spec["storages"]), ("servers", spec["servers"]), ("loadBalancers", spec["loadBalancers"]), ("nics", [nic for server in spec["servers"] for nic in server.get("nics", [])])):
+		names = [item.get("name") for item in items]
+		if not all(names) or len(set(names)) != len(names):
+			errorhandler.ArgsError("every item of %s needs a name of its own" % section)
+			return None
+	return spec
+
+# One API call of a plan; it runs once the steps it comes after are done
+class Step:
+
+	def __init__(self, number, action, kind, name, detail, run, after):
+		self.number = number
+		self.action = action # create, update, connect, disconnect, register, deregister, add (a firewall rule), set (internet access), delete
+		self.kind = kind
+		self.name = name
+		self.detail = detail
+		self.run = run # fn(api) => ID of the created resource or None
+		self.after = [step for step in after if step is not None]
+		self.status = "planned" # then done, failed or skipped
+		self.id = None
+		self.error = None
+
+	def record(self):
+		return {"number": self.number, "action": self.action, "resource": self.kind, "name": self.name, "detail": self.detail, "after": [step.number for step in self.after], "status": self.status, "id": self.id, "error": self.error}
+
+# The steps that make the data center of api look like spec, and their execution: steps whose dependencies are
+# done run at the same time on a bounded pool of threads (each with its own clone of the API), so independent
+# branches (eg, two servers with their NICs and storages) don't wait for each other. A step that comes after others
+# first waits for the data center to be AVAILABLE, so that what they created is provisioned.
+class Plan:
+
+	parallel = 8
+	waitTimeout = 600 # seconds a step waits for the provisioning of the steps it comes after
+
+	def __init__(self, api, spec, prune = False):
+		self.api = api
+		self.spec = spec
+		self.prune = prune
+		self.steps = []
+		self.ids = {} # (kind, name) => ID, of live resources and of the ones created by the steps
+		self.created = {} # (kind, name) => step creating the resource
+		self.detaching = {} # storage name => steps disconnecting it from a server
+		self.build()
+
+	def add(self, action, kind, name, detail, run, after = []):
+		step = Step(len(self.steps) + 1, action, kind, name, detail, run, after)
+		self.steps.append(step)
+		return step
+
+	def id(self, kind, name):
+		return self.ids[(kind, name)]
+
+	def dcid(self):
+		return self.id("datacenter", None)
+
+	def liveDataCenter(self):
+		dcid = self.spec.get("dataCenterId")
+		if dcid is None:
+			matches = [dc for dc in (self.api.getAllDataCenters() or []) if _str(_get(dc, "dataCenterName")) == self.spec["dataCenterName"]]
+			if len(matches) > 1:
+				errorhandler.ArgsError("there are %d data centers named %s, use dataCenterId" % (len(matches), self.spec["dataCenterName"]))
+				return None
+			if not matches:
+				return None
+			dcid = str(matches[0].dataCenterId)
+		return self.api.getDataCenter(dcid)
+
+	def build(self):
+		spec = self.spec
+		dataCenter = self.liveDataCenter()
+		if dataCenter is None and spec.get("dataCenterId"):
+			errorhandler.ArgsError("data center %s does not exist" % spec["dataCenterId"])
+			return
+		if dataCenter is None:
+			self.created[("datacenter", None)] = self.add("create", "datacenter", spec["dataCenterName"], "", lambda api: str(api.createDataCenter(spec["dataCenterName"]).dataCenterId))
+			dataCenter = {}
+		else:
+			self.ids[("datacenter", None)] = str(dataCenter.dataCenterId)
+			if spec.get("dataCenterName") and _str(_get(dataCenter, "dataCenterName")) != spec["dataCenterName"]:
+				self.add("update", "datacenter", spec["dataCenterName"], "name %s" % spec["dataCenterName"], lambda api: api.updateDataCenter({"dcid": self.dcid(), "name": spec["dataCenterName"]}) and None)
+		servers = dict((_str(_get(server, "serverName")), server) for server in _get(dataCenter, "servers", []))
+		storages = dict((_str(_get(storage, "storageName")), storage) for storage in _get(dataCenter, "storages", []))
+		loadBalancers = dict((_str(_get(loadBalancer, "loadBalancerName")), loadBalancer) for loadBalancer in _get(dataCenter, "loadBalancers", []))
+		for name, server in servers.items():
+			self.ids[("server", name)] = str(server.serverId)
+		for name, storage in storages.items():
+			self.ids[("storage", name)] = str(storage.storageId)
+		self.lanSteps = {} # LAN ID => steps putting NICs or load balancers in it
+		for storage in spec["storages"]:
+			self.planStorage(storage, storages.get(storage["name"]))
+		for server in spec["servers"]:
+			self.planServer(server, servers.get(server["name"]), storages)
+		for loadBalancer in spec["loadBalancers"]:
+			self.planLoadBalancer(loadBalancer, loadBalancers.get(loadBalancer["name"]))
+		for lan in spec["lans"]:
+			self.planLan(lan, dataCenter)
+		if self.prune:
+			declared = lambda section: set(item["name"] for item in spec[section])
+			for name in sorted(set(servers) - declared("servers")):
+				step = self.add("delete", "server", name, "", lambda api, srvid = self.id("server", name): api.deleteServer(srvid) and None)
+				# deleting the server releases its storages
+				for storage in _get(servers[name], "connectedStorages", []):
+					self.detaching.setdefault(_str(_get(storage, "storageName")), []).append(step)
+			for name in sorted(set(storages) - declared("storages") - set(storage for server in spec["servers"] for storage in server.get("storages", []))):
+				self.add("delete", "storage", name, "", lambda api, stoid = self.id("storage", name): api.deleteStorage(stoid) and None, self.detaching.get(name, []))
+			for name in sorted(set(loadBalancers) - declared("loadBalancers")):
+				self.add("delete", "loadbalancer", name, "", lambda api, bid = str(loadBalancers[name].loadBalancerId): api.deleteLoadBalancer(bid) and None)
+
+	def planStorage(self, storage, live):
+		name = storage["name"]
+		if live is None:
+			args = {"size": storage.get("size"), "name": name}
+			if storage.get("mountImageId"):
+				args["mountimageid"] = storage["mountImageId"]
+			self.created[("storage", name)] = self.add("create", "storage", name, "size %s" % storage.get("size"), lambda api: str(api.createStorage(dict(args, dcid = self.dcid())).storageId), [self.created.get(("datacenter", None))])
+		elif storage.get("size") is not None and _int(_get(live, "size")) != int(storage["size"]):
+			self.add("update", "storage", name, "size %s => %s" % (_get(live, "size"), storage["size"]), lambda api: api.updateStorage({"stoid": self.id("storage", name), "size": storage["size"]}) and None)
+
+	def planServer(self, server, live, storages):
+		name = server["name"]
+		fields = [(field, server[field]) for field in ("cores", "ram", "osType") if server.get(field) is not None]
+		if live is None:
+			args = dict((field.lower(), value) for field, value in fields)
+			args["name"] = name
+			serverStep = self.created[("server", name)] = self.add("create", "server", name, ", ".join("%s %s" % field for field in fields), lambda api: str(api.createServer(dict(args, dcid = self.dcid())).serverId), [self.created.get(("datacenter", None))])
+		else:
+			serverStep = None
+			changed = [(field, value) for field, value in fields if _str(_get(live, field)) != str(value)]
+			if changed:
+				self.add("update", "server", name, ", ".join("%s %s => %s" % (field, _get(live, field), value) for field, value in changed), lambda api: api.updateServer(dict([(field.lower(), value) for field, value in changed], srvid = self.id("server", name))) and None)
+		# storages
+		connected = [str(storage.storageId) for storage in _get(live, "connectedStorages", [])] if live is not None else []
+		for storageName in server.get("storages", []):
+			if ("storage", storageName) not in self.ids and ("storage", storageName) not in self.created:
+				errorhandler.ArgsError("server %s uses storage %s, which is neither in the topology nor in the data center" % (name, storageName))
+				continue
+			if self.ids.get(("storage", storageName)) in connected:
+				continue
+			self.add("connect", "storage", storageName, "to server %s" % name, lambda api, storageName = storageName: api.connectStorageToServer({"stoid": self.id("storage", storageName), "srvid": self.id("server", name), "bus": "VIRTIO"}) and None, [serverStep, self.created.get(("storage", storageName))])
+		if self.prune and live is not None:
+			for storage in _get(live, "connectedStorages", []):
+				if _str(_get(storage, "storageName")) not in server.get("storages", []):
+					step = self.add("disconnect", "storage", _str(_get(storage, "storageName")), "from server %s" % name, lambda api, stoid = str(storage.storageId): api.disconnectStorageFromServer(stoid, self.id("server", name)) and None)
+					self.detaching.setdefault(_str(_get(storage, "storageName")), []).append(step)
+		# NICs
+		nics = dict((_str(_get(nic, "nicName")), nic) for nic in _get(live, "nics", [])) if live is not None else {}
+		for nic in server.get("nics", []):
+			self.planNic(nic, nics.get(nic["name"]), name, serverStep)
+		if self.prune:
+			for nicName in sorted(set(nics) - set(nic["name"] for nic in server.get("nics", []))):
+				self.add("delete", "nic", nicName, "of server %s" % name, lambda api, nicid = str(nics[nicName].nicId): api.deleteNIC(nicid) and None)
+
+	def planNic(self, nic, live, serverName, serverStep):
+		name = nic["name"]
+		lanId = int(nic.get("lanId") or 1)
+		if live is None:
+			args = {"lanid": lanId, "name": name}
+			if nic.get("ip"):
+				args["ip"] = nic["ip"]
+			nicStep = self.add("create", "nic", name, "on server %s in LAN %d" % (serverName, lanId), lambda api: str(api.createNIC(dict(args, srvid = self.id("server", serverName))).nicId), [serverStep])
+			self.lanSteps.setdefault(lanId, []).append(nicStep)
+			rules = []
+		else:
+			nicStep = None
+			self.ids[("nic", name)] = str(live.nicId)
+			changes = {}
+			if _int(_get(live, "lanId")) != lanId:
+				changes["lanid"] = lanId
+			if nic.get("ip") and nic["ip"] not in [str(ip) for ip in _get(live, "ips", [])]:
+				changes["ip"] = nic["ip"]
+			if changes:
+				step = self.add("update", "nic", name, ", ".join("%s %s" % change for change in sorted(changes.items())), lambda api: api.updateNIC(dict(changes, nicid = self.id("nic", name))) and None)
+				self.lanSteps.setdefault(lanId, []).append(step)
+			firewall = _get(live, "firewall")
+			rules = [ruleKey(rule) for rule in _get(firewall, "firewallRules", [])] if firewall is not None else []
+		for rule in nic.get("firewall", []):
+			if ruleKey(rule) not in rules:
+				self.add("add", "firewallrule", name, "%s on NIC %s" % (describeRule(rule), name), lambda api, rule = rule: api.addFirewallRuleToNic(self.id("nic", name), ruleArgs(rule)) and None, [nicStep])
+
+	def planLan(self, lan, dataCenter):
+		lanId = int(lan["lanId"])
+		nics = [nic for server in _get(dataCenter, "servers", []) for nic in _get(server, "nics", []) if _int(_get(nic, "lanId")) == lanId]
+		internetAccess = bool(lan.get("internetAccess"))
+		# the state of a LAN is only known from its NICs; one without any exists once the plan puts something in it
+		if (nics and any(_get(nic, "internetAccess") for nic in nics) != internetAccess) or (not nics and internetAccess and self.lanSteps.get(lanId)):
+			self.add("set", "lan", str(lanId), "internet access %s" % ("on" if internetAccess else "off"), lambda api: api.setInternetAccess(self.dcid(), lanId, internetAccess) and None, self.lanSteps.get(lanId, []) + [self.created.get(("datacenter", None))])
+
+	def planLoadBalancer(self, loadBalancer, live):
+		name = loadBalancer["name"]
+		serverNames = loadBalancer.get("servers", [])
+		serverSteps = [self.created.get(("server", serverName)) for serverName in serverNames]
+		for serverName in serverNames:
+			if ("server", serverName) not in self.ids and ("server", serverName) not in self.created:
+				errorhandler.ArgsError("load balancer %s uses server %s, which is neither in the topology nor in the data center" % (name, serverName))
+				return
+		serverIds = lambda names: ",".join(self.id("server", serverName) for serverName in names)
+		if live is None:
+			args = {"name": name}
+			for field, arg in (("algorithm", "algo"), ("ip", "ip"), ("lanId", "lanid")):
+				if loadBalancer.get(field) is not None:
+					args[arg] = str(loadBalancer[field])
+			def create(api):
+				lbArgs = dict(args, dcid = self.dcid())
+				if serverNames:
+					lbArgs["srvid"] = serverIds(serverNames)
+				return str(api.createLoadBalancer(lbArgs))
+			lbStep = self.add("create", "loadbalancer", name, "with servers %s" % (", ".join(serverNames) or "(none)"), create, serverSteps + [self.created.get(("datacenter", None))])
+			self.lanSteps.setdefault(int(loadBalancer.get("lanId") or 1), []).append(lbStep)
+			rules = []
+		else:
+			lbStep = None
+			self.ids[("loadbalancer", name)] = str(live.loadBalancerId)
+			changes = {}
+			if loadBalancer.get("algorithm") and _str(_get(live, "loadBalancerAlgorithm")) != loadBalancer["algorithm"].upper():
+				changes["algo"] = loadBalancer["algorithm"]
+			if loadBalancer.get("ip") and _str(_get(live, "ip")) != loadBalancer["ip"]:
+				changes["ip"] = loadBalancer["ip"]
+			if changes:
+				self.add("update", "loadbalancer", name, ", ".join("%s %s" % change for change in sorted(changes.items())), lambda api: api.updateLoadBalancer(dict(changes, bid = self.id("loadbalancer", name))) and None)
+			balanced = [_str(_get(server, "serverName")) for server in _get(live, "balancedServers", [])]
+			missing = [serverName for serverName in serverNames if serverName not in balanced]
+			extra = [serverName for serverName in balanced if serverName not in serverNames]
+			if missing:
+				self.add("register", "loadbalancer", name, "servers %s" % ", ".join(missing), lambda api: api.registerServersOnLoadBalancer(serverIds(missing).split(","), self.id("loadbalancer", name)) and None, [self.created.get(("server", serverName)) for serverName in missing])
+			if extra:
+				extraIds = [str(server.serverId) for server in _get(live, "balancedServers", []) if _str(_get(server, "serverName")) in extra]
+				self.add("deregister", "loadbalancer", name, "servers %s" % ", ".join(extra), lambda api: api.deregisterServersOnLoadBalancer(extraIds, self.id("loadbalancer", name)) and None)
+			firewall = _get(live, "firewall")
+			rules = [ruleKey(rule) for rule in _get(firewall, "firewallRules", [])] if firewall is not None else []
+		for rule in loadBalancer.get("firewall", []):
+			if ruleKey(rule) not in rules:
+				self.add("add", "firewallrule", name, "%s on load balancer %s" % (describeRule(rule), name), lambda api, rule = rule: api.addFirewallRuleToLoadBalancer(self.id("loadbalancer", name), ruleArgs(rule)) and None, [lbStep])
+
+	# Runs the steps, each as soon as the ones it comes after are done; the steps after a failed one are skipped
+	def apply(self, parallel = None):
+		parallel = max(1, int(parallel or self.parallel))
+		pending = list(self.steps)
+		ready = threading.Condition()
+
+		# Returns the next step that can run (marking the ones that never will), or None
+		def nextStep():
+			for step in list(pending):
+				failed = [dep for dep in step.after if dep.status in ("failed", "skipped")]
+				if failed:
+					step.status, step.error = "skipped", "after %s, which did not succeed" % ", ".join(str(dep.number) for dep in failed)
+					pending.remove(step)
+					return nextStep()
+				if all(dep.status == "done" for dep in step.after):
+					pending.remove(step)
+					return step
+			return None
+
+		def worker():
+			api = self.api.clone()
+			while True:
+				with ready:
+					step = nextStep()
+					while step is None and pending:
+						ready.wait(1)
+						step = nextStep()
+				if step is None:
+					return
+				self.runStep(api, step)
+				if api.broken:
+					api = self.api.clone()
+				with ready:
+					ready.notify_all()
+
+		savedStdout, savedShouldExit = sys.stdout, errorhandler.should_exit_python
+		self.output = batch.threadOutput()
+		errorhandler.should_exit_python = True # a failed call must end its step (SystemExit is caught per step)
+		try:
+			threads = [threading.Thread(target = worker) for i in range(min(parallel, len(self.steps)))]
+			for thread in threads:
+				thread.daemon = True
+				thread.start()
+			for thread in threads:
+				while thread.is_alive():
+					thread.join(1)
+		finally:
+			sys.stdout = savedStdout
+			errorhandler.should_exit_python = savedShouldExit
+		return self
+
+	def runStep(self, api, step):
+		buffer = StringIO()
+		self.output.local.buffer = buffer
+		try:
+			if step.after:
+				api.waitUntilAvailable([self.dcid()], self.waitTimeout)
+			step.id = step.run(api)
+			if step.action == "create":
+				self.ids[(step.kind, step.name if step.kind != "datacenter" else None)] = step.id
+			step.status = "done"
+		except SystemExit:
+			step.status, step.error = "failed", buffer.getvalue().strip() or "Error: unknown error"
+		except Exception as (err):
+			step.status, step.error = "failed", "Error: %s" % str(err)
+		finally:
+			self.output.local.buffer = None
+
+	def failed(self):
+		return [step for step in self.steps if step.status in ("failed", "skipped")]
+
+# Entry points of the "planTopology" and "applyTopology" operations; return the plan, or None if the file is unusable
+def plan(api, opArgs):
+	spec = load(opArgs.get("file", "-"))
+	if spec is None:
+		return None
+	return Plan(api, spec, (opArgs.get("prune") or "n")[:1].lower() == "y")
+
+def apply(api, opArgs):
+	try:
+		parallel = int(opArgs["parallel"]) if opArgs.get("parallel") else None
+	except ValueError:
+		errorhandler.ArgsError("-parallel must be a number")
+		return None
+	result = plan(api, opArgs)
+	if result is None or errorhandler.last_error.last != 0:
+		return None
+	result.apply(parallel)
+	if (opArgs.get("wait") or "n")[:1].lower() == "y" and ("datacenter", None) in result.ids and not result.failed():
+		api.waitUntilAvailable([result.dcid()])
+	return result
@@ -0,0 +1,171 @@
+import time
+import random
+import errorhandler
+import sync
+
+# Fields whose every change is an event: kind => fields
+states = {
+	"datacenter": ["provisioningState"],
+	"server": ["provisioningState", "virtualMachineState"]
+}
+
+# Fields listing what a resource is attached to or holds: kind => (field, event of an item appearing, of one going)
+members = {
+	"storage": ("serverIds", "attached", "detached"),
+	"nic": ("ips", "ip added", "ip removed")
+}
+
+def _members(fields, name):
+	value = (fields or {}).get(name)
+	if value is None:
+		return []
+	return value if isinstance(value, list) else [value]
+
+# Something that happened to a resource: "added" and "removed" (old and new are its provisioning state), the change of
+# one of its states (eg "virtualMachineState", from old to new), or one of the members events (eg "ip added", new)
+class Event:
+
+	def __init__(self, change, event, old = None, new = None):
+		self.time = time.strftime("%Y-%m-%dT%H:%M:%S")
+		self.kind = change.kind
+		self.id = change.id
+		self.dataCenterId = change.dataCenterId
+		self.name = change.name
+		self.event = event
+		self.old = old
+		self.new = new
+
+	def __repr__(self):
+		return "<%s %s %s>" % (self.event, self.kind, self.id)
+
+	# As a record of RecordFormatter, whose "kind" is "event": the kind of the resource is its "resource"
+	def record(self):
+		return {"time": self.time, "dataCenterId": self.dataCenterId, "resource": self.kind, "id": self.id, "name": self.name, "event": self.event, "old": self.old, "new": self.new}
+
+# Returns the events of a sync.Change; what else changed (eg a rename) is not an event
+def events(change):
+	result = []
+	if change.action == "added":
+		result.append(Event(change, "added", None, change.new.get("provisioningState")))
+	elif change.action == "removed":
+		return [Event(change, "removed", change.old.get("provisioningState"), None)]
+	else:
+		for name in states.get(change.kind, []):
+			if change.old.get(name) != change.new.get(name):
+				result.append(Event(change, name, change.old.get(name), change.new.get(name)))
+	if change.kind in members:
+		name, appeared, went = members[change.kind]
+		old, new = _members(change.old, name), _members(change.new, name)
+		result.extend(Event(change, appeared, None, item) for item in new if item not in old)
+		result.extend(Event(change, went, item, None) for item in old if item not in new)
+	return result
+
+# Follows data centers (default: all of them) and reports the events of their resources as they happen. Every poll
+# reads the version list and downloads the data centers that changed or are still provisioning (see sync.Sync), within
+# a budget of calls per second shared by all of them: a poll that made n calls waits n / budget seconds before the
+# next one, and downloads at most as many data centers as the budget allows in pollMax seconds. Polls start every
+# pollMin seconds and slow down (up to every pollMax seconds, see api.API) while nothing changes. The first download
+# of the data centers is what the events are reported against; it is paged and paced the same way, and the data
+# centers of a page that change while the next pages are downloaded report their events as soon as paging ends.
+#
+#	for event in pb.watch.Watch(api, [dcid]).events(timeout = 600):
+#		print event.kind, event.id, event.event, event.old, event.new
+class Watch:
+
+	budget = 2.0 # calls per second
+
+	def __init__(self, api, dcids = None, budget = None):
+		self.api = api
+		self.dcids = dcids
+		if budget is not None:
+			self.budget = budget
+		self.sync = sync.Sync(api, dcids)
+		self.interval = api.pollMin
+		self.stats = {"polls": 0, "calls": 0, "events": 0}
+
+	# Most data centers a poll downloads, so that no poll has to wait longer than pollMax for the budget
+	def limit(self):
+		return max(1, int(self.budget * self.api.pollMax) - 1)
+
+	# Downloads the data centers as they are now, limit() of them at a time within the budget; returns (events of the
+	# data centers held already that changed while the later pages were downloaded, calls made by the last page), or
+	# None if they could not be read (the error was printed)
+	def start(self):
+		found = []
+		while True:
+			held = set(self.sync.resources)
+			delta = self.sync.refresh(limit = self.limit())
+			if delta is None:
+				return None
+			found.extend(event for change in delta if change.dataCenterId in held for event in events(change))
+			calls = 1 + len(delta.fetched) + len(delta.errors)
+			self.stats["calls"] += calls
+			if not delta.pending:
+				break
+			time.sleep(calls / self.budget)
+		for dcid in self.dcids or []:
+			if dcid not in self.sync.resources and dcid not in delta.errors:
+				print "Error: No data center %s" % dcid
+				errorhandler.exit(3)
+				return None
+		self.stats["events"] += len(found)
+		return found, calls
+
+	# Returns (events, calls made) of one poll, or None if the version list could not be read (the error was printed)
+	def poll(self):
+		delta = self.sync.refresh(limit = self.limit())
+		if delta is None:
+			return None
+		found = [event for change in delta for event in events(change)]
+		if delta.changes or delta.pending or any(self.sync.settling(dcid) for dcid in self.sync.resources):
+			self.interval = self.api.pollMin
+		else:
+			self.interval = min(self.interval * self.api.pollBackoff, self.api.pollMax)
+		calls = 1 + len(delta.fetched) + len(delta.errors)
+		self.stats["polls"] += 1
+		self.stats["calls"] += calls
+		self.stats["events"] += len(found)
+		return found, calls
+
+	# Yields the events until timeout seconds have passed, count events were yielded or the data centers given were
+	# all deleted (without any of these, until the version list can't be read)
+	def events(self, timeout = None, count = None):
+		deadline = time.time() + timeout if timeout is not None else None
+		started = self.start()
+		if started is None:
+			return
+		found, calls = started
+		yielded = 0
+		while True:
+			for event in found:
+				yield event
+				yielded += 1
+				if count is not None and yielded >= count:
+					return
+			if (deadline is not None and time.time() >= deadline) or (self.dcids and not self.sync.resources):
+				return
+			wait = max(self.interval * random.uniform(1 - self.api.pollJitter, 1 + self.api.pollJitter), calls / self.budget)
+			if deadline is not None:
+				wait = min(wait, deadline - time.time())
+				if wait < 0:
+					return
+			time.sleep(wait)
+			polled = self.poll()
+			if polled is None:
+				return
+			found, calls = polled
+
+# Entry point of the "watchDataCenter" operation: the events of the data centers of -dcid (default: all of them)
+def watchDataCenter(api, opArgs):
+	try:
+		budget = float(opArgs["budget"]) if opArgs.get("budget") else None
+		timeout = float(opArgs["timeout"]) if opArgs.get("timeout") else None
+		count = int(opArgs["count"]) if opArgs.get("count") else None
+	except ValueError:
+		errorhandler.ArgsError("-budget, -timeout and -count must be numbers")
+		return []
+	if budget is not None and budget <= 0:
+		errorhandler.ArgsError("-budget must be more than 0")
+		return []
+	dcids = [dcid for dcid in opArgs["dcid"].split(",") if dcid] if opArgs.get("dcid") else None
+	return Watch(api, dcids, budget).events(timeout, count)
@@ -0,0 +1,65 @@
+import os
+import time
+import hashlib
+import urllib2
+import suds
+import suds.cache
+from cachedir import userCacheDir
+
+# Bump whenever the layout of the cache directory changes, so old caches are simply ignored
+cacheVersion = "1"
+
+# Returns the "file://" URL of a local WSDL file, so suds can read it without any network access
+def localWsdlUrl(path):
+	path = os.path.abspath(os.path.expanduser(path))
+	return "file://" + urllib2.quote(path.replace("\\", "/"))
+
+def _sha1(data):
+	return hashlib.sha1(data).hexdigest()
+
+# Persistent cache of the parsed service definition (the pickled suds Definitions and schemas).
+# Entries live in <cache dir>/wsdl-<cacheVersion>/suds-<suds version>/<sha1(url + content hash)>, so a new
+# WSDL, a new suds or a new cache layout each get a fresh directory instead of unpickling stale objects.
+# The content hash of a local file is computed on every start (it is cheap); the one of a remote WSDL is
+# remembered in a small ".ref" file and revalidated with a plain download (no parsing) every revalidateDays. A
+# caller that already knows the content hash (eg, of a WSDL replayed from a cassette) passes it as digest.
+class WsdlCache(suds.cache.ObjectCache):
+
+	revalidateDays = 7
+
+	def __init__(self, url, location = None, revalidateDays = None, digest = None):
+		self.url = url
+		if revalidateDays is not None:
+			self.revalidateDays = revalidateDays
+		self.root = os.path.join(location or userCacheDir(), "wsdl-" + cacheVersion, "suds-" + suds.__version__)
+		suds.cache.ObjectCache.__init__(self, os.path.join(self.root, _sha1(url + "\n" + (digest or self.contentHash()))))
+
+	def contentHash(self):
+		if self.url.startswith("file://"):
+			try:
+				return _sha1(open(urllib2.unquote(self.url[len("file://"):]), "rb").read())
+			except IOError:
+				return "missing"
+		refFile = os.path.join(self.root, _sha1(self.url) + ".ref")
+		try:
+			if time.time() - os.path.getmtime(refFile) < self.revalidateDays * 86400:
+				return open(refFile, "r").read().strip()
+		except (IOError, OSError):
+			pass
+		try:
+			digest = _sha1(urllib2.urlopen(self.url).read())
+		except Exception:
+			# can't tell whether it changed, keep using what we have (suds will report real connection errors)
+			try:
+				return open(refFile, "r").read().strip()
+			except IOError:
+				return "unknown"
+		try:
+			if not os.path.isdir(self.root):
+				os.makedirs(self.root)
+			ref = open(refFile, "w")
+			ref.write(digest)
+			ref.close()
+		except (IOError, OSError):
+			pass
+		return digest
@@ -16,13 +16,12 @@
 # limitations under the License.
 #
 
+import os
 import sys
-import logging
-logging.basicConfig(level=logging.INFO)
+import atexit
 
-import pb.api
-import pb.formatter
 import pb.argsparser
+import pb.errorhandler
 import pb.helper
 
 ## Parse arguments
@@ -30,6 +29,13 @@ import pb.helper
 argsParser = pb.argsparser.ArgsParser()
 argsParser.readUserArgs(sys.argv)
 
+# pbapi.py -daemon serves the operations of the other invocations until it is stopped
+
+if argsParser.baseArgs["daemon"]:
+	import pb.daemon
+	pb.daemon.serve()
+	sys.exit(0)
+
 # Make sure we have an operation
 
 requestedOp = argsParser.getRequestedOperation()
@@ -51,14 +57,89 @@ if requestedOp[0] == "@":
 if not argsParser.isAuthenticated():
 	pb.errorhandler.ArgsError("Missing authentication")
 
-formatter = pb.formatter.Formatter()
-if argsParser.baseArgs["s"]:
-	formatter.shortFormat()
+# hand the operation to the daemon if one is running: its API clients are ready (see pb/daemon.py)
+
+import pb.daemon
+
+if pb.daemon.mayForward(requestedOp, argsParser):
+	exitCode = pb.daemon.forward(requestedOp, argsParser)
+	if exitCode is not None:
+		sys.exit(exitCode)
+
+# only now load the SOAP client (suds) and logging: the cases above must answer without waiting for them
+
+import logging
+logging.basicConfig(level=logging.INFO)
+
+import pb.api
+import pb.fastxml
+import pb.retry
+import pb.ratelimit
+import pb.metrics
+import pb.cassette
+import pb.formatter
+import pb.responsecache
+import pb.wsdlcache
+
+formatter = pb.formatter.forArgs(argsParser.baseArgs)
+
+if argsParser.baseArgs["cache"]:
+	pb.api.API.cache = pb.responsecache.ResponseCache(os.path.join(pb.wsdlcache.userCacheDir(), "responses"))
+
+if argsParser.baseArgs["retries"] is not None:
+	pb.api.API.retryPolicy = pb.retry.RetryPolicy(argsParser.baseArgs["retries"])
+
+if argsParser.baseArgs["rate"]:
+	try:
+		pb.api.API.rateLimiter = pb.ratelimit.forRate(argsParser.baseArgs["rate"])
+	except ValueError:
+		pb.errorhandler.ArgsError("-rate must be R or R:W (reads and writes per second)")
+
+if argsParser.baseArgs["fast"]:
+	pb.api.API.fastDecode = pb.fastxml.defaultOperations
+
+if argsParser.baseArgs["record"] and argsParser.baseArgs["replay"]:
+	pb.errorhandler.ArgsError("-record and -replay cannot be used together")
+if argsParser.baseArgs["record"] or argsParser.baseArgs["replay"]:
+	try:
+		if argsParser.baseArgs["record"]:
+			pb.api.API.cassette = pb.cassette.Cassette(argsParser.baseArgs["record"], "record")
+		else:
+			pb.api.API.cassette = pb.cassette.Cassette(argsParser.baseArgs["replay"], "replay", latency = argsParser.baseArgs["replaylatency"])
+	except (IOError, ValueError) as (err):
+		pb.errorhandler.ArgsError("cannot use the cassette: %s" % err)
+
+# the metrics are written at exit, also when the operation failed
+if argsParser.baseArgs["stats"] or argsParser.baseArgs["statsfile"]:
+	metrics = pb.api.API.metrics = pb.metrics.Metrics()
+	formatter = pb.metrics.TimedFormatter(formatter, metrics)
+	def writeStats():
+		if argsParser.baseArgs["stats"]:
+			sys.stdout.flush()
+			sys.stderr.write(metrics.summary() + "\n")
+		if argsParser.baseArgs["statsfile"]:
+			try:
+				metrics.write(argsParser.baseArgs["statsfile"])
+			except (IOError, OSError) as (err):
+				sys.stderr.write("Error: cannot write %s: %s\n" % (argsParser.baseArgs["statsfile"], err))
+	atexit.register(writeStats)
 
-api = pb.api.API(argsParser.baseArgs["u"], argsParser.baseArgs["p"], debug = argsParser.baseArgs["debug"])
+api = pb.api.API(argsParser.baseArgs["u"], argsParser.baseArgs["p"], debug = argsParser.baseArgs["debug"], wsdl = argsParser.baseArgs["wsdl"], url = argsParser.baseArgs["url"])
 
 pb.argsparser.ArgsParser.operations[requestedOp]["lambda"](formatter, api, argsParser.opArgs)
-if not argsParser.baseArgs["s"]:
+formatter.end()
+if not argsParser.baseArgs["s"] and argsParser.baseArgs["o"] is None and requestedOp not in ("batch", "watchDataCenter"): # each of their calls has its own ID
 	print ""
 	print "Request ID:", str(api.requestId) if api.requestId is not None else "(none)"
+if argsParser.baseArgs["debug"]:
+	print "# Connections:", api.transport.stats
+	print "# Shared calls:", api.sharedCalls.stats
+	print "# Retries:", api.retryPolicy.stats
+	print "# Circuit breaker:", api.breaker.stats
+	if api.rateLimiter is not None:
+		print "# Rate limiter:", api.rateLimiter.stats
+	if api.cache is not None:
+		print "# Cache:", api.cache.stats
+	if api.cassette is not None:
+		print "# Cassette:", api.cassette.stats
 
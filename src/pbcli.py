@@ -3,15 +3,19 @@
 import readline
 import sys
 import re
-import time
 import platform
 import os
 import shlex
 import pb.api
+import pb.fastxml
 import pb.argsparser
 import pb.helper
 import pb.formatter
 import pb.errorhandler
+import pb.responsecache
+import pb.wsdlcache
+import pb.ratelimit
+import pb.metrics
 
 pb.errorhandler.should_exit_python = False
 
@@ -20,15 +24,18 @@ class Shell:
 	version = '0.1'
 
 	cmds_internal = {}
-	cmds_api = pb.argsparser.ArgsParser().operations
 	tbold = '\033[1m'
 	treset = '\033[0;0m'
 
 	default_dc = None
 	wait = True
+	rate = None # -rate (or PB_RATE) of the rate limiter in use
 
 	def __init__(self):
 		this = self
+		self.apiPool = pb.api.APIPool()
+		pb.api.API.metrics = pb.metrics.Metrics() # for the whole session, see do_stats
+		self.formatter = pb.formatter.Formatter()
 		self.cmds_internal = {
 			'help': lambda args: this.do_help(),
 			'use': lambda args: this.do_use(args),
@@ -38,6 +45,11 @@ class Shell:
 			'bye': lambda args: this.do_exit(),
 			'wait': lambda args: this.do_wait(),
 			'nowait': lambda args: this.do_nowait(),
+			'cache': lambda args: this.do_cache(),
+			'nocache': lambda args: this.do_nocache(),
+			'fast': lambda args: this.do_fast(),
+			'nofast': lambda args: this.do_nofast(),
+			'stats': lambda args: this.do_stats(args),
 			'about': lambda args: this.do_about()
 		}
 
@@ -46,17 +58,15 @@ class Shell:
 
 	def completer(self):
 		this = self
+		registry = pb.argsparser.ArgsParser.registry
+		for cmd in this.cmds_internal:
+			registry.addCompletion(cmd)
 		
+		# readline asks for the matches one state at a time, the trie is only walked for the first one
 		def inner_completer(text, state):
-			text = text.replace('-', '').lower()
-			matches = []
-			for cmd in this.cmds_internal:
-				if cmd.replace('-', '').lower().startswith(text):
-					matches.append(cmd)
-			for cmd in this.cmds_api:
-				if cmd.replace('-', '').lower().startswith(text):
-					matches.append(cmd)
-			return pb.helper.Helper.camelCaseToDash(matches[state]) + ' ' if state < len(matches) else None
+			if state == 0:
+				this.matches = registry.complete(text)
+			return this.matches[state] + ' ' if state < len(this.matches) else None
 		
 		return inner_completer
 
@@ -75,42 +85,71 @@ class Shell:
 			text = '-dcid ' + self.default_dc + ' ' + text
 			args = shlex.split(text)
 		
-		for c in self.cmds_api:
-			if c.replace('-', '').replace('@', '').lower() == cmd.replace('-', '').replace('@', '').lower():
-				if c == 'deleteDataCenter' and self.default_dc is not None:
-					print 'Data center ' + self.default_dc + ' is in use. You may not perform data center deletion operations. Type \'use\' to reset and try again\n'
-					return
-				args.insert(0, 'dummy') # equivalent of argv[0]
-				argsParser = pb.argsparser.ArgsParser()
-				argsParser.readUserArgs(args)
-				requestedOp = argsParser.getRequestedOperation()
-				if requestedOp[0] == '@':
-					helper = pb.helper.Helper()
-					pb.argsparser.ArgsParser.operations[requestedOp]['lambda'](helper)
-					return
-				if not argsParser.isAuthenticated():
-					print 'Missing authentication'
-					return
-				formatter = pb.formatter.Formatter()
-				if argsParser.baseArgs['s']:
-					formatter.shortFormat()
-				api = pb.api.API(argsParser.baseArgs['u'], argsParser.baseArgs['p'], debug = argsParser.baseArgs['debug'])
-				if pb.errorhandler.last_error() != 0:
-					return
-				pb.argsparser.ArgsParser.operations[requestedOp]['lambda'](formatter, api, argsParser.opArgs)
-				if pb.errorhandler.last_error() != 0:
-					return
-				while self.wait and self.default_dc is not None:
-					if self.default_dc_state(api) == 'AVAILABLE' or pb.errorhandler.last_error != 0:
-						break
-					sys.stdout.write('.')
-					sys.stdout.flush()
-					time.sleep(1)
-				print '-'
+		c = pb.argsparser.ArgsParser.registry.lookup(cmd.replace('@', ''))
+		if c is None:
+			return
+		if c == 'deleteDataCenter' and self.default_dc is not None:
+			print 'Data center ' + self.default_dc + ' is in use. You may not perform data center deletion operations. Type \'use\' to reset and try again\n'
+			return
+		args.insert(0, 'dummy') # equivalent of argv[0]
+		argsParser = pb.argsparser.ArgsParser()
+		argsParser.readUserArgs(args)
+		requestedOp = argsParser.getRequestedOperation()
+		if pb.errorhandler.last_error() != 0:
+			return
+		if requestedOp[0] == '@':
+			helper = pb.helper.Helper()
+			pb.argsparser.ArgsParser.operations[requestedOp]['lambda'](helper)
+			return
+		if not argsParser.isAuthenticated():
+			print 'Missing authentication'
+			return
+		if argsParser.baseArgs['rate'] != self.rate:
+			try:
+				pb.api.API.rateLimiter = pb.ratelimit.forRate(argsParser.baseArgs['rate']) if argsParser.baseArgs['rate'] else None
+				self.rate = argsParser.baseArgs['rate']
+			except ValueError:
+				print '-rate must be R or R:W (reads and writes per second)'
 				return
+		if argsParser.baseArgs['o'] is not None:
+			formatter = pb.formatter.RecordFormatter(argsParser.baseArgs['o'])
+		else:
+			formatter = self.formatter
+			formatter.indentValue = 0
+			if argsParser.baseArgs['s']:
+				formatter.shortFormat()
+			else:
+				formatter.longFormat()
+		formatter = pb.metrics.TimedFormatter(formatter, pb.api.API.metrics)
+		api = self.apiPool.get(argsParser.baseArgs['u'], argsParser.baseArgs['p'], debug = argsParser.baseArgs['debug'], wsdl = argsParser.baseArgs['wsdl'], url = argsParser.baseArgs['url'])
+		if pb.errorhandler.last_error() != 0:
+			return
+		pb.argsparser.ArgsParser.operations[requestedOp]['lambda'](formatter, api, argsParser.opArgs)
+		formatter.end()
+		failed = pb.errorhandler.last_error() != 0
+		if not failed and self.wait and self.default_dc is not None:
+			api.waitUntilAvailable([self.default_dc], progress = lambda states: self.show_progress())
+			pb.errorhandler.last_error() # a timeout has been reported already, it must not fail the next command
+		self.write_stats(argsParser.baseArgs)
+		if not failed:
+			print '-'
+		return
+
+	# -stats prints the metrics of the session after the command; -stats-file (or PB_STATS_FILE) rewrites the file
+	def write_stats(self, baseArgs):
+		if baseArgs['stats']:
+			print pb.api.API.metrics.summary()
+		if baseArgs['statsfile']:
+			try:
+				pb.api.API.metrics.write(baseArgs['statsfile'])
+			except (IOError, OSError) as (err):
+				print 'Cannot write %s: %s' % (baseArgs['statsfile'], err)
+				return False
+		return True
 
-	def default_dc_state(self, api):
-		return api.getDataCenterState(self.default_dc);
+	def show_progress(self):
+		sys.stdout.write('.')
+		sys.stdout.flush()
 
 	def start(self):
 		readline.set_completer(self.completer())
@@ -154,5 +193,29 @@ class Shell:
 		print 'Operations will no longer wait for data center to become available'
 		self.wait = False
 
+	def do_cache(self):
+		if pb.api.API.cache is None:
+			pb.api.API.cache = pb.responsecache.ResponseCache(os.path.join(pb.wsdlcache.userCacheDir(), 'responses'))
+		print 'Read operations will use cached replies while they are fresh; ' + ', '.join('%s: %s' % item for item in sorted(pb.api.API.cache.stats.items()))
+
+	def do_nocache(self):
+		print 'Read operations will no longer use cached replies'
+		pb.api.API.cache = None
+
+	def do_fast(self):
+		print 'Replies of ' + ', '.join(pb.fastxml.defaultOperations) + ' will be decoded without suds'
+		pb.api.API.fastDecode = pb.fastxml.defaultOperations
+
+	def do_nofast(self):
+		print 'Replies will be decoded by suds again'
+		pb.api.API.fastDecode = []
+
+	def do_stats(self, args):
+		if len(args) > 0:
+			if self.write_stats({'stats': False, 'statsfile': args[0]}):
+				print 'Metrics written to ' + args[0]
+		else:
+			print pb.api.API.metrics.summary()
+
 Shell().start()
 
@@ -0,0 +1,779 @@
+#!/usr/bin/python
+
+#
+# Local stand-in for the ProfitBricks 1.1 SOAP API, for tests and benchmarks that can't use the real one.
+#
+# It serves a WSDL (at /1.1/wsdl) describing the operations pb.api.API uses and implements them on an in-memory
+# model of data centers, servers, storages, NICs, load balancers, images and public IP blocks. Every change puts the
+# touched resources and their data center INPROCESS for a while, like the real API, and latency and errors can be
+# injected. Point the tools at it with PB_API_URL (or pbapi.py -url):
+#
+#	test/standin.py -port 8080 -latency 50 &
+#	PB_API_URL=http://127.0.0.1:8080/1.1/wsdl src/pbapi.py -u any -p any create-datacenter -name test
+#
+# usage: standin.py [-port N] [-latency ms] [-jitter ms] [-fault-rate 0..1] [-error-rate 0..1]
+#                   [-provisioning seconds] [-auth user:password] [-seed servers] [-dump-wsdl file]
+#
+
+import re
+import sys
+import time
+import uuid
+import random
+import base64
+import socket
+import threading
+import SocketServer
+import BaseHTTPServer
+import xml.etree.cElementTree as etree
+from xml.sax.saxutils import escape
+
+namespace = "http://ws.api.profitbricks.com/"
+
+# Complex types of the service: name => [(field, type), ...]; a type ending with * is a list; string, int,
+# boolean and dateTime are XML schema types, everything else is one of these
+types = {
+	"versionResponse": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterVersion", "int")],
+	"createServerReturn": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterVersion", "int"), ("serverId", "string")],
+	"createStorageReturn": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterVersion", "int"), ("storageId", "string")],
+	"createNicReturn": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterVersion", "int"), ("nicId", "string")],
+	"createLbReturn": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterVersion", "int"), ("loadBalancerId", "string")],
+	"dataCenterIdentifier": [("dataCenterId", "string"), ("dataCenterName", "string"), ("dataCenterVersion", "int")],
+	"dataCenter": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterName", "string"), ("servers", "server*"), ("storages", "storage*"), ("loadBalancers", "loadBalancer*"), ("provisioningState", "string"), ("dataCenterVersion", "int")],
+	"server": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterVersion", "int"), ("serverId", "string"), ("serverName", "string"), ("cores", "int"), ("ram", "int"), ("internetAccess", "boolean"), ("ips", "string*"), ("connectedStorages", "connectedStorage*"), ("romDrives", "romDrive*"), ("nics", "nic*"), ("provisioningState", "string"), ("virtualMachineState", "string"), ("creationTime", "dateTime"), ("lastModificationTime", "dateTime"), ("osType", "string")],
+	"connectedStorage": [("bootDevice", "boolean"), ("busType", "string"), ("deviceNumber", "int"), ("size", "int"), ("storageId", "string"), ("storageName", "string")],
+	"romDrive": [("imageId", "string"), ("imageName", "string"), ("deviceNumber", "int")],
+	"storage": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterVersion", "int"), ("storageId", "string"), ("size", "int"), ("storageName", "string"), ("mountImage", "imageIdentifier"), ("serverIds", "string*"), ("provisioningState", "string"), ("creationTime", "dateTime"), ("lastModificationTime", "dateTime"), ("osType", "string")],
+	"imageIdentifier": [("imageId", "string"), ("imageName", "string")],
+	"nic": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterVersion", "int"), ("nicId", "string"), ("nicName", "string"), ("lanId", "int"), ("internetAccess", "boolean"), ("serverId", "string"), ("ips", "string*"), ("macAddress", "string"), ("firewall", "firewall"), ("provisioningState", "string")],
+	"firewall": [("active", "boolean"), ("firewallId", "string"), ("firewallRules", "firewallRule*"), ("nicId", "string"), ("provisioningState", "string")],
+	"firewallRule": [("firewallRuleId", "string"), ("icmpCode", "int"), ("icmpType", "int"), ("portRangeEnd", "int"), ("portRangeStart", "int"), ("protocol", "string"), ("sourceIp", "string"), ("sourceMac", "string"), ("targetIp", "string")],
+	"loadBalancer": [("requestId", "string"), ("dataCenterId", "string"), ("dataCenterVersion", "int"), ("loadBalancerId", "string"), ("loadBalancerName", "string"), ("loadBalancerAlgorithm", "string"), ("ip", "string"), ("lanId", "int"), ("balancedServers", "balancedServer*"), ("firewall", "firewall"), ("provisioningState", "string"), ("creationTime", "dateTime"), ("lastModificationTime", "dateTime")],
+	"balancedServer": [("activate", "boolean"), ("balancedNicId", "string"), ("serverId", "string"), ("serverName", "string")],
+	"image": [("imageId", "string"), ("imageName", "string"), ("imageSize", "int"), ("imageType", "string"), ("writeable", "boolean"), ("cpuHotpluggable", "boolean"), ("memoryHotpluggable", "boolean"), ("serverIds", "string*"), ("osType", "string")],
+	"ipBlock": [("blockId", "string"), ("publicIps", "publicIp*")],
+	"publicIp": [("ip", "string"), ("nicId", "string")],
+	"reservedIpBlock": [("requestId", "string"), ("blockId", "string"), ("ips", "string*")],
+	"updateDcRequest": [("dataCenterId", "string"), ("dataCenterName", "string")],
+	"createServerRequest": [("dataCenterId", "string"), ("serverName", "string"), ("cores", "int"), ("ram", "int"), ("internetAccess", "boolean"), ("bootFromImageId", "string"), ("bootFromStorageId", "string"), ("lanId", "int"), ("osType", "string")],
+	"updateServerRequest": [("serverId", "string"), ("serverName", "string"), ("cores", "int"), ("ram", "int"), ("bootFromImageId", "string"), ("bootFromStorageId", "string"), ("osType", "string")],
+	"createStorageRequest": [("dataCenterId", "string"), ("storageName", "string"), ("size", "int"), ("mountImageId", "string")],
+	"connectStorageRequest": [("storageId", "string"), ("serverId", "string"), ("busType", "string"), ("deviceNumber", "int")],
+	"updateStorageRequest": [("storageId", "string"), ("storageName", "string"), ("size", "int"), ("mountImageId", "string")],
+	"createLbRequest": [("dataCenterId", "string"), ("loadBalancerName", "string"), ("loadBalancerAlgorithm", "string"), ("ip", "string"), ("lanId", "int"), ("serverIds", "string*")],
+	"updateLbRequest": [("loadBalancerId", "string"), ("loadBalancerName", "string"), ("loadBalancerAlgorithm", "string"), ("ip", "string")],
+	"addRomDriveRequest": [("imageId", "string"), ("serverId", "string"), ("deviceNumber", "int")],
+	"nicRequest": [("nicId", "string"), ("serverId", "string"), ("lanId", "int"), ("nicName", "string"), ("ip", "string")],
+	"firewallRuleRequest": [("sourceMac", "string"), ("sourceIp", "string"), ("targetIp", "string"), ("icmpType", "int"), ("icmpCode", "int"), ("protocol", "string"), ("portRangeStart", "int"), ("portRangeEnd", "int")]
+}
+
+# Operations: name => ([(parameter, type), ...], return type or None), in the parameter order pb.api.API uses
+operations = {
+	"getAllDataCenters": ([], "dataCenterIdentifier*"),
+	"getDataCenter": ([("dataCenterId", "string")], "dataCenter"),
+	"getDataCenterState": ([("dataCenterId", "string")], "string"),
+	"createDataCenter": ([("dataCenterName", "string")], "versionResponse"),
+	"updateDataCenter": ([("request", "updateDcRequest")], "versionResponse"),
+	"clearDataCenter": ([("dataCenterId", "string")], "versionResponse"),
+	"deleteDataCenter": ([("dataCenterId", "string")], "versionResponse"),
+	"createServer": ([("request", "createServerRequest")], "createServerReturn"),
+	"getServer": ([("serverId", "string")], "server"),
+	"rebootServer": ([("serverId", "string")], "versionResponse"),
+	"updateServer": ([("request", "updateServerRequest")], "versionResponse"),
+	"deleteServer": ([("serverId", "string")], "versionResponse"),
+	"createStorage": ([("request", "createStorageRequest")], "createStorageReturn"),
+	"getStorage": ([("storageId", "string")], "storage"),
+	"connectStorageToServer": ([("request", "connectStorageRequest")], "versionResponse"),
+	"disconnectStorageFromServer": ([("storageId", "string"), ("serverId", "string")], "versionResponse"),
+	"updateStorage": ([("request", "updateStorageRequest")], "versionResponse"),
+	"deleteStorage": ([("storageId", "string")], "versionResponse"),
+	"createLoadBalancer": ([("request", "createLbRequest")], "createLbReturn"),
+	"getLoadBalancer": ([("loadBalancerId", "string")], "loadBalancer"),
+	"updateLoadBalancer": ([("request", "updateLbRequest")], "versionResponse"),
+	"registerServersOnLoadBalancer": ([("serverIds", "string*"), ("loadBalancerId", "string")], "loadBalancer"),
+	"deregisterServersOnLoadBalancer": ([("serverIds", "string*"), ("loadBalancerId", "string")], "versionResponse"),
+	"activateLoadBalancingOnServers": ([("serverIds", "string*"), ("loadBalancerId", "string")], "versionResponse"),
+	"deactivateLoadBalancingOnServers": ([("serverIds", "string*"), ("loadBalancerId", "string")], "versionResponse"),
+	"deleteLoadBalancer": ([("loadBalancerId", "string")], "versionResponse"),
+	"addRomDriveToServer": ([("request", "addRomDriveRequest")], "versionResponse"),
+	"removeRomDriveFromServer": ([("imageId", "string"), ("serverId", "string")], "versionResponse"),
+	"setImageOsType": ([("imageId", "string"), ("osType", "string")], "versionResponse"),
+	"getImage": ([("imageId", "string")], "image"),
+	"getAllImages": ([], "image*"),
+	"deleteImage": ([("imageId", "string")], "versionResponse"),
+	"createNic": ([("request", "nicRequest")], "createNicReturn"),
+	"getNic": ([("nicId", "string")], "nic"),
+	"setInternetAccess": ([("dataCenterId", "string"), ("lanId", "int"), ("internetAccess", "boolean")], "versionResponse"),
+	"updateNic": ([("request", "nicRequest")], "versionResponse"),
+	"deleteNic": ([("nicId", "string")], "versionResponse"),
+	"reservePublicIpBlock": ([("blockSize", "int")], "reservedIpBlock"),
+	"addPublicIpToNic": ([("ip", "string"), ("nicId", "string")], "versionResponse"),
+	"getAllPublicIpBlocks": ([], "ipBlock*"),
+	"removePublicIpFromNic": ([("ip", "string"), ("nicId", "string")], "versionResponse"),
+	"releasePublicIpBlock": ([("blockId", "string")], "versionResponse"),
+	"addFirewallRuleToNic": ([("nicId", "string"), ("request", "firewallRuleRequest*")], "firewall"),
+	"addFirewallRuleToLoadBalancer": ([("loadBalancerId", "string"), ("request", "firewallRuleRequest*")], "firewall")
+}
+
+def _xsdType(fieldType):
+	name = fieldType.rstrip("*")
+	return ("xs:" if name in ("string", "int", "boolean", "dateTime") else "tns:") + name
+
+def _xsdElement(name, fieldType):
+	return '<xs:element name="%s" type="%s" minOccurs="0"%s/>' % (name, _xsdType(fieldType), ' maxOccurs="unbounded"' if fieldType.endswith("*") else "")
+
+# Returns the WSDL of the service, with its endpoint at location
+def wsdl(location):
+	schema, messages, portType, binding = [], [], [], []
+	for name in sorted(types):
+		schema.append('<xs:complexType name="%s"><xs:sequence>%s</xs:sequence></xs:complexType>' % (name, "".join(_xsdElement(f, t) for f, t in types[name])))
+	for op in sorted(operations):
+		params, returnType = operations[op]
+		schema.append('<xs:element name="%s" type="tns:%s"/><xs:element name="%sResponse" type="tns:%sResponse"/>' % (op, op, op, op))
+		schema.append('<xs:complexType name="%s"><xs:sequence>%s</xs:sequence></xs:complexType>' % (op, "".join(_xsdElement(p, t) for p, t in params)))
+		schema.append('<xs:complexType name="%sResponse"><xs:sequence>%s</xs:sequence></xs:complexType>' % (op, _xsdElement("return", returnType) if returnType else ""))
+		messages.append('<message name="%s"><part name="parameters" element="tns:%s"/></message><message name="%sResponse"><part name="parameters" element="tns:%sResponse"/></message>' % (op, op, op, op))
+		portType.append('<operation name="%s"><input message="tns:%s"/><output message="tns:%sResponse"/></operation>' % (op, op, op))
+		binding.append('<operation name="%s"><soap:operation soapAction=""/><input><soap:body use="literal"/></input><output><soap:body use="literal"/></output></operation>' % op)
+	return "\n".join([
+		'<?xml version="1.0" encoding="UTF-8"?>',
+		'<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="%s" targetNamespace="%s" name="ProfitbricksApiService">' % (namespace, namespace),
+		'<types><xs:schema version="1.0" targetNamespace="%s">' % namespace] + schema + [
+		'</xs:schema></types>'] + messages + [
+		'<portType name="ProfitbricksApi">'] + portType + [
+		'</portType>',
+		'<binding name="ProfitbricksApiPortBinding" type="tns:ProfitbricksApi"><soap:binding transport="http://schemas.xmlsoap.org/soap/http" style="document"/>'] + binding + [
+		'</binding>',
+		'<service name="ProfitbricksApiService"><port name="ProfitbricksApiPort" binding="tns:ProfitbricksApiPortBinding"><soap:address location="%s"/></port></service>' % escape(location),
+		'</definitions>'])
+
+# Returns the XML of value as the fieldType element(s) called name
+def serialize(name, value, fieldType):
+	if value is None:
+		return ""
+	if fieldType.endswith("*"):
+		return "".join(serialize(name, item, fieldType[:-1]) for item in value)
+	if fieldType in types:
+		return "<%s>%s</%s>" % (name, "".join(serialize(f, value.get(f), t) for f, t in types[fieldType]), name)
+	if fieldType == "boolean":
+		value = "true" if value else "false"
+	elif fieldType == "dateTime":
+		value = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(value)) + ".000Z"
+	return "<%s>%s</%s>" % (name, escape(unicode(value).encode("utf-8")), name)
+
+# Returns the python value of the fieldType element(s) in elements
+def deserialize(elements, fieldType):
+	if fieldType.endswith("*"):
+		return [deserialize([element], fieldType[:-1]) for element in elements]
+	if not elements:
+		return None
+	element = elements[0]
+	if fieldType in types:
+		value = {}
+		for f, t in types[fieldType]:
+			children = [child for child in element if _localName(child.tag) == f]
+			if children:
+				value[f] = deserialize(children, t)
+		return value
+	text = element.text or ""
+	if fieldType == "int":
+		return int(text) if text.strip() != "" else None
+	if fieldType == "boolean":
+		return text.strip().lower() in ("true", "1")
+	return text
+
+def _localName(tag):
+	return tag.split("}")[-1]
+
+class Fault(Exception):
+	pass
+
+# In-memory model of one account; every public method is the operation of the same name
+class Account:
+
+	provisioning = 2.0 # seconds changed resources stay INPROCESS
+
+	def __init__(self, provisioning = None):
+		if provisioning is not None:
+			self.provisioning = provisioning
+		self.lock = threading.RLock()
+		self.dataCenters = {}
+		self.servers = {}
+		self.storages = {}
+		self.nics = {}
+		self.loadBalancers = {}
+		self.ipBlocks = {}
+		self.images = {}
+		self.busy = [] # resources waiting to become AVAILABLE
+		self.requests = 0
+		for name, imageType, size, osType in (("Ubuntu-11.10-server", "HDD", 2048, "LINUX"), ("CentOS-6.2-minimal", "HDD", 2048, "LINUX"), ("Windows-2008-R2", "HDD", 20480, "WINDOWS"), ("debian-6.0.4-netinst.iso", "CDROM", 180, "LINUX")):
+			imageId = self._id()
+			self.images[imageId] = {"imageId": imageId, "imageName": name, "imageSize": size, "imageType": imageType, "writeable": True, "cpuHotpluggable": True, "memoryHotpluggable": False, "serverIds": [], "osType": osType}
+
+	def _id(self):
+		return str(uuid.uuid4())
+
+	def _requestId(self):
+		self.requests += 1
+		return str(self.requests)
+
+	def _get(self, table, id, kind):
+		self._settle()
+		if id not in table:
+			raise Fault("%s %s does not exist" % (kind, id))
+		return table[id]
+
+	def _changed(self, dataCenter, *resources):
+		now = time.time()
+		dataCenter["dataCenterVersion"] += 1
+		for resource in (dataCenter,) + resources:
+			resource["provisioningState"] = "INPROCESS"
+			resource["lastModificationTime"] = now
+			resource["_readyAt"] = now + self.provisioning
+			if resource not in self.busy:
+				self.busy.append(resource)
+		return {"requestId": self._requestId(), "dataCenterId": dataCenter["dataCenterId"], "dataCenterVersion": dataCenter["dataCenterVersion"]}
+
+	# Makes the resources whose provisioning time is over AVAILABLE
+	def _settle(self):
+		now = time.time()
+		for resource in [r for r in self.busy if r["_readyAt"] <= now]:
+			resource["provisioningState"] = "AVAILABLE"
+			if "virtualMachineState" in resource:
+				resource["virtualMachineState"] = "RUNNING"
+			self.busy.remove(resource)
+
+	def _new(self, dataCenter, table, idField, fields):
+		now = time.time()
+		resource = dict(fields, creationTime = now, lastModificationTime = now, provisioningState = "INPROCESS", _dc = dataCenter["dataCenterId"])
+		resource[idField] = self._id()
+		table[resource[idField]] = resource
+		return resource
+
+	def _dataCenterOf(self, resource):
+		return self.dataCenters[resource["_dc"]]
+
+	def _lan(self, dataCenter, lanId):
+		return dataCenter["_lans"].setdefault(int(lanId), {"internetAccess": False, "hosts": 0})
+
+	def _newNic(self, dataCenter, server, lanId, name = None, ip = None):
+		lan = self._lan(dataCenter, lanId)
+		lan["hosts"] += 1
+		nic = self._new(dataCenter, self.nics, "nicId", {"nicName": name, "lanId": int(lanId), "serverId": server["serverId"], "macAddress": "02:01:%02x:%02x:%02x:%02x" % tuple(random.randint(0, 255) for i in range(4)), "ips": [ip or "10.%d.%d.%d" % (int(lanId) % 256, lan["hosts"] // 250, lan["hosts"] % 250 + 2)], "firewall": None})
+		server["_nics"].append(nic["nicId"])
+		return nic
+
+	# Views: what the API returns for each kind of resource
+
+	def _nicView(self, nic):
+		lan = self._lan(self._dataCenterOf(nic), nic["lanId"])
+		return dict(nic, internetAccess = lan["internetAccess"])
+
+	def _serverView(self, server):
+		nics = [self._nicView(self.nics[nicId]) for nicId in server["_nics"]]
+		return dict(server,
+			nics = nics,
+			ips = [ip for nic in nics for ip in nic["ips"]],
+			internetAccess = any(nic["internetAccess"] for nic in nics),
+			connectedStorages = [dict(self.storages[storageId], busType = bus, deviceNumber = number, bootDevice = storageId == server.get("_bootFrom")) for storageId, bus, number in server["_storages"]],
+			romDrives = [dict(imageId = imageId, imageName = self.images[imageId]["imageName"], deviceNumber = number) for imageId, number in server["_romDrives"] if imageId in self.images])
+
+	def _storageView(self, storage):
+		image = self.images.get(storage.get("_mountImageId"))
+		return dict(storage, mountImage = {"imageId": image["imageId"], "imageName": image["imageName"]} if image else None)
+
+	def _loadBalancerView(self, loadBalancer):
+		balanced = []
+		for serverId, active in loadBalancer["_servers"]:
+			server = self.servers.get(serverId)
+			if server is not None:
+				balanced.append({"activate": active, "serverId": serverId, "serverName": server["serverName"], "balancedNicId": server["_nics"][0] if server["_nics"] else ""})
+		return dict(loadBalancer, balancedServers = balanced)
+
+	def _dataCenterState(self, dataCenter):
+		dcid = dataCenter["dataCenterId"]
+		return "INPROCESS" if any(r is dataCenter or r.get("_dc") == dcid for r in self.busy) else "AVAILABLE"
+
+	# Data centers
+
+	def getAllDataCenters(self):
+		return [{"dataCenterId": dc["dataCenterId"], "dataCenterName": dc["dataCenterName"], "dataCenterVersion": dc["dataCenterVersion"]} for dc in self.dataCenters.values()]
+
+	def getDataCenter(self, dataCenterId):
+		dataCenter = self._get(self.dataCenters, dataCenterId, "Data center")
+		return dict(dataCenter,
+			requestId = self._requestId(),
+			provisioningState = self._dataCenterState(dataCenter),
+			servers = [self._serverView(s) for s in self.servers.values() if s["_dc"] == dataCenterId],
+			storages = [self._storageView(s) for s in self.storages.values() if s["_dc"] == dataCenterId],
+			loadBalancers = [self._loadBalancerView(b) for b in self.loadBalancers.values() if b["_dc"] == dataCenterId])
+
+	def getDataCenterState(self, dataCenterId):
+		return self._dataCenterState(self._get(self.dataCenters, dataCenterId, "Data center"))
+
+	def createDataCenter(self, dataCenterName = None):
+		dcid = self._id()
+		dataCenter = {"dataCenterId": dcid, "dataCenterName": dataCenterName or "", "dataCenterVersion": 0, "_lans": {}}
+		self.dataCenters[dcid] = dataCenter
+		return self._changed(dataCenter)
+
+	def updateDataCenter(self, request):
+		dataCenter = self._get(self.dataCenters, request.get("dataCenterId"), "Data center")
+		if "dataCenterName" in request:
+			dataCenter["dataCenterName"] = request["dataCenterName"]
+		return self._changed(dataCenter)
+
+	def clearDataCenter(self, dataCenterId):
+		dataCenter = self._get(self.dataCenters, dataCenterId, "Data center")
+		for table in (self.servers, self.storages, self.nics, self.loadBalancers):
+			for id in [id for id, r in table.items() if r["_dc"] == dataCenterId]:
+				del table[id]
+		dataCenter["_lans"] = {}
+		return self._changed(dataCenter)
+
+	def deleteDataCenter(self, dataCenterId):
+		dataCenter = self._get(self.dataCenters, dataCenterId, "Data center")
+		if any(r["_dc"] == dataCenterId for table in (self.servers, self.storages, self.loadBalancers) for r in table.values()):
+			raise Fault("Data center %s is not empty" % dataCenterId)
+		del self.dataCenters[dataCenterId]
+		if dataCenter in self.busy:
+			self.busy.remove(dataCenter)
+		return {"requestId": self._requestId()}
+
+	# Servers
+
+	def createServer(self, request):
+		dataCenter = self._get(self.dataCenters, request.get("dataCenterId"), "Data center") if request.get("dataCenterId") else self.dataCenters[self.createDataCenter()["dataCenterId"]]
+		if not request.get("cores") or not request.get("ram"):
+			raise Fault("cores and ram are required")
+		server = self._new(dataCenter, self.servers, "serverId", {"serverName": request.get("serverName") or "", "cores": request["cores"], "ram": request["ram"], "osType": request.get("osType") or "UNKNOWN", "virtualMachineState": "NOSTATE", "_nics": [], "_storages": [], "_romDrives": []})
+		changed = [server]
+		if request.get("lanId") is not None:
+			changed.append(self._newNic(dataCenter, server, request["lanId"]))
+			if request.get("internetAccess"):
+				self._lan(dataCenter, request["lanId"])["internetAccess"] = True
+		if request.get("bootFromStorageId"):
+			self._connect(server, self._get(self.storages, request["bootFromStorageId"], "Storage"), "VIRTIO", 1)
+			server["_bootFrom"] = request["bootFromStorageId"]
+		if request.get("bootFromImageId"):
+			server["_romDrives"].append((self._get(self.images, request["bootFromImageId"], "Image")["imageId"], 1))
+		return dict(self._changed(dataCenter, *changed), serverId = server["serverId"])
+
+	def getServer(self, serverId):
+		return dict(self._serverView(self._get(self.servers, serverId, "Server")), requestId = self._requestId())
+
+	def rebootServer(self, serverId):
+		server = self._get(self.servers, serverId, "Server")
+		return self._changed(self._dataCenterOf(server), server)
+
+	def updateServer(self, request):
+		server = self._get(self.servers, request.get("serverId"), "Server")
+		for field in ("serverName", "cores", "ram", "osType"):
+			if request.get(field) is not None:
+				server[field] = request[field]
+		return self._changed(self._dataCenterOf(server), server)
+
+	def deleteServer(self, serverId):
+		server = self._get(self.servers, serverId, "Server")
+		for nicId in server["_nics"]:
+			self.nics.pop(nicId, None)
+		for storageId, bus, number in server["_storages"]:
+			if storageId in self.storages:
+				self.storages[storageId]["serverIds"].remove(serverId)
+		del self.servers[serverId]
+		return self._changed(self._dataCenterOf(server))
+
+	# Storages
+
+	def createStorage(self, request):
+		dataCenter = self._get(self.dataCenters, request.get("dataCenterId"), "Data center")
+		if not request.get("size"):
+			raise Fault("size is required")
+		image = self._get(self.images, request["mountImageId"], "Image") if request.get("mountImageId") else None
+		storage = self._new(dataCenter, self.storages, "storageId", {"storageName": request.get("storageName") or "", "size": request["size"], "serverIds": [], "osType": image["osType"] if image else "UNKNOWN", "_mountImageId": image and image["imageId"]})
+		return dict(self._changed(dataCenter, storage), storageId = storage["storageId"])
+
+	def getStorage(self, storageId):
+		return dict(self._storageView(self._get(self.storages, storageId, "Storage")), requestId = self._requestId())
+
+	def _connect(self, server, storage, busType, deviceNumber):
+		if server["serverId"] in storage["serverIds"]:
+			raise Fault("Storage %s is already connected to server %s" % (storage["storageId"], server["serverId"]))
+		storage["serverIds"].append(server["serverId"])
+		server["_storages"].append((storage["storageId"], (busType or "VIRTIO").upper(), deviceNumber or len(server["_storages"]) + 1))
+
+	def connectStorageToServer(self, request):
+		storage = self._get(self.storages, request.get("storageId"), "Storage")
+		server = self._get(self.servers, request.get("serverId"), "Server")
+		self._connect(server, storage, request.get("busType"), request.get("deviceNumber"))
+		return self._changed(self._dataCenterOf(server), server, storage)
+
+	def disconnectStorageFromServer(self, storageId, serverId):
+		storage = self._get(self.storages, storageId, "Storage")
+		server = self._get(self.servers, serverId, "Server")
+		if serverId not in storage["serverIds"]:
+			raise Fault("Storage %s is not connected to server %s" % (storageId, serverId))
+		storage["serverIds"].remove(serverId)
+		server["_storages"] = [s for s in server["_storages"] if s[0] != storageId]
+		return self._changed(self._dataCenterOf(server), server, storage)
+
+	def updateStorage(self, request):
+		storage = self._get(self.storages, request.get("storageId"), "Storage")
+		if request.get("storageName") is not None:
+			storage["storageName"] = request["storageName"]
+		if request.get("size") is not None:
+			if request["size"] < storage["size"]:
+				raise Fault("Storages can't shrink")
+			storage["size"] = request["size"]
+		if request.get("mountImageId"):
+			storage["_mountImageId"] = self._get(self.images, request["mountImageId"], "Image")["imageId"]
+		return self._changed(self._dataCenterOf(storage), storage)
+
+	def deleteStorage(self, storageId):
+		storage = self._get(self.storages, storageId, "Storage")
+		for serverId in storage["serverIds"]:
+			server = self.servers[serverId]
+			server["_storages"] = [s for s in server["_storages"] if s[0] != storageId]
+		del self.storages[storageId]
+		return self._changed(self._dataCenterOf(storage))
+
+	# Load balancers
+
+	def createLoadBalancer(self, request):
+		dataCenter = self._get(self.dataCenters, request.get("dataCenterId"), "Data center")
+		lanId = request.get("lanId") or 1
+		loadBalancer = self._new(dataCenter, self.loadBalancers, "loadBalancerId", {"loadBalancerName": request.get("loadBalancerName") or "", "loadBalancerAlgorithm": request.get("loadBalancerAlgorithm") or "ROUND_ROBIN", "lanId": lanId, "ip": request.get("ip") or "10.%d.255.%d" % (lanId % 256, len(self.loadBalancers) % 250 + 2), "firewall": None, "_servers": []})
+		for serverId in request.get("serverIds") or []:
+			self._get(self.servers, serverId, "Server")
+			loadBalancer["_servers"].append((serverId, True))
+		return dict(self._changed(dataCenter, loadBalancer), loadBalancerId = loadBalancer["loadBalancerId"])
+
+	def getLoadBalancer(self, loadBalancerId):
+		return dict(self._loadBalancerView(self._get(self.loadBalancers, loadBalancerId, "Load balancer")), requestId = self._requestId())
+
+	def updateLoadBalancer(self, request):
+		loadBalancer = self._get(self.loadBalancers, request.get("loadBalancerId"), "Load balancer")
+		for field in ("loadBalancerName", "loadBalancerAlgorithm", "ip"):
+			if request.get(field) is not None:
+				loadBalancer[field] = request[field]
+		return self._changed(self._dataCenterOf(loadBalancer), loadBalancer)
+
+	def registerServersOnLoadBalancer(self, serverIds, loadBalancerId):
+		loadBalancer = self._get(self.loadBalancers, loadBalancerId, "Load balancer")
+		for serverId in serverIds:
+			self._get(self.servers, serverId, "Server")
+			if serverId not in [s for s, active in loadBalancer["_servers"]]:
+				loadBalancer["_servers"].append((serverId, True))
+		response = self._changed(self._dataCenterOf(loadBalancer), loadBalancer)
+		return dict(self._loadBalancerView(loadBalancer), **response)
+
+	def deregisterServersOnLoadBalancer(self, serverIds, loadBalancerId):
+		loadBalancer = self._get(self.loadBalancers, loadBalancerId, "Load balancer")
+		loadBalancer["_servers"] = [(s, active) for s, active in loadBalancer["_servers"] if s not in serverIds]
+		return self._changed(self._dataCenterOf(loadBalancer), loadBalancer)
+
+	def _activate(self, serverIds, loadBalancerId, active):
+		loadBalancer = self._get(self.loadBalancers, loadBalancerId, "Load balancer")
+		loadBalancer["_servers"] = [(s, active if s in serverIds else a) for s, a in loadBalancer["_servers"]]
+		return self._changed(self._dataCenterOf(loadBalancer), loadBalancer)
+
+	def activateLoadBalancingOnServers(self, serverIds, loadBalancerId):
+		return self._activate(serverIds, loadBalancerId, True)
+
+	def deactivateLoadBalancingOnServers(self, serverIds, loadBalancerId):
+		return self._activate(serverIds, loadBalancerId, False)
+
+	def deleteLoadBalancer(self, loadBalancerId):
+		loadBalancer = self._get(self.loadBalancers, loadBalancerId, "Load balancer")
+		del self.loadBalancers[loadBalancerId]
+		return self._changed(self._dataCenterOf(loadBalancer))
+
+	# CD/DVD drives and images
+
+	def addRomDriveToServer(self, request):
+		server = self._get(self.servers, request.get("serverId"), "Server")
+		image = self._get(self.images, request.get("imageId"), "Image")
+		server["_romDrives"].append((image["imageId"], request.get("deviceNumber") or len(server["_romDrives"]) + 1))
+		return self._changed(self._dataCenterOf(server), server)
+
+	def removeRomDriveFromServer(self, imageId, serverId):
+		server = self._get(self.servers, serverId, "Server")
+		server["_romDrives"] = [d for d in server["_romDrives"] if d[0] != imageId]
+		return self._changed(self._dataCenterOf(server), server)
+
+	def setImageOsType(self, imageId, osType):
+		self._get(self.images, imageId, "Image")["osType"] = osType
+		return {"requestId": self._requestId()}
+
+	def getImage(self, imageId):
+		return self._get(self.images, imageId, "Image")
+
+	def getAllImages(self):
+		return self.images.values()
+
+	def deleteImage(self, imageId):
+		self._get(self.images, imageId, "Image")
+		del self.images[imageId]
+		return {"requestId": self._requestId()}
+
+	# NICs and IPs
+
+	def createNic(self, request):
+		server = self._get(self.servers, request.get("serverId"), "Server")
+		dataCenter = self._dataCenterOf(server)
+		nic = self._newNic(dataCenter, server, request.get("lanId") or 1, request.get("nicName"), request.get("ip"))
+		return dict(self._changed(dataCenter, server, nic), nicId = nic["nicId"])
+
+	def getNic(self, nicId):
+		return dict(self._nicView(self._get(self.nics, nicId, "NIC")), requestId = self._requestId())
+
+	def setInternetAccess(self, dataCenterId, lanId, internetAccess):
+		dataCenter = self._get(self.dataCenters, dataCenterId, "Data center")
+		self._lan(dataCenter, lanId)["internetAccess"] = internetAccess
+		return self._changed(dataCenter)
+
+	def updateNic(self, request):
+		nic = self._get(self.nics, request.get("nicId"), "NIC")
+		if request.get("nicName") is not None:
+			nic["nicName"] = request["nicName"]
+		if request.get("lanId") is not None:
+			nic["lanId"] = request["lanId"]
+		if request.get("ip") is not None:
+			nic["ips"] = [request["ip"]] if request["ip"] != "" else []
+		return self._changed(self._dataCenterOf(nic), nic)
+
+	def deleteNic(self, nicId):
+		nic = self._get(self.nics, nicId, "NIC")
+		server = self.servers[nic["serverId"]]
+		server["_nics"].remove(nicId)
+		del self.nics[nicId]
+		return self._changed(self._dataCenterOf(nic), server)
+
+	def reservePublicIpBlock(self, blockSize):
+		if not blockSize or blockSize < 1:
+			raise Fault("blockSize must be at least 1")
+		blockId = self._id()
+		base = len(self.ipBlocks) * 16
+		ips = ["46.16.%d.%d" % ((base + i) // 250 % 256, (base + i) % 250 + 2) for i in range(blockSize)]
+		self.ipBlocks[blockId] = {"blockId": blockId, "publicIps": [{"ip": ip, "nicId": None} for ip in ips]}
+		return {"requestId": self._requestId(), "blockId": blockId, "ips": ips}
+
+	def _publicIp(self, ip):
+		for block in self.ipBlocks.values():
+			for publicIp in block["publicIps"]:
+				if publicIp["ip"] == ip:
+					return publicIp
+		raise Fault("IP %s is not reserved" % ip)
+
+	def addPublicIpToNic(self, ip, nicId):
+		nic = self._get(self.nics, nicId, "NIC")
+		publicIp = self._publicIp(ip)
+		if publicIp["nicId"] is not None:
+			raise Fault("IP %s is already in use" % ip)
+		publicIp["nicId"] = nicId
+		nic["ips"].append(ip)
+		return self._changed(self._dataCenterOf(nic), nic)
+
+	def getAllPublicIpBlocks(self):
+		return self.ipBlocks.values()
+
+	def removePublicIpFromNic(self, ip, nicId):
+		nic = self._get(self.nics, nicId, "NIC")
+		publicIp = self._publicIp(ip)
+		if publicIp["nicId"] != nicId:
+			raise Fault("IP %s is not assigned to NIC %s" % (ip, nicId))
+		publicIp["nicId"] = None
+		nic["ips"].remove(ip)
+		return self._changed(self._dataCenterOf(nic), nic)
+
+	def releasePublicIpBlock(self, blockId):
+		block = self._get(self.ipBlocks, blockId, "IP block")
+		if any(publicIp["nicId"] for publicIp in block["publicIps"]):
+			raise Fault("IP block %s is still in use" % blockId)
+		del self.ipBlocks[blockId]
+		return {"requestId": self._requestId()}
+
+	# Firewalls
+
+	def _addFirewallRules(self, owner, idField, rules):
+		if owner.get("firewall") is None:
+			owner["firewall"] = {"firewallId": self._id(), idField: owner[idField], "active": True, "firewallRules": []}
+		firewall = owner["firewall"]
+		for rule in rules:
+			firewall["firewallRules"].append(dict(rule, firewallRuleId = self._id()))
+		response = self._changed(self._dataCenterOf(owner), owner)
+		firewall["provisioningState"] = owner["provisioningState"]
+		return dict(firewall, requestId = response["requestId"], nicId = firewall.get("nicId"))
+
+	def addFirewallRuleToNic(self, nicId, request):
+		return self._addFirewallRules(self._get(self.nics, nicId, "NIC"), "nicId", request)
+
+	def addFirewallRuleToLoadBalancer(self, loadBalancerId, request):
+		return self._addFirewallRules(self._get(self.loadBalancers, loadBalancerId, "Load balancer"), "loadBalancerId", request)
+
+	# Creates a data center with the given number of servers, each with a NIC and a storage (for benchmarks)
+	def seed(self, servers, name = "seeded"):
+		with self.lock:
+			dcid = self.createDataCenter(name)["dataCenterId"]
+			for i in range(servers):
+				serverId = self.createServer({"dataCenterId": dcid, "serverName": "server-%d" % i, "cores": 1 + i % 4, "ram": 1024, "lanId": 1 + i % 3, "internetAccess": i % 3 == 0})["serverId"]
+				storageId = self.createStorage({"dataCenterId": dcid, "storageName": "storage-%d" % i, "size": 10 + i % 90})["storageId"]
+				self.connectStorageToServer({"storageId": storageId, "serverId": serverId, "busType": "VIRTIO"})
+			return dcid
+
+	# Runs operation op with the parsed parameters and returns the reply body
+	def call(self, op, params):
+		with self.lock:
+			self._settle()
+			return getattr(self, op)(*params)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	protocol_version = "HTTP/1.1"
+	wbufsize = -1 # send each reply in one write (headers and body in separate packets run into delayed ACKs)
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+	def reply(self, status, body, contentType = "text/xml; charset=utf-8", headers = {}):
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def authorized(self):
+		if self.server.credentials is None:
+			return True
+		header = self.headers.get("Authorization", "")
+		return header.startswith("Basic ") and base64.b64decode(header[6:]) == self.server.credentials
+
+	def do_GET(self):
+		if not self.path.rstrip("/").lower().endswith("/wsdl"):
+			self.reply(404, "Not found", "text/plain")
+			return
+		self.reply(200, self.server.wsdl)
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		server = self.server
+		delay = server.latency + random.uniform(0, server.jitter)
+		if delay > 0:
+			time.sleep(delay)
+		if not self.authorized():
+			self.reply(401, "Unauthorized", "text/plain", {"WWW-Authenticate": 'Basic realm="ProfitBricks"'})
+			return
+		if random.random() < server.errorRate:
+			self.reply(503, "Service Unavailable (injected)", "text/plain")
+			return
+		try:
+			element = [child for child in etree.fromstring(body).iter() if _localName(child.tag) == "Body"][0][0]
+			op = _localName(element.tag)
+			if op not in operations:
+				raise Fault("Unknown operation %s" % op)
+			if random.random() < server.faultRate:
+				raise Fault("Injected fault")
+			params, returnType = operations[op]
+			values = [deserialize([child for child in element if _localName(child.tag) == name], fieldType) for name, fieldType in params]
+			result = server.account.call(op, values)
+		except Fault as (err):
+			self.reply(500, envelope('<S:Fault><faultcode>S:Server</faultcode><faultstring>%s</faultstring></S:Fault>' % escape(str(err))))
+			return
+		except Exception as (err):
+			self.reply(500, envelope('<S:Fault><faultcode>S:Client</faultcode><faultstring>%s</faultstring></S:Fault>' % escape("%s: %s" % (err.__class__.__name__, err))))
+			return
+		server.calls += 1
+		self.reply(200, envelope('<ns2:%sResponse xmlns:ns2="%s">%s</ns2:%sResponse>' % (op, namespace, serialize("return", result, returnType) if returnType else "", op)))
+
+def envelope(body):
+	return '<?xml version="1.0" encoding="UTF-8"?><S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>%s</S:Body></S:Envelope>' % body
+
+# The stand-in HTTP server; start() runs it in a background thread (for tests), serve_forever() in the current one
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, port = 0, latency = 0, jitter = 0, faultRate = 0, errorRate = 0, provisioning = None, credentials = None, verbose = False):
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+		self.port = self.server_address[1]
+		self.endpoint = "http://127.0.0.1:%d/1.1" % self.port
+		self.url = self.endpoint + "/wsdl"
+		self.wsdl = wsdl(self.endpoint)
+		self.account = Account(provisioning)
+		self.latency = latency / 1000.0
+		self.jitter = jitter / 1000.0
+		self.faultRate = faultRate
+		self.errorRate = errorRate
+		self.credentials = credentials
+		self.verbose = verbose
+		self.calls = 0
+		self.lock = threading.Lock()
+		self.connections = set()
+		self.threads = set()
+		self.stopped = False
+
+	def start(self):
+		thread = threading.Thread(target = self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	# Stops serving and closes the connections clients still keep alive, so no handler thread outlives the server
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		with self.lock:
+			self.stopped = True
+			connections = list(self.connections)
+		for connection in connections:
+			try:
+				connection.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+		for thread in list(self.threads):
+			thread.join(1)
+
+	def process_request(self, request, clientAddress):
+		with self.lock:
+			if self.stopped:
+				self.shutdown_request(request)
+				return
+			self.connections.add(request)
+		thread = threading.Thread(target = self.process_request_thread, args = (request, clientAddress))
+		thread.daemon = True
+		self.threads.add(thread)
+		thread.start()
+
+	def process_request_thread(self, request, clientAddress):
+		try:
+			SocketServer.ThreadingMixIn.process_request_thread(self, request, clientAddress)
+		finally:
+			with self.lock:
+				self.connections.discard(request)
+				self.threads.discard(threading.current_thread())
+
+if __name__ == "__main__":
+	args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+	server = StandInServer(
+		port = int(args.get("-port", 8080)),
+		latency = float(args.get("-latency", 0)),
+		jitter = float(args.get("-jitter", 0)),
+		faultRate = float(args.get("-fault-rate", 0)),
+		errorRate = float(args.get("-error-rate", 0)),
+		provisioning = float(args["-provisioning"]) if "-provisioning" in args else None,
+		credentials = args.get("-auth"),
+		verbose = True)
+	if "-dump-wsdl" in args:
+		open(args["-dump-wsdl"], "w").write(server.wsdl)
+	if "-seed" in args:
+		print "Seeded data center %s" % server.account.seed(int(args["-seed"]))
+	print "ProfitBricks stand-in listening, WSDL at %s" % server.url
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass